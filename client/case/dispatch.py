@@ -90,17 +90,21 @@ def ep_create_grid_env():
     cur = ep_connection.cursor()
     try:
         if ep_cfg.domain.create_grid:
-            # regular grid created by fume, envelope is a rectangle
-            cur.execute('select min(xmi), min(ymi), max(xma), max(yma) from "{}"."{}"'.format(conf_schema, grid_name))
-            row = cur.fetchone()
-            sqltext = 'insert into "{}".ep_grid_env select ST_MakeEnvelope({}, {}, {}, {}, {}) as geom'.format(
-                       case_schema, row[0], row[1], row[2], row[3], ep_cfg.projection_params.projection_srid)
-            log.debug('sqltext:', sqltext)
-            cur.execute(sqltext)
+            # regular grid created by fume, envelope is the rectangle of the domain bounds
+            # (the same expressions as the cell bounds in ep_create_grid)
+            domain = ep_cfg.domain
+            sqltext = 'insert into "{}".ep_grid_env select ST_MakeEnvelope(' \
+                      '%(xo)s::float8+%(dx)s::float8*(0-%(nx)s/2.0), %(yo)s::float8+%(dy)s::float8*(0-%(ny)s/2.0), ' \
+                      '%(xo)s::float8+%(dx)s::float8*(%(nx)s-%(nx)s/2.0), %(yo)s::float8+%(dy)s::float8*(%(ny)s-%(ny)s/2.0), %(srid)s) as geom'.format(case_schema)
+            params = {'xo': domain.xorg, 'yo': domain.yorg, 'dx': domain.delx, 'dy': domain.dely,
+                      'nx': domain.nx, 'ny': domain.ny, 'srid': ep_cfg.projection_params.projection_srid}
+            log.debug('sqltext:', sqltext, params)
+            cur.execute(sqltext, params)
         else:
-            # user supplied grid possibly irregular
-            cur.execute('insert into "{}".ep_grid_env select ST_Envelope((select ST_Union('
-                    '(array(select geom from "{}"."{}"))))) as geom'.format(case_schema, conf_schema, grid_name))
+            # user supplied grid possibly irregular, envelope is the extent of its cells
+            cur.execute('insert into "{}".ep_grid_env select ST_SetSRID(ST_Extent(geom)::geometry, {}) as geom '
+                        'from "{}"."{}"'.format(case_schema, ep_cfg.projection_params.projection_srid,
+                                                conf_schema, grid_name))
         cur.close()
         ep_connection.commit()
     except Exception as e:
@@ -23,6 +23,7 @@ Copyright 2014-2017 Czech Technical University in Prague, Czech Republic
 """
 
 import time
+from contextlib import contextmanager
 
 class FakeDBConnection():
     source_schema = 'sources'
@@ -58,3 +59,41 @@ class ExecTimer():
     @property
     def duration(self):
         return time.time()-self.start
+
+
+class StageTimer():
+    """
+    Accumulates the execution times of named stages of a repeated process,
+    e.g. fetching, combining and distributing the steps of a time series.
+    """
+    def __init__(self, name='', logger=None):
+        self.name = name
+        self.logger = logger
+        self.durations = {}
+
+    @contextmanager
+    def stage(self, stage):
+        start = time.time()
+        try:
+            yield self
+        finally:
+            self.durations[stage] = self.durations.get(stage, 0.0) + time.time() - start
+
+    def iterate(self, iterable, stage):
+        """
+        Iterate over iterable, accounting the time spent in obtaining
+        the items to the given stage.
+        """
+        it = iter(iterable)
+        while True:
+            with self.stage(stage):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def print_split(self):
+        if self.logger:
+            self.logger.info('*** {} stage times: {}'.format(self.name,
+                ', '.join('{} {:.2f}s'.format(k, v) for k, v in self.durations.items())))
@@ -54,6 +54,112 @@ class Domain:
             raise ValueError
 
 
+class GridGeometry:
+    """
+    Geometry of the regular case grid computed analytically from the domain
+    parameters (nx, ny, delx, dely and the domain centre xorg, yorg) and the
+    case projection given by a PROJ4 string.
+
+    Attributes (coordinates in the case projection):
+        x_edges, y_edges: 1D arrays of nx+1 and ny+1 cell edges
+        x_centres, y_centres: 1D arrays of nx and ny cell centres
+    Properties computed on first use (geographic coordinates in degrees on the
+    datum of the case projection, arrays [ny, nx] or [ny+1, nx+1]):
+        lon, lat: cell centres
+        lon_edges, lat_edges: cell corners
+    """
+
+    def __init__(self, nx, ny, delx, dely, xorg, yorg, proj4):
+        self.nx, self.ny = nx, ny
+        self.delx, self.dely = delx, dely
+        self.proj4 = proj4
+
+        xorig = xorg - nx*delx/2.0
+        yorig = yorg - ny*dely/2.0
+        self.x_edges = xorig + np.arange(nx+1)*delx
+        self.y_edges = yorig + np.arange(ny+1)*dely
+        self.x_centres = xorig + np.arange(nx)*delx + delx/2.0
+        self.y_centres = yorig + np.arange(ny)*dely + dely/2.0
+        self._lonlat = {}
+
+    @classmethod
+    def from_config(cls, cfg, rt_cfg):
+        return cls(cfg.domain.nx, cfg.domain.ny, cfg.domain.delx, cfg.domain.dely,
+                   cfg.domain.xorg, cfg.domain.yorg, rt_cfg['projection_params']['proj4string'])
+
+    def __getstate__(self):
+        # the transformers are not picklable, the coordinates are computed again if needed
+        state = dict(self.__dict__)
+        state.pop('_transformer', None)
+        state.pop('_inverse_transformer', None)
+        return state
+
+    def mesh(self):
+        """
+        Edges of the grid cells as 2D arrays grid_x, grid_y [ny+1, nx+1]
+        (the data of the grid pack).
+        """
+
+        return np.meshgrid(self.x_edges, self.y_edges)
+
+    def to_lonlat(self, x, y):
+        """
+        Vectorized inverse projection of the case coordinates x, y to lon, lat.
+        """
+
+        try:
+            transformer = self._transformer
+        except AttributeError:
+            crs = pyproj.CRS(self.proj4)
+            transformer = self._transformer = pyproj.Transformer.from_crs(crs, crs.geodetic_crs, always_xy=True)
+        return transformer.transform(x, y)
+
+    def from_lonlat(self, lon, lat):
+        """
+        Vectorized projection of lon, lat to the case coordinates x, y.
+        """
+
+        try:
+            transformer = self._inverse_transformer
+        except AttributeError:
+            crs = pyproj.CRS(self.proj4)
+            transformer = self._inverse_transformer = pyproj.Transformer.from_crs(crs.geodetic_crs, crs, always_xy=True)
+        return transformer.transform(lon, lat)
+
+    def cell_index(self, x, y):
+        """
+        Zero-based indices i, j (arrays) of the grid cells containing the points
+        x, y given in the case coordinates, -1 for the points outside the grid.
+        """
+
+        x, y = np.asarray(x, dtype='f8'), np.asarray(y, dtype='f8')
+        i = np.floor((x - self.x_edges[0])/self.delx).astype(int)
+        j = np.floor((y - self.y_edges[0])/self.dely).astype(int)
+        inside = (i >= 0) & (i < self.nx) & (j >= 0) & (j < self.ny)
+        return np.where(inside, i, -1), np.where(inside, j, -1)
+
+    def _geographic(self, name, x, y):
+        if name not in self._lonlat:
+            self._lonlat[name] = self.to_lonlat(*np.meshgrid(x, y))
+        return self._lonlat[name]
+
+    @property
+    def lon(self):
+        return self._geographic('centres', self.x_centres, self.y_centres)[0]
+
+    @property
+    def lat(self):
+        return self._geographic('centres', self.x_centres, self.y_centres)[1]
+
+    @property
+    def lon_edges(self):
+        return self._geographic('edges', self.x_edges, self.y_edges)[0]
+
+    @property
+    def lat_edges(self):
+        return self._geographic('edges', self.x_edges, self.y_edges)[1]
+
+
 def get_projection_params(srs):
         if srs.IsGeographic():
             proj = 'LATLON'
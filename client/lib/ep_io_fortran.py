@@ -1,6 +1,9 @@
 """
 Description: I/O functions for writing binary data (e.g. CAMx/UAM)
-
+    - write_record, read_record: records of values given by a struct format
+    - pack_record, pack_array_record: records as bytes, to be written in batches
+    - write_array_record, read_array_record: records ending with a NumPy array
+    - MappedRecordFile: memory mapped read access to the records of a file
 """
 
 """
@@ -23,6 +26,7 @@ Copyright 2014-2017 Czech Technical University in Prague, Czech Republic
 """
 
 import struct
+import numpy as np
 
 def get_format_string(endian, type_str):
     if endian=='big':
@@ -33,16 +37,46 @@ def get_format_string(endian, type_str):
     return fmt_mod+type_str
 
 
+def byte_order(endian):
+    return '>' if endian == 'big' else '<'
+
+
+def pack_record(endian, type_str, *var):
+    """
+    Return the bytes of a record (with the leading and trailing record
+    markers) of the values var packed by the struct format type_str.
+    """
+
+    data = struct.pack(get_format_string(endian, type_str), *var)
+    marker = struct.pack(get_format_string(endian, 'i'), len(data))
+    return b''.join((marker, data, marker))
+
+
+def pack_array_record(endian, type_str, data, *var):
+    """
+    Return the bytes of a record consisting of the values var packed by the
+    struct format type_str followed by the values of the NumPy array data
+    (in its dtype, converted to the byte order of endian). The array is
+    converted as a block, without converting each value to a Python object.
+    """
+
+    data = np.ascontiguousarray(data, dtype=np.dtype(data.dtype).newbyteorder(byte_order(endian)))
+    head = struct.pack(get_format_string(endian, type_str), *var)
+    marker = struct.pack(get_format_string(endian, 'i'), len(head) + data.nbytes)
+    return b''.join((marker, head, data.tobytes(), marker))
+
+
 def write_record(of, endian, type_str, *var):
-    try:
-        fmt_i = get_format_string(endian,'i')
-        recordsize = struct.calcsize(type_str)
-        fmt_str = get_format_string(endian, type_str)
-        of.write( struct.pack(fmt_i, recordsize))
-        of.write( struct.pack(fmt_str, *var))
-        of.write( struct.pack(fmt_i, recordsize))
-    except IOError:
-        raise
+    of.write(pack_record(endian, type_str, *var))
+
+
+def write_array_record(of, endian, type_str, data, *var):
+    """
+    Write a record consisting of the values var packed by the struct format
+    type_str followed by the values of the NumPy array data, see pack_array_record.
+    """
+
+    of.write(pack_array_record(endian, type_str, data, *var))
 
 
 def read_record(ifile, endian, type_str):
@@ -56,7 +90,86 @@ def read_record(ifile, endian, type_str):
         return(var)
     except IOError:
         raise
-        
+
+
+def read_array_record(ifile, endian, type_str, dtype):
+    """
+    Read a record written by write_array_record: returns the tuple of values
+    of the struct format type_str and the array of the rest of the record
+    with the dtype dtype (native byte order).
+    """
+
+    fmt_i = get_format_string(endian, 'i')
+    size = struct.unpack(fmt_i, ifile.read(4))[0]
+    fmt_str = get_format_string(endian, type_str)
+    headsize = struct.calcsize(fmt_str)
+    var = struct.unpack(fmt_str, ifile.read(headsize))
+    dtype = np.dtype(dtype).newbyteorder(byte_order(endian))
+    data = np.frombuffer(ifile.read(size-headsize), dtype=dtype)
+    ifile.read(4)
+    return var, data.astype(dtype.newbyteorder('='))
+
+
+class MappedRecordFile():
+    """
+    Read-only access to the records of a Fortran unformatted sequential file
+    (e.g. CAMx/UAM emission or meteorology files) through a memory map.
+
+    The file is scanned for the record markers only once, the record data
+    are returned as NumPy views of the mapped file and are read from the
+    disk only when used, e.g.
+
+        f = MappedRecordFile('emis.bin', 'big')
+        name, data = f.array(n, 'i40s', 'f4')
+    """
+
+    def __init__(self, filename, endian):
+        self.endian = endian
+        self.map = np.memmap(filename, dtype='u1', mode='r')
+        marker_dtype = np.dtype(get_format_string(endian, 'i4'))
+        offsets, sizes = [], []
+        pos = 0
+        while pos < self.map.size:
+            size = int(self.map[pos:pos+4].view(marker_dtype)[0])
+            end = pos + 4 + size
+            if end + 4 > self.map.size or int(self.map[end:end+4].view(marker_dtype)[0]) != size:
+                raise ValueError('Invalid record marker at offset {} of {}'.format(pos, filename))
+            offsets.append(pos+4)
+            sizes.append(size)
+            pos = end + 4
+
+        self.offsets = np.array(offsets, dtype='i8')
+        self.sizes = np.array(sizes, dtype='i8')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def record(self, n):
+        """
+        Raw bytes of the record n as an uint8 array view.
+        """
+
+        return self.map[self.offsets[n]:self.offsets[n]+self.sizes[n]]
+
+    def values(self, n, type_str):
+        """
+        Values of the record n unpacked by the struct format type_str.
+        """
+
+        return struct.unpack(get_format_string(self.endian, type_str), self.record(n))
+
+    def array(self, n, type_str, dtype):
+        """
+        Values of the leading part of the record n unpacked by the struct
+        format type_str and a view of the rest of the record as an array
+        of dtype in the byte order of the file.
+        """
+
+        rec = self.record(n)
+        headsize = struct.calcsize(get_format_string(self.endian, type_str))
+        var = struct.unpack(get_format_string(self.endian, type_str), rec[:headsize])
+        return var, rec[headsize:].view(np.dtype(dtype).newbyteorder(byte_order(self.endian)))
+
 
 def ResultIter(cursor, arraysize=1000):
 #   An iterator that uses fetchmany to keep memory usage down
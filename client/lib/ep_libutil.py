@@ -30,7 +30,7 @@ import configobj
 from lib.ep_config import ep_cfg
 from lib.ep_geo_tools import create_projection,  get_projection_domain_params
 from osgeo import osr
-from lib.debug import ExecTimer
+from lib.debug import ExecTimer, StageTimer
 import lib.ep_logging
 log = lib.ep_logging.Logger(__name__)
 from numpy import zeros 
@@ -76,6 +76,21 @@ def ep_getconnection(database, connection_info=None):
     return ep_connection
 
 
+def ep_newconnection():
+    """
+    Returns a new connection into the database of the shared global connection
+    (see ep_getconnection), e.g. for the use in a background thread. The caller
+    is responsible for committing and closing it.
+    """
+    connection = psycopg2.connect(database=ep_cfg.db_connection.database,
+                                  host=ep_connection_info['host'],
+                                  port=ep_connection_info['port'],
+                                  user=ep_connection_info['user'],
+                                  password=ep_connection_info['password'])
+    connection.set_client_encoding('UTF8')
+    return connection
+
+
 def ep_create_schema(schema, init_file=None, srid=None):
     """
     Create new schema and register init_file
@@ -344,6 +359,10 @@ def exec_timer(name):
     return ExecTimer(name, log)
 
 
+def stage_timer(name):
+    return StageTimer(name, log)
+
+
 def ep_internal_path(*paths):
     return path.join(ep_rtcfg['execdir'], *paths)
 
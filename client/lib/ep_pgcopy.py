@@ -0,0 +1,204 @@
+"""
+Description: decoding of the PostgreSQL binary COPY format into NumPy structured arrays
+    - copy_query: COPY statement returning the result of a query in the binary format
+    - record_dtype: NumPy dtype of the decoded rows
+    - BinaryCopyReader: file-like sink for cursor.copy_expert decoding the stream in chunks
+"""
+
+"""
+This file is part of the FUME emission model.
+
+FUME is free software: you can redistribute it and/or modify it under the terms of the GNU General
+Public License as published by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+FUME is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+Information and source code can be obtained at www.fume-ep.org
+
+Copyright 2014-2023 Institute of Computer Science of the Czech Academy of Sciences, Prague, Czech Republic
+Copyright 2014-2023 Charles University, Faculty of Mathematics and Physics, Prague, Czech Republic
+Copyright 2014-2023 Czech Hydrometeorological Institute, Prague, Czech Republic
+Copyright 2014-2017 Czech Technical University in Prague, Czech Republic
+"""
+
+import struct
+import numpy as np
+
+PGCOPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+# PostgreSQL types with fixed binary width and their NumPy (big endian) counterparts
+pg_types = {
+    'int2': '>i2',
+    'int4': '>i4',
+    'int8': '>i8',
+    'float4': '>f4',
+    'float8': '>f8',
+}
+
+
+def copy_query(query, fields):
+    """
+    Wrap a SELECT query into a binary COPY statement. fields is a list of
+    (name, pg_type) pairs, one for each column of the query result in order.
+    The columns are renamed and cast to the given types so that the binary
+    stream matches the dtype of BinaryCopyReader with the same fields.
+    """
+
+    names = ', '.join(name for name, pg_type in fields)
+    columns = ', '.join('q.{}::{}'.format(name, pg_type) for name, pg_type in fields)
+    return 'COPY (SELECT {columns} FROM ({query}) AS q({names})) TO STDOUT WITH BINARY'\
+        .format(columns=columns, query=query, names=names)
+
+
+def record_dtype(fields):
+    """
+    NumPy structured dtype (native byte order) of the rows with the given
+    fields, list of (name, pg_type) pairs.
+    """
+
+    return np.dtype([(name, np.dtype(pg_types[pg_type]).newbyteorder('='))
+                     for name, pg_type in fields])
+
+
+class BinaryCopyReader():
+    """
+    File-like object receiving a binary COPY stream (e.g. from psycopg2
+    cursor.copy_expert). The stream is decoded into NumPy structured arrays
+    with fields given by the list of (name, pg_type) pairs, native byte order.
+    Every time at least chunksize rows are available, they are passed to
+    the callback function; the rest is passed on close().
+
+    Rows are decoded with a single numpy.frombuffer call per chunk, rows
+    containing NULL values are decoded one by one (NULL is converted to NaN
+    in floating point columns and is not allowed in integer columns).
+    """
+
+    def __init__(self, fields, callback, chunksize=100000):
+        self.fields = fields
+        self.callback = callback
+        self.chunksize = chunksize
+        self.dtype = record_dtype(fields)
+        # one row on the wire: field count followed by (length, value) of each field
+        wire = [('nfields', '>i2')]
+        for name, pg_type in fields:
+            wire += [('len_'+name, '>i4'), (name, pg_types[pg_type])]
+        self.wire_dtype = np.dtype(wire)
+        self.buffer = bytearray()
+        self.header = False
+        self.finished = False
+        self.rows = []
+        self.nrows = 0
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.chunksize*self.wire_dtype.itemsize:
+            self._decode()
+            self._emit(self.chunksize)
+
+    def close(self):
+        self._decode()
+        if not self.finished:
+            raise ValueError('Binary COPY stream ended without trailer')
+        if self.buffer:
+            raise ValueError('Unexpected data after binary COPY trailer')
+        self._emit(1)
+
+    def _emit(self, minrows):
+        if self.nrows < minrows:
+            return
+        chunk = np.concatenate(self.rows) if len(self.rows) > 1 else self.rows[0]
+        self.rows = []
+        self.nrows = 0
+        self.callback(chunk)
+
+    def _append(self, rows):
+        if len(rows):
+            self.rows.append(rows)
+            self.nrows += len(rows)
+
+    def _decode(self):
+        if not self.header:
+            if not self._decode_header():
+                return
+
+        offset = 0
+        rowsize = self.wire_dtype.itemsize
+        nfields = len(self.fields)
+        while not self.finished:
+            count = (len(self.buffer)-offset) // rowsize
+            if count > 0:
+                wire = np.frombuffer(self.buffer, dtype=self.wire_dtype, count=count, offset=offset)
+                valid = wire['nfields'] == nfields
+                for name, pg_type in self.fields:
+                    valid &= wire['len_'+name] == np.dtype(pg_types[pg_type]).itemsize
+                nvalid = count if valid.all() else int(np.argmin(valid))
+                if nvalid > 0:
+                    rows = np.empty(nvalid, dtype=self.dtype)
+                    for name, pg_type in self.fields:
+                        rows[name] = wire[name][:nvalid]
+                    self._append(rows)
+                    offset += nvalid*rowsize
+                # release the view so that the buffer can be resized
+                del wire
+                if nvalid == count:
+                    continue
+
+            # trailer, a row with NULL values or an incomplete row
+            consumed = self._decode_row(offset)
+            if consumed == 0:
+                break
+            offset += consumed
+
+        del self.buffer[:offset]
+
+    def _decode_header(self):
+        if len(self.buffer) < len(PGCOPY_SIGNATURE) + 8:
+            return False
+        if bytes(self.buffer[:len(PGCOPY_SIGNATURE)]) != PGCOPY_SIGNATURE:
+            raise ValueError('Invalid binary COPY signature')
+        flags, extlen = struct.unpack_from('>ii', self.buffer, len(PGCOPY_SIGNATURE))
+        headersize = len(PGCOPY_SIGNATURE) + 8 + extlen
+        if len(self.buffer) < headersize:
+            return False
+        del self.buffer[:headersize]
+        self.header = True
+        return True
+
+    def _decode_row(self, offset):
+        """
+        Decode one row (or the trailer) starting at offset with struct.
+        Returns the number of bytes consumed, 0 if the row is not complete yet.
+        """
+
+        buf = self.buffer
+        if len(buf) - offset < 2:
+            return 0
+        nfields = struct.unpack_from('>h', buf, offset)[0]
+        if nfields == -1:
+            self.finished = True
+            return 2
+        if nfields != len(self.fields):
+            raise ValueError('Binary COPY row has {} fields, expected {}'.format(nfields, len(self.fields)))
+
+        pos = offset + 2
+        values = []
+        for name, pg_type in self.fields:
+            if len(buf) - pos < 4:
+                return 0
+            length = struct.unpack_from('>i', buf, pos)[0]
+            pos += 4
+            if length == -1:
+                if self.dtype[name].kind != 'f':
+                    raise ValueError('NULL value in integer column {} of binary COPY'.format(name))
+                values.append(np.nan)
+                continue
+            if len(buf) - pos < length:
+                return 0
+            values.append(np.frombuffer(buf, dtype=pg_types[pg_type], count=1, offset=pos)[0])
+            pos += length
+
+        self._append(np.array([tuple(values)], dtype=self.dtype))
+        return pos - offset
@@ -28,6 +28,8 @@ import lib.ep_io_fortran as mt
 from netCDF4 import Dataset
 from postproc.receiver import DataReceiver, requires
 from postproc.netcdf import NetCDFAreaTimeDisaggregator
+from postproc.timedisagg import time_factor_tensor, disaggregate
+from postproc.sharding import shard_filename
 import lib.ep_logging
 log = lib.ep_logging.Logger(__name__)
 
@@ -75,6 +77,23 @@ def long_object_name(s):
     return '{0:16s}'.format(s)
 
 
+def stack_time_record(numstk):
+    """
+    Time-variant stack parameters (IDUM, ISTK, KCELL, FLOW, PLMHT) of the
+    CAMx point source file: the same dummy values for all stacks, CAMx
+    computes the plume rise itself.
+    """
+
+    record = np.zeros(numstk, dtype=[('idum', 'i4'), ('istk', 'i4'), ('kcell', 'i4'),
+                                     ('flow', 'f4'), ('plmht', 'f4')])
+    record['idum'] = ione
+    record['istk'] = ione
+    record['kcell'] = ione
+    record['flow'] = rdum
+    record['plmht'] = rdum
+    return record
+
+
 class CAMxWriter(DataReceiver):
     """
     Postprocessor class for writing CAMx emission input files.
@@ -88,6 +107,8 @@ class CAMxWriter(DataReceiver):
     """
 
     def setup(self, filename):
+        if 'shard' in self.rt_cfg['run']:
+            filename = shard_filename(filename, self.rt_cfg['run']['datestimes'][0], self.rt_cfg['run']['shard'])
         self.outfile = open(filename, mode='wb')
 
         # datetime data needed when writing both file header and data
@@ -188,6 +209,8 @@ class CAMxAreaWriterBase(CAMxWriter):
 
 
 class CAMxAreaTimeWriter(CAMxAreaWriterBase):
+    shardable = True
+
     def setup(self):
         super().setup()
 
@@ -205,62 +228,70 @@ class CAMxAreaTimeWriter(CAMxAreaWriterBase):
                 self.ts.append(ts_id[0])
         self.ts_lookup = {member: idx for idx, member in enumerate(self.ts)}
 
+    @requires('species')
+    def receive_area_emiss_cube(self, spec_idx, start, data):
+        # the species of one time chunk come one after another, the chunk
+        # is written when all of them were received
+        if spec_idx == 0:
+            self.cube_chunk = [None]*self.numspec
+        self.cube_chunk[spec_idx] = (data.sum(axis=1)*self.cfg.run_params.time_params.timestep).astype('f4')
+        if spec_idx == self.numspec-1:
+            self.write_time_steps(start, self.cube_chunk)
+            self.cube_chunk = None
+
+    def write_time_steps(self, start, values):
+        """
+        Write the time steps from start on, values are the [time, y, x] arrays
+        of the emissions of all species.
+        """
+
+        endian = self.cfg.run_params.output_params.endian
+        datestimes = self.rt_cfg['run']['datestimes']
+        for time_idx in range(start, start+values[0].shape[0]):
+            log.debug('Time step ', time_idx, datestimes[time_idx].replace(tzinfo=None))
+            records = [mt.pack_record(endian, 'ifif', self.bdate[time_idx], self.btime[time_idx],
+                                      self.bdate[time_idx+1], self.btime[time_idx+1])]
+            for spec_idx in range(self.numspec):
+                # grid values x fastest, y slowest
+                records.append(mt.pack_array_record(endian, 'i40s', values[spec_idx][time_idx-start].ravel(),
+                                                    ione, ''.join(self.longemisname[spec_idx]).encode('utf-8')))
+            self.outfile.write(b''.join(records))
+
     @requires('time_shifts')
     def finalize(self):
+        if self.cfg.postproc.time_disaggregation == 'cube':
+            return
+
         self.infile = Dataset(self.cfg.postproc.netcdfareawriter.totalfile)
 
-        for time_idx, stepdt in enumerate(self.rt_cfg['run']['datestimes']):
-            log.debug('Time step ', time_idx, stepdt.replace(tzinfo=None))
-            mt.write_record(self.outfile,
-                            self.cfg.run_params.output_params.endian,
-                            'ifif', self.bdate[time_idx], self.btime[time_idx],
-                            self.bdate[time_idx+1], self.btime[time_idx+1])
-
-            for spec_idx, (specid, specname) in enumerate(self.species):
-                fmt_str = 'i40s'+str(self.cfg.domain.nx*self.cfg.domain.ny)+'f'
-                # Create a data placeholder with the data from the first
-                # category, then sum for the rest of the categories.
-                # In CAMx, we do not have elevated emissions (3D emissions),
-                # so sum up the vertical column too
-                data = np.zeros(self.infile.variables[specname][0][0].shape, dtype='f')
-                for ts_id in self.ts:
-                    ts_idx = self.ts_lookup[ts_id]
-                    for cat_idx, (catid, catname) in enumerate(self.categories):
-                        dtutc = self.time_shifts[(ts_id, stepdt)]
-                        tf = self.time_factors[dtutc]
-                        try:
-                            time_factor = float(tf[catid])
-                        except KeyError:
-                            continue
-
-                        data += self.infile.variables[specname][ts_idx, cat_idx, :, :, :].filled(fill_value=0)*time_factor
-
-                emis2d = np.sum(data, axis=0).transpose()
-                data2d = emis2d.flatten('F')*self.cfg.run_params.time_params.timestep
-                mt.write_record(self.outfile,
-                                self.cfg.run_params.output_params.endian,
-                                fmt_str, ione,
-                                ''.join(self.longemisname[spec_idx]).encode('utf-8'),
-                                *data2d)
+        # In CAMx, we do not have elevated emissions (3D emissions), so the
+        # vertical column is summed up when reading the totals of each species
+        datestimes = self.rt_cfg['run']['datestimes']
+        factors = time_factor_tensor(datestimes, self.time_shifts, self.time_factors,
+                                     self.ts, [c[0] for c in self.categories])
+        factors *= self.cfg.run_params.time_params.timestep
+        time_chunk = self.cfg.postproc.netcdfwriter.time_chunk
+        series = [disaggregate(np.ma.filled(self.infile.variables[specname][:], fill_value=0).sum(axis=2),
+                               factors, time_chunk)
+                  for specid, specname in self.species]
+
+        for start in range(0, len(datestimes), time_chunk):
+            self.write_time_steps(start, [next(s)[1].astype('f4') for s in series])
 
 
 class CAMxAreaWriter(CAMxAreaWriterBase):
     def receive_area_emiss(self, timestep, data):
-        mt.write_record(self.outfile, self.cfg.run_params.output_params.endian,
-                        'ifif', self.bdate[timestep], self.btime[timestep],
-                        self.bdate[timestep+1], self.btime[timestep+1])
+        endian = self.cfg.run_params.output_params.endian
+        records = [mt.pack_record(endian, 'ifif', self.bdate[timestep], self.btime[timestep],
+                                  self.bdate[timestep+1], self.btime[timestep+1])]
 
+        # in CAMx, we do not have elevated emissions (3D emissions),
+        # so sum up to the ground
+        emis2d = np.sum(data, axis=2)*self.cfg.run_params.time_params.timestep
         for i in range(self.numspec):
-            fmt_str = 'i40s'+str(self.cfg.domain.nx*self.cfg.domain.ny)+'f'
-            # in CAMx, we do not have elevated emissions (3D emissions),
-            # so sum up to the ground
-            emis2d = np.sum(data, axis=2)
-            data2d = emis2d[:, :, i].flatten('F')*self.cfg.run_params.time_params.timestep
-            mt.write_record(self.outfile,
-                            self.cfg.run_params.output_params.endian,
-                            fmt_str, ione,
-                            ''.join(self.longemisname[i]).encode('utf-8'),
-                            *data2d)
+            records.append(mt.pack_array_record(endian, 'i40s', emis2d[:, :, i].astype('f4').flatten('F'),
+                                                ione, ''.join(self.longemisname[i]).encode('utf-8')))
+        self.outfile.write(b''.join(records))
 
 
 class CAMxPointWriter(CAMxWriter):
@@ -341,38 +372,25 @@ class CAMxPointWriter(CAMxWriter):
                         ''.join(joinedstr).encode('utf-8'))
 
         mt.write_record(self.outfile, endian, 'ii', ione, self.numstk)
+        mt.write_array_record(self.outfile, endian, '',
+                              self.point_src_params[:, [2, 4, 5, 6, 7, 8]].astype('f4').ravel())
 
-        var_list = []
-        for i in range(self.numstk):
-            stk_list = [self.point_src_params[i, j] for j in (2, 4, 5, 6, 7, 8)]
-            var_list.extend(stk_list)
-
-        fmt_str = str(6*self.numstk)+'f'
-        mt.write_record(self.outfile, endian, fmt_str, *var_list)
+        # the same (1, 1, 1, 0., 0.) stack record is written every time step
+        self.stk_record = mt.pack_array_record(endian, '', stack_time_record(self.numstk))
 
     @requires('point_species')
     def receive_point_emiss(self, timestep, data):
         endian = self.cfg.run_params.output_params.endian
-        mt.write_record(self.outfile, endian, 'ifif',
-                        self.bdate[timestep], self.btime[timestep],
-                        self.bdate[timestep+1], self.btime[timestep+1])
-        mt.write_record(self.outfile, endian, 'ii', ione, self.numstk)
-        var_list = []
-        # create list to write
-
-        for i in range(self.numstk):
-            var_list.extend([ione, ione, ione, rdum, rdum])
+        records = [mt.pack_record(endian, 'ifif', self.bdate[timestep], self.btime[timestep],
+                                  self.bdate[timestep+1], self.btime[timestep+1]),
+                   mt.pack_record(endian, 'ii', ione, self.numstk),
+                   self.stk_record]
 
-        fmt_str = self.numstk*'iiiff'
-
-        mt.write_record(self.outfile, endian, fmt_str, *var_list)
-        pemis = np.array(data)
+        pemis = np.array(data)*self.cfg.run_params.time_params.timestep
         for i in range(self.numspec):
-            pemis1 = pemis[:, i]*self.cfg.run_params.time_params.timestep
-            fmt_str = 'i40s'+str(self.numstk)+'f'
-            mt.write_record(self.outfile, endian, fmt_str, ione,
-                            ''.join(self.longemisname[i]).encode('utf-8'),
-                            *pemis1)
+            records.append(mt.pack_array_record(endian, 'i40s', pemis[:, i].astype('f4'),
+                                                ione, ''.join(self.longemisname[i]).encode('utf-8')))
+        self.outfile.write(b''.join(records))
 
     def finalize(self):
         super().finalize()
@@ -400,6 +418,9 @@ class CAMxNetCDFAreaTimeWriter(NetCDFAreaTimeDisaggregator):
 
         self.outfile.createDimension('DATE-TIME', 2)        
 
+    def receive_grid_geometry(self, geometry):
+        self.grid_geometry = geometry
+
     def finalize(self):
         """
         Finalization steps
@@ -491,26 +512,13 @@ class CAMxNetCDFAreaTimeWriter(NetCDFAreaTimeDisaggregator):
         ny = self.cfg.domain.ny
         nz = self.cfg.domain.nz
 
-        xorg = self.cfg.domain.xorg
-        yorg = self.cfg.domain.yorg
-
-        delx = self.cfg.domain.delx
-        dely = self.cfg.domain.dely
+        xorig = self.grid_geometry.x_edges[0]
+        yorig = self.grid_geometry.y_edges[0]
 
-
-        xorig = xorg - nx*delx/2.0
-        yorig = yorg - ny*dely/2.0
-
-        for i in range(nx):
-            self.coord_x[i] = xorig + i*delx + delx/2.0      
-        for j in range(ny):
-            self.coord_y[j] = yorig + j*dely + dely/2.0
-
-        import pyproj
-        myproj = pyproj.Proj(self.cfg.projection_params.projection_proj4)
-        for i in range(nx):
-            for j in range(ny):
-                self.lon[j,i], self.lat[j,i] = myproj(xorig + i*delx + delx/2.0,yorig + j*dely + dely/2.0,  inverse=True)
+        self.coord_x[:] = self.grid_geometry.x_centres
+        self.coord_y[:] = self.grid_geometry.y_centres
+        self.lon[:] = self.grid_geometry.lon
+        self.lat[:] = self.grid_geometry.lat
 
         # vertical layers
         self.lev = self.outfile.createVariable('layer', 'f8', ('LAY'))
@@ -572,7 +580,7 @@ class CAMxNetCDFAreaTimeWriter(NetCDFAreaTimeDisaggregator):
         self.outfile.UPNAM = ""
         self.outfile.UPDSC = ""
 
-        self.outfile.close()
+        self.close_outfile()
 
 
 ######################################
@@ -588,6 +596,8 @@ class CAMxAreaTimeWriterFromTotalFile(CAMxWriter):
     In this class, these are not taken from the database but read in from the file. The only data coming from the database are the timefactors/time_shifts
     """
 
+    shardable = True
+
     def setup(self):
         super().setup(self.cfg.postproc.camxareawriter.outfile)
 
@@ -679,39 +689,28 @@ class CAMxAreaTimeWriterFromTotalFile(CAMxWriter):
         mt.write_record(self.outfile, endian, fmt_str,
                         ''.join(joinedstr).encode('utf-8'))
 
-        for time_idx, stepdt in enumerate(self.rt_cfg['run']['datestimes']):
-            log.debug('Time step ', time_idx, stepdt.replace(tzinfo=None))
-            mt.write_record(self.outfile,
-                            self.cfg.run_params.output_params.endian,
-                            'ifif', self.bdate[time_idx], self.btime[time_idx],
-                            self.bdate[time_idx+1], self.btime[time_idx+1])
-
-            for spec_idx, specname in enumerate(species):
-                fmt_str = 'i40s'+str(self.cfg.domain.nx*self.cfg.domain.ny)+'f'
-                # Create a data placeholder with the data from the first
-                # category, then sum for the rest of the categories.
-                # In CAMx, we do not have elevated emissions (3D emissions),
-                # so sum up the vertical column too
-                data = np.zeros(self.infile.variables[specname][0][0].shape, dtype='f')
-                for ts_id in self.ts:
-                    ts_idx = self.ts_lookup[ts_id]
-                    for cat_idx, (catid, catname) in enumerate(categories):
-                        dtutc = self.time_shifts[(ts_id, stepdt)]
-                        tf = self.time_factors[dtutc]
-                        try:
-                            time_factor = float(tf[catid])
-                        except KeyError:
-                            continue
-
-                        data += self.infile.variables[specname][ts_idx, cat_idx, :, :, :].filled(fill_value=0)*time_factor
-
-                emis2d = np.sum(data, axis=0).transpose()
-                data2d = emis2d.flatten('F')*self.cfg.run_params.time_params.timestep
-                mt.write_record(self.outfile,
-                                self.cfg.run_params.output_params.endian,
-                                fmt_str, ione,
-                                ''.join(longemisname[spec_idx]).encode('utf-8'),
-                                *data2d)
+        # In CAMx, we do not have elevated emissions (3D emissions), so the
+        # vertical column is summed up when reading the totals of each species
+        datestimes = self.rt_cfg['run']['datestimes']
+        factors = time_factor_tensor(datestimes, self.time_shifts, self.time_factors,
+                                     self.ts, [int(c) for c in category_ids])
+        factors *= self.cfg.run_params.time_params.timestep
+        time_chunk = self.cfg.postproc.netcdfwriter.time_chunk
+        series = [disaggregate(np.ma.filled(self.infile.variables[specname][:], fill_value=0).sum(axis=2),
+                               factors, time_chunk)
+                  for specname in species]
+
+        for start in range(0, len(datestimes), time_chunk):
+            values = [next(s)[1].astype('f4') for s in series]
+            for time_idx in range(start, min(start+time_chunk, len(datestimes))):
+                log.debug('Time step ', time_idx, datestimes[time_idx].replace(tzinfo=None))
+                records = [mt.pack_record(endian, 'ifif', self.bdate[time_idx], self.btime[time_idx],
+                                          self.bdate[time_idx+1], self.btime[time_idx+1])]
+                for spec_idx in range(numspec):
+                    # grid values x fastest, y slowest
+                    records.append(mt.pack_array_record(endian, 'i40s', values[spec_idx][time_idx-start].ravel(),
+                                                        ione, ''.join(longemisname[spec_idx]).encode('utf-8')))
+                self.outfile.write(b''.join(records))
 
 
 class CAMxPointTimeWriterFromTotalFile(CAMxWriter):
@@ -723,6 +722,8 @@ class CAMxPointTimeWriterFromTotalFile(CAMxWriter):
     In this class, these are not taken from the database but read in from the file. The only data coming from the database are the timefactors/time_shifts
     """
 
+    shardable = True
+
     def setup(self):
         super().setup(self.cfg.postproc.camxpointwriter.outfile)
 
@@ -826,53 +827,31 @@ class CAMxPointTimeWriterFromTotalFile(CAMxWriter):
         mt.write_record(self.outfile, endian, fmt_str,
                         ''.join(joinedstr).encode('utf-8'))
 
-        # stack param record
+        # stack param record: XLOCA, YLOCA, STKHT, STKDM, STKTK, STKVE of each stack
         mt.write_record(self.outfile, endian, 'ii', ione, numstk)
-        var_list = []
-        for i in range(numstk):
-            stk_list = [stack_params_float[7][i], stack_params_float[8][i], stack_params_float[3][i], stack_params_float[2][i], stack_params_float[4][i], stack_params_float[5][i] ]
-            var_list.extend(stk_list)
-        fmt_str = str(6*numstk)+'f'
-        mt.write_record(self.outfile, endian, fmt_str, *var_list)
+        stk_params = np.stack([np.ma.filled(stack_params_float[k], fill_value=0) for k in (7, 8, 3, 2, 4, 5)], axis=1)
+        mt.write_array_record(self.outfile, endian, '', stk_params.astype('f4').ravel())
+
+        # the same (1, 1, 1, 0., 0.) stack record is written every time step
+        stk_record = mt.pack_array_record(endian, '', stack_time_record(numstk))
+
+        datestimes = self.rt_cfg['run']['datestimes']
+        factors = time_factor_tensor(datestimes, self.time_shifts, self.time_factors,
+                                     self.ts, [int(c) for c in category_ids])
+        time_chunk = self.cfg.postproc.netcdfwriter.time_chunk
+        series = [disaggregate(np.ma.filled(self.infile.variables[specname][:], fill_value=0), factors, time_chunk)
+                  for specname in species]
 
         # time var record
-        for time_idx, stepdt in enumerate(self.rt_cfg['run']['datestimes']):
-            log.debug('Time step ', time_idx, stepdt.replace(tzinfo=None))
-            mt.write_record(self.outfile,
-                            self.cfg.run_params.output_params.endian,
-                            'ifif', self.bdate[time_idx], self.btime[time_idx],
-                            self.bdate[time_idx+1], self.btime[time_idx+1])
-            mt.write_record(self.outfile, endian, 'ii', ione, numstk)
-
-            var_list = []
-            for i in range(numstk):
-                var_list.extend([ione, ione, ione, rdum, rdum])
-
-            fmt_str = numstk*'iiiff'
-            mt.write_record(self.outfile, endian, fmt_str, *var_list)
-
-            for spec_idx, specname in enumerate(species):
-                fmt_str = 'i40s'+str(self.cfg.domain.nx*self.cfg.domain.ny)+'f'
-                # Create a data placeholder with the data from the first
-                # category, then sum for the rest of the categories.
-                # In CAMx, we do not have elevated emissions (3D emissions),
-                # so sum up the vertical column too
-                data = np.zeros((numstk), dtype='f')
-                for ts_id in self.ts:
-                    ts_idx = self.ts_lookup[ts_id]
-                    for cat_idx, (catid, catname) in enumerate(categories):
-                        dtutc = self.time_shifts[(ts_id, stepdt)]
-                        tf = self.time_factors[dtutc]
-                        try:
-                            time_factor = float(tf[catid])
-                        except KeyError:
-                            continue
-
-                        data += self.infile.variables[specname][ts_idx, cat_idx, :].filled(fill_value=0)*time_factor
-
-                fmt_str = 'i40s'+str(numstk)+'f'
-                mt.write_record(self.outfile,
-                                self.cfg.run_params.output_params.endian,
-                                fmt_str, ione,
-                                ''.join(longemisname[spec_idx]).encode('utf-8'),
-                                *data)
+        for start in range(0, len(datestimes), time_chunk):
+            values = [next(s)[1].astype('f4') for s in series]
+            for time_idx in range(start, min(start+time_chunk, len(datestimes))):
+                log.debug('Time step ', time_idx, datestimes[time_idx].replace(tzinfo=None))
+                records = [mt.pack_record(endian, 'ifif', self.bdate[time_idx], self.btime[time_idx],
+                                          self.bdate[time_idx+1], self.btime[time_idx+1]),
+                           mt.pack_record(endian, 'ii', ione, numstk),
+                           stk_record]
+                for spec_idx in range(numspec):
+                    records.append(mt.pack_array_record(endian, 'i40s', values[spec_idx][time_idx-start],
+                                                        ione, ''.join(longemisname[spec_idx]).encode('utf-8')))
+                self.outfile.write(b''.join(records))
@@ -139,7 +139,7 @@ class CMAQAreaTimeWriter(NetCDFAreaTimeDisaggregator):
         self.outfile.UPNAM = '???'
         self.outfile.HISTORY = '???'
 
-        self.outfile.close()
+        self.close_outfile()
 
 
 class CMAQWriter(DataReceiver):
@@ -27,7 +27,10 @@ Copyright 2014-2017 Czech Technical University in Prague, Czech Republic
 
 import importlib
 from lib.ep_libutil import ep_connection, ep_rtcfg
+from postproc.sharding import ShardedReceiver
 from lib.ep_config import ep_cfg
+import lib.ep_logging
+log = lib.ep_logging.Logger(__name__)
 
 def data_provider(name='postproc.emissprovider.EmissProvider'):
     """
@@ -44,17 +47,57 @@ def data_provider(name='postproc.emissprovider.EmissProvider'):
     return dp_instance
 
 
-def run():
+def configured_provider():
     """
-    Main postprocessing dispatcher: run from within workflow.conf
+    Helper function returning the data provider with all the receivers
+    from the postproc.processors configuration registered.
+    With postproc.sharding, shardable receivers are replaced by ShardedReceiver
+    (not with postproc.time_disaggregation = cube, the cube is computed for
+    the whole simulation time).
     """
 
+    sharding = ep_cfg.postproc.sharding
+    if sharding != 'none' and ep_cfg.postproc.time_disaggregation == 'cube':
+        log.warning('Sharding is not supported with the cube time disaggregation, writing single files')
+        sharding = 'none'
+
     dp = data_provider()
     for rec in ep_cfg.postproc.processors:
         mod_name, class_name = rec.rsplit('.', 1)
         mod_obj = importlib.import_module(mod_name)
         class_obj = getattr(mod_obj, class_name)
-        dp.register_receiver(class_obj(cfg=ep_cfg, rt_cfg=ep_rtcfg,
-                                       db=ep_connection))
+        if sharding != 'none' and class_obj.shardable:
+            dp.register_receiver(ShardedReceiver(class_obj, cfg=ep_cfg, rt_cfg=ep_rtcfg,
+                                                 db=ep_connection))
+        else:
+            if sharding != 'none':
+                log.info('Processor', rec, 'does not support sharding, writing a single file')
+            dp.register_receiver(class_obj(cfg=ep_cfg, rt_cfg=ep_rtcfg,
+                                           db=ep_connection))
+
+    return dp
+
+
+def run():
+    """
+    Main postprocessing dispatcher: run from within workflow.conf
+    """
 
+    dp = configured_provider()
     dp.run()
+
+
+def plan():
+    """
+    Print the execution plan of the data packs for the configured processors
+    without running it: can be run from within workflow.conf instead of run
+    """
+
+    dp = configured_provider()
+    stages = dp.execution_plan(parallel=ep_cfg.postproc.parallel_packs > 1)
+    log.info('Postprocessing execution plan ({} stages):'.format(len(stages)))
+    for i, stage in enumerate(stages):
+        log.info('  stage {}: {}'.format(i, ', '.join(
+            '{} -> {}'.format(p, ', '.join(type(r).__name__ for r in dp.receivers[p])) for p in stage)))
+
+    return stages
@@ -1,6 +1,8 @@
 """
 Description: Simple plotter postprocessor
-
+    - plot_context: projection, grid mesh and overlay polygons prepared once for all figures
+    - EmissPlot: rendering of the figures, in the data provider thread or in plotting processes
+    - EmissPlotter, TotalEmissPlotter: the plotting processors
 """
 
 """
@@ -23,6 +25,8 @@ Copyright 2014-2017 Czech Technical University in Prague, Czech Republic
 """
 
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
@@ -38,20 +42,84 @@ _file_resolution = 300
 _cmap = 'hot_r'
 
 
+def plot_context(cfg, rt_cfg, grid_x, grid_y, quicklook=1):
+    """
+    Prepare the projection (basemap), the grid mesh and the overlay polygons
+    for the figures once. The result is a picklable dictionary passed to
+    EmissPlot, possibly in other processes. With quicklook > 1 the mesh
+    is decimated for the data decimated by the function decimate.
+    """
+
+    context = {'basemap': None, 'overlay_polygons': []}
+    if hasattr(cfg.postproc.emissplotter, 'basemap') and cfg.postproc.emissplotter.basemap:
+        pp = rt_cfg['projection_params']
+        from mpl_toolkits.basemap import Basemap
+        if pp['proj'] == 'LAMBERT':
+            m = Basemap(projection='lcc',
+                        resolution=cfg.postproc.emissplotter.basemap_resolution,
+                        lat_0=pp['lat_central'], lon_0=pp['lon_central'],
+                        lat_1=pp['p_alp'], lat_2=pp['p_bet'],
+                        width=cfg.domain.nx*cfg.domain.delx,
+                        height=cfg.domain.ny*cfg.domain.dely)
+
+        context['basemap'] = m
+        context['grid_x'] = grid_x+m.projparams['x_0']
+        context['grid_y'] = grid_y+m.projparams['y_0']
+    else:
+        context['grid_x'] = np.arange(cfg.domain.nx+1)
+        context['grid_y'] = np.arange(cfg.domain.ny+1)
+
+    if quicklook > 1:
+        ex = block_edges(cfg.domain.nx, quicklook)
+        ey = block_edges(cfg.domain.ny, quicklook)
+        if np.ndim(context['grid_x']) == 2:
+            context['grid_x'] = context['grid_x'][np.ix_(ey, ex)]
+            context['grid_y'] = context['grid_y'][np.ix_(ey, ex)]
+        else:
+            context['grid_x'] = context['grid_x'][ex]
+            context['grid_y'] = context['grid_y'][ey]
+
+    try:
+        context['overlay_polygons'] = get_polygons_from_file(cfg.postproc.emissplotter.overlay_polygons)
+    except AttributeError:
+        pass
+    except IOError:
+        log.debug('No such file or directory: ', cfg.postproc.emissplotter.overlay_polygons)
+
+    return context
+
+
+def block_edges(n, factor):
+    """
+    Edges of the blocks of factor grid cells along a grid axis of n cells
+    (the last block may be smaller).
+    """
+
+    return np.append(np.arange(0, n, factor), n)
+
+
+def decimate(data, factor):
+    """
+    Quick-look version of the data [y, x]: blocks of factor x factor grid
+    cells are replaced by their mean value.
+    """
+
+    ny, nx = data.shape
+    ex = block_edges(nx, factor)
+    ey = block_edges(ny, factor)
+    sums = np.add.reduceat(np.add.reduceat(data, ey[:-1], axis=0), ex[:-1], axis=1)
+    return sums / np.outer(np.diff(ey), np.diff(ex))
+
+
 class EmissPlot():
     def __init__(self, cfg, rt_cfg, **kwargs):
         self.cfg = cfg
         self.rt_cfg = rt_cfg
 
         try:
-            self.grid_x = kwargs['grid_x']
-        except KeyError:
-            self.grid_x = None
-
-        try:
-            self.grid_y = kwargs['grid_y']
+            self.context = kwargs['context']
         except KeyError:
-            self.grid_y = None
+            self.context = plot_context(cfg, rt_cfg, kwargs.get('grid_x'), kwargs.get('grid_y'))
 
         self._setup()
 
@@ -76,36 +144,18 @@ class EmissPlot():
 
         self.fig = plt.figure(dpi=self.file_resolution)
         plt.set_cmap(self.cmap)
-        if hasattr(self.cfg.postproc.emissplotter, 'basemap') and self.cfg.postproc.emissplotter.basemap:
-            pp = self.rt_cfg['projection_params']
-            from mpl_toolkits.basemap import Basemap
-            if pp['proj'] == 'LAMBERT':
-                m = Basemap(projection='lcc',
-                            resolution=self.cfg.postproc.emissplotter.basemap_resolution,
-                            lat_0=pp['lat_central'], lon_0=pp['lon_central'],
-                            lat_1=pp['p_alp'], lat_2=pp['p_bet'],
-                            width=self.cfg.domain.nx*self.cfg.domain.delx,
-                            height=self.cfg.domain.ny*self.cfg.domain.dely)
-
+        m = self.context['basemap']
+        if m is not None:
             self.plotter = m
             m.drawcoastlines()
             if self.cfg.postproc.emissplotter.draw_countries:
                 m.drawcountries()
-
-            self.grid_x = self.grid_x+m.projparams['x_0']
-            self.grid_y = self.grid_y+m.projparams['y_0']
         else:
-            self.grid_x = np.arange(self.cfg.domain.nx+1)
-            self.grid_y = np.arange(self.cfg.domain.ny+1)
             self.plotter = plt
 
-        try:
-            self.overlay_polygons = get_polygons_from_file(self.cfg.postproc.emissplotter.overlay_polygons)
-        except AttributeError:
-            self.overlay_polygons = []
-        except IOError:
-            log.debug('No such file or directory: ', self.cfg.postproc.emissplotter.overlay_polygons)
-            self.overlay_polygons = []
+        self.grid_x = self.context['grid_x']
+        self.grid_y = self.context['grid_y']
+        self.overlay_polygons = self.context['overlay_polygons']
 
     def plot(self, data, filename, **kwargs):
         pic = self.plotter.pcolormesh(self.grid_x, self.grid_y, data)
@@ -138,11 +188,32 @@ class EmissPlot():
         pic.remove()
 
 
+# EmissPlot of a plotting process, created by the pool initializer
+_worker_plot = None
+
+
+def _init_plot_worker(cfg, rt_cfg, context):
+    global _worker_plot
+    _worker_plot = EmissPlot(cfg, rt_cfg, context=context)
+
+
+def _plot_figure(data, filename, kwargs):
+    _worker_plot.plot(data, filename, **kwargs)
+    return filename
+
+
 class EmissPlotterBase(DataReceiver):
     """
     Base class for emission plotting classes
     Options (set in config file):
         - postproc.emissplotter.filetype (default png)
+        - postproc.emissplotter.plot_workers (default 0, plot in the data provider thread)
+        - postproc.emissplotter.plot_queue_size (default 8)
+        - postproc.emissplotter.quicklook (default 1, no decimation)
+
+    With plot_workers > 0 the figures are rendered by a pool of processes
+    sharing the plot context prepared once here; at most plot_queue_size
+    figures wait for rendering, then the receiver waits for the oldest one.
     """
 
     def __init__(self, *args, **kwargs):
@@ -152,12 +223,50 @@ class EmissPlotterBase(DataReceiver):
         except AttributeError:
             self.filetype = 'png'
 
+        try:
+            self.plot_workers = self.cfg.postproc.emissplotter.plot_workers
+            self.plot_queue_size = self.cfg.postproc.emissplotter.plot_queue_size
+            self.quicklook = self.cfg.postproc.emissplotter.quicklook
+        except AttributeError:
+            self.plot_workers, self.plot_queue_size, self.quicklook = 0, 8, 1
+
+        self.executor = None
+        self.pending = deque()
+
     def receive_species(self, species):
         self.species = species
 
     def receive_grid(self, grid_x, grid_y):
         self.grid_x, self.grid_y = grid_x, grid_y
-        self.plotter = EmissPlot(self.cfg, self.rt_cfg, grid_x=self.grid_x, grid_y=self.grid_y)
+        context = plot_context(self.cfg, self.rt_cfg, grid_x, grid_y, self.quicklook)
+        if self.plot_workers > 0:
+            self.executor = ProcessPoolExecutor(max_workers=self.plot_workers,
+                                                initializer=_init_plot_worker,
+                                                initargs=(self.cfg, self.rt_cfg, context))
+        else:
+            self.plotter = EmissPlot(self.cfg, self.rt_cfg, context=context)
+
+    def plot(self, data, filename, **kwargs):
+        """
+        Plot the data [y, x] to filename, in a plotting process if configured.
+        """
+
+        if self.quicklook > 1:
+            data = decimate(data, self.quicklook)
+
+        if self.executor is None:
+            self.plotter.plot(data, filename, **kwargs)
+            return
+
+        while len(self.pending) >= self.plot_queue_size:
+            log.debug('Figure', self.pending.popleft().result(), 'plotted')
+        self.pending.append(self.executor.submit(_plot_figure, np.ascontiguousarray(data), filename, kwargs))
+
+    def finalize(self):
+        if self.executor is not None:
+            while self.pending:
+                log.debug('Figure', self.pending.popleft().result(), 'plotted')
+            self.executor.shutdown()
 
 
 class EmissPlotter(EmissPlotterBase):
@@ -182,7 +291,7 @@ class EmissPlotter(EmissPlotterBase):
             specid, specname = spectuple
             title = 'Emissions of {} at {}'.format(specname, time)
             filename = self.filename_pattern.format(species=specname, datetime=time) + '.' + self.filetype
-            self.plotter.plot(data[:, :, 0, s].T, filename, title=title)
+            self.plot(data[:, :, 0, s].T, filename, title=title)
 
     def receive_species(self, species):
         self.species = species
@@ -209,4 +318,4 @@ class TotalEmissPlotter(EmissPlotterBase):
             specid, specname = spectuple
             title = 'Total emissions of {}'.format(specname)
             filename = self.filename_pattern.format(species=specname) + '.' + self.filetype
-            self.plotter.plot(data[:, :, 0, s].T, filename, title=title)
+            self.plot(data[:, :, 0, s].T, filename, title=title)
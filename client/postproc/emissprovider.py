@@ -25,9 +25,15 @@ Copyright 2014-2017 Czech Technical University in Prague, Czech Republic
 
 import numpy as np
 from collections import defaultdict
-from lib.ep_libutil import exec_timer, ep_rtcfg
-from postproc.provider import DataProvider, pack
+from lib.ep_libutil import exec_timer, stage_timer, ep_rtcfg, ep_newconnection
+from postproc.provider import DataProvider, pack, prefetch
 from lib.ep_libutil import combine_2_spec, combine_2_emis, combine_model_emis, combine_model_spec
+from postproc.timedisagg import time_factor_tensor, lookup_index, chunk_columns, disaggregate
+from lib.ep_pgcopy import BinaryCopyReader, copy_query, record_dtype
+from postproc.packcache import PackCache
+import os
+import csv
+import threading
 import lib.ep_logging
 log = lib.ep_logging.Logger(__name__)
 
@@ -45,29 +51,89 @@ class EmissProvider(DataProvider):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.pack_cache_lock = threading.Lock()
+        self.shared_scan_lock = threading.Lock()
 
-    @pack('grid')
-    def get_grid(self):
+    def _cached(self, name, fetch):
         """
-        Fetch grid coordinates from the database and distribute to the receiver objects.
+        Return the data of the metadata pack name from the on-disk pack cache
+        (postproc.emissprovider.metadata_cache directory, one file per case schema)
+        or, if not cached or the cache is disabled, by calling the function fetch.
+
+        The cache is invalidated automatically when the fingerprint of the case
+        data (see _pack_cache_fingerprint) changes.
         """
 
-        cur = self.db.cursor()
-        log.debug('Fetching grid coordinates...')
-        cur.execute('SELECT i, j, xmi, xma, ymi, yma FROM "{}"."{}"'.format(self.cfg.db_connection.conf_schema, self.cfg.domain.grid_name))
+        with self.pack_cache_lock:
+            try:
+                cache = self.pack_cache
+            except AttributeError:
+                cache_dir = self.cfg.postproc.emissprovider.metadata_cache
+                if cache_dir:
+                    filename = os.path.join(cache_dir, self.cfg.db_connection.case_schema + '.packs')
+                    cache = PackCache(filename, self._pack_cache_fingerprint())
+                else:
+                    cache = None
+                self.pack_cache = cache
 
-        grid_x = np.zeros((self.cfg.domain.ny+1, self.cfg.domain.nx+1), dtype='f')
-        grid_y = np.zeros_like(grid_x)
-        for rec in cur:
-            if rec[0] == 1:
-                grid_x[rec[1], 0] = rec[2]
-            if rec[1] == 1:
-                grid_y[0, rec[1]] = rec[4]
+        if cache is None:
+            return fetch()
 
-            grid_x[rec[1], rec[0]] = rec[3]
-            grid_y[rec[1], rec[0]] = rec[5]
+        return cache.get(name, fetch)
 
-        cur.close()
+    def _pack_cache_fingerprint(self):
+        """
+        Fingerprint of the case data the metadata packs are read from:
+        the configuration they depend on and the row counts and maximum ids
+        of the database tables involved.
+        """
+
+        tables = [
+            (self.cfg.db_connection.case_schema, 'ep_sg_emissions_spec', 'sg_id'),
+            (self.cfg.db_connection.case_schema, 'ep_sources_grid', 'sg_id'),
+            (self.cfg.db_connection.case_schema, 'ep_out_species', 'spec_id'),
+            (self.cfg.db_connection.case_schema, 'ep_time_zone_shifts', 'time_out'),
+            (self.cfg.db_connection.case_schema, 'ep_time_factors', 'time_loc'),
+            (self.cfg.db_connection.case_schema, 'ep_mod_spec_factors_all', 'cat_id'),
+            (self.cfg.db_connection.conf_schema, 'ep_emission_categories', 'cat_id'),
+            (self.cfg.db_connection.conf_schema, self.cfg.domain.grid_name, 'grid_id'),
+        ]
+        q = 'SELECT ' + ', '.join('(SELECT array[count(*)::text, max({col})::text] FROM "{schema}"."{table}")'
+                                  .format(schema=schema, table=table, col=col)
+                                  for schema, table, col in tables)
+        log.debug('Computing pack cache fingerprint...', q)
+        with self.db.cursor() as cur:
+            cur.execute(q)
+            counts = cur.fetchone()
+
+        return (self.cfg.db_connection.conf_schema, self.cfg.db_connection.case_schema,
+                self.cfg.domain.grid_name, self.cfg.domain.nx, self.cfg.domain.ny,
+                tuple(tuple(c) for c in counts))
+
+    @pack('grid_geometry')
+    def get_grid_geometry(self):
+        """
+        Distribute the geometry of the case grid (lib.ep_geo_tools.GridGeometry:
+        cell edges and centres in the case projection, lon/lat computed on
+        first use) computed once from the domain configuration.
+        """
+
+        try:
+            self.grid_geometry
+        except AttributeError:
+            from lib.ep_geo_tools import GridGeometry
+            self.grid_geometry = GridGeometry.from_config(self.cfg, self.rt_cfg)
+            self.distribute('grid_geometry', geometry=self.grid_geometry)
+
+    @pack('grid')
+    def get_grid(self):
+        """
+        Distribute the edges of the grid cells as 2D arrays grid_x, grid_y [ny+1, nx+1]
+        to the receiver objects.
+        """
+
+        self.get_grid_geometry()
+        grid_x, grid_y = self.grid_geometry.mesh()
         self.distribute('grid', grid_x, grid_y)
 
     @pack('time_shifts')
@@ -82,14 +148,18 @@ class EmissProvider(DataProvider):
             self.time_shifts
         except AttributeError:  # Read the list from the database is it does not exist
             # get timezone shifts
-            q = 'SELECT ts_id, time_out, time_loc FROM "{}".ep_time_zone_shifts ORDER BY ts_id, time_out'\
-                .format(self.cfg.db_connection.case_schema)
-            log.debug('Getting a list of case timezone shifts...', q)
-            with self.db.cursor() as cur:
-                cur.execute(q)
-                self.time_shifts = {}
-                for row in cur.fetchall():
-                    self.time_shifts[(row[0],row[1])] = row[2]
+            def fetch():
+                q = 'SELECT ts_id, time_out, time_loc FROM "{}".ep_time_zone_shifts ORDER BY ts_id, time_out'\
+                    .format(self.cfg.db_connection.case_schema)
+                log.debug('Getting a list of case timezone shifts...', q)
+                time_shifts = {}
+                with self.db.cursor() as cur:
+                    cur.execute(q)
+                    for row in cur.fetchall():
+                        time_shifts[(row[0],row[1])] = row[2]
+                return time_shifts
+
+            self.time_shifts = self._cached('time_shifts', fetch)
 
             log.debug('Time shifts used in domain were provided.')
 
@@ -168,6 +238,89 @@ class EmissProvider(DataProvider):
         self.distribute('number_volume_sources', nvsrc=nvsrc)
 
 
+    # columns of the emission totals as delivered by the binary COPY transport
+    area_emiss_fields = [('i', 'int4'), ('j', 'int4'), ('k', 'int4'), ('spec', 'int4'),
+                         ('cat', 'int8'), ('ts', 'int4'), ('emiss', 'float8')]
+    point_vsrc_fields = [('i', 'int4'), ('j', 'int4'), ('k', 'int4'), ('spec', 'int4'),
+                         ('cat', 'int8'), ('ts', 'int4'), ('height', 'float8'), ('emiss', 'float8')]
+    point_emiss_fields = [('sg_id', 'int8'), ('spec', 'int4'), ('cat', 'int8'), ('ts', 'int4'),
+                          ('emiss', 'float8')]
+    point_emiss_ij_fields = [('i', 'int4'), ('j', 'int4'), ('spec', 'int4'), ('cat', 'int8'), ('ts', 'int4'),
+                             ('emiss', 'float8')]
+
+    def _fetch_chunks(self, cursor_name, query, fields, callback, db=None):
+        """
+        Run query and pass its result in chunks to the callback function.
+
+        With the default transport (postproc.emissprovider.transport = cursor)
+        the rows are fetched through the named cursor cursor_name in chunks of
+        db_connection.itersize row tuples. With the copy transport the query
+        is run as COPY ... TO STDOUT WITH BINARY and the stream is decoded into
+        NumPy structured arrays with the given fields (list of (name, type)
+        pairs) in chunks of postproc.emissprovider.copy_chunk_size rows.
+        The records of these arrays can be indexed by position like the row
+        tuples, the columns are available by name, e.g. chunk['emiss'].
+        The query runs on the connection db (self.db by default).
+        """
+
+        if db is None:
+            db = self.db
+        cur = db.cursor()
+        if self.cfg.postproc.emissprovider.transport == 'copy':
+            reader = BinaryCopyReader(fields, callback,
+                                      chunksize=self.cfg.postproc.emissprovider.copy_chunk_size)
+            q = copy_query(query, fields)
+            log.debug('Binary COPY:', q)
+            cur.copy_expert(q, reader)
+            reader.close()
+            cur.close()
+            return
+
+        cur.execute('DECLARE {} CURSOR FOR {}'.format(cursor_name, query))
+        cur2 = db.cursor(cursor_name)
+        try:
+            cur2.itersize = int(self.cfg.db_connection.itersize)
+        except AttributeError:
+            pass
+
+        while True:
+            chunk = cur2.fetchmany(cur2.itersize)
+            if not chunk:
+                break
+            callback(chunk)
+
+        cur.close()
+
+    def _area_emissions_by_species_and_category_query(self):
+        """
+        Query of the total area emissions grouped by grid cell, level, species,
+        category and time shift (with the vertical distribution if applied).
+        """
+
+        if self.cfg.run_params.vdistribution_params.apply_vdistribution == False or "vdist" not in ep_rtcfg.keys() or ep_rtcfg["vdist"] != 1:
+            q = 'SELECT g.i, g.j, sg.k, em.spec_id s, em.cat_id c, z.ts_id z, sum(em.emiss) e ' \
+                'FROM "{case_schema}".ep_sg_emissions_spec em ' \
+                'JOIN "{case_schema}".ep_sources_grid sg USING(sg_id) ' \
+                'JOIN "{case_schema}".ep_grid_tz g USING(grid_id) ' \
+                'JOIN "{case_schema}".ep_timezones z USING(tz_id) ' \
+                "WHERE sg.source_type IN ('A', 'L') " \
+                'GROUP BY g.i, g.j, sg.k, em.spec_id, em.cat_id, z.ts_id'.format(
+                    case_schema=self.cfg.db_connection.case_schema)
+        elif self.cfg.run_params.vdistribution_params.apply_vdistribution == True and ep_rtcfg["vdist"] == 1:
+            q = 'SELECT i, j, COALESCE(vdf.level+1, 1) lev, em.spec_id s, em.cat_id c, z.ts_id z, sum(em.emiss * COALESCE(vdf.factor,1)) e ' \
+                'FROM "{case_schema}".ep_sg_emissions_spec em ' \
+                'JOIN "{case_schema}".ep_sources_grid sg USING(sg_id) ' \
+                'JOIN "{case_schema}".ep_grid_tz g USING(grid_id) ' \
+                'JOIN "{case_schema}".ep_timezones z USING(tz_id) ' \
+                'JOIN "{source_schema}".ep_in_sources sources USING(source_id) ' \
+                'JOIN "{source_schema}".ep_emission_sets es USING(eset_id) ' \
+                'LEFT JOIN "{case_schema}".ep_vdistribution_factors_out_all vdf ON vdf.vdistribution_id = ANY(es.vdistribution_id) ' \
+                'AND vdf.cat_id = em.cat_id ' \
+                "WHERE sg.source_type IN ('A', 'L') " \
+                'GROUP BY i,j,lev, em.spec_id, em.cat_id, z.ts_id'.format(case_schema=self.cfg.db_connection.case_schema, source_schema=self.cfg.db_connection.source_schema)
+
+        return q
+
     @pack('area_emiss_by_species_and_category')
     def get_area_emissions_by_species_and_category(self):
         """
@@ -176,48 +329,96 @@ class EmissProvider(DataProvider):
 
         The emissions received are speciated but not time dissagreggated.
         """
+        if self._shared_scan('area_emiss_by_species_and_category'):
+            return
+
         self.get_species()  # Make sure we have the list of species ready first
         self.get_categories()  # Make sure we have the list of categories ready first
         self.get_time_shifts()  # Make sure we have the list of time shifts ready first
-        cur = self.db.cursor()
 
-        if self.cfg.run_params.vdistribution_params.apply_vdistribution == False or "vdist" not in ep_rtcfg.keys() or ep_rtcfg["vdist"] != 1:
-            cur.execute('DECLARE c_area_emiss_by_species_and_category CURSOR FOR '
-                        'SELECT g.i, g.j, sg.k, em.spec_id s, em.cat_id c, z.ts_id z, sum(em.emiss) e '
-                        'FROM "{case_schema}".ep_sg_emissions_spec em '
-                        'JOIN "{case_schema}".ep_sources_grid sg USING(sg_id) '
-                        'JOIN "{case_schema}".ep_grid_tz g USING(grid_id) '
-                        'JOIN "{case_schema}".ep_timezones z USING(tz_id) '
-                        "WHERE sg.source_type IN ('A', 'L') "
-                        'GROUP BY g.i, g.j, sg.k, em.spec_id, em.cat_id, z.ts_id'.format(
-                case_schema=self.cfg.db_connection.case_schema))
-        elif self.cfg.run_params.vdistribution_params.apply_vdistribution == True and ep_rtcfg["vdist"] == 1:
-            cur.execute('DECLARE c_area_emiss_by_species_and_category CURSOR FOR '
-                        'SELECT i, j, COALESCE(vdf.level+1, 1) lev, em.spec_id s, em.cat_id c, z.ts_id z, sum(em.emiss * COALESCE(vdf.factor,1)) e '
-                        'FROM "{case_schema}".ep_sg_emissions_spec em '
-                        'JOIN "{case_schema}".ep_sources_grid sg USING(sg_id) '
-                        'JOIN "{case_schema}".ep_grid_tz g USING(grid_id) '
-                        'JOIN "{case_schema}".ep_timezones z USING(tz_id) '
-                        'JOIN "{source_schema}".ep_in_sources sources USING(source_id) '
-                        'JOIN "{source_schema}".ep_emission_sets es USING(eset_id) '
-                        'LEFT JOIN "{case_schema}".ep_vdistribution_factors_out_all vdf ON vdf.vdistribution_id = ANY(es.vdistribution_id) '
-                        'AND vdf.cat_id = em.cat_id '
-                        "WHERE sg.source_type IN ('A', 'L') "
-                        'GROUP BY i,j,lev, em.spec_id, em.cat_id, z.ts_id'.format(case_schema=self.cfg.db_connection.case_schema, source_schema=self.cfg.db_connection.source_schema))
-        cur2 = self.db.cursor('c_area_emiss_by_species_and_category')
-        try:
-            cur2.itersize = int(self.cfg.db_connection.itersize)
-        except AttributeError:
-            pass
+        q = self._area_emissions_by_species_and_category_query()
+        self._fetch_chunks('c_area_emiss_by_species_and_category', q, self.area_emiss_fields,
+                           lambda chunk: self.distribute('area_emiss_by_species_and_category', data=chunk))
 
-        while True:
-            chunk = cur2.fetchmany(cur2.itersize)
-            if not chunk:
-                break
+    @pack('area_emiss_cube')
+    def get_area_emission_cube(self):
+        """
+        Compute the time disaggregated area emissions once for all the time
+        writers (postproc.time_disaggregation = cube, otherwise the pack is empty
+        and the writers read the total file instead).
+
+        The speciated totals (the data of the area_emiss_by_species_and_category
+        pack) are fetched into a dense [species, ts, cat, nz, ny, nx] array and
+        multiplied by the [time, ts, cat] time factors. For each chunk of
+        postproc.netcdfwriter.time_chunk output times and for each species
+        (in this order) the receivers get spec_idx (index in the species pack),
+        start (index of the first time step of the chunk) and data, the emissions
+        [time, nz, ny, nx] of the chunk.
+        """
 
-            self.distribute('area_emiss_by_species_and_category', data=chunk)
+        if self.cfg.postproc.time_disaggregation != 'cube':
+            return
 
-        cur.close()
+        if self._shared_scan('area_emiss_cube'):
+            return
+
+        self.get_species()
+        self.get_categories()
+        self.get_time_shifts()
+        self.get_time_factors()
+
+        log.debug('Fetching area emission totals for the time disaggregation...')
+        self._fetch_chunks('c_area_emiss_cube', self._area_emissions_by_species_and_category_query(),
+                           self.area_emiss_fields, self._area_cube_accumulator())
+        self._distribute_area_cube()
+
+    def _area_cube_accumulator(self):
+        """
+        Create the dense array of the area emission totals [species, ts, cat, nz, ny, nx]
+        (self.area_cube_totals) and return the function adding a chunk of the totals
+        (rows of the area_emiss_by_species_and_category pack) to it.
+        """
+
+        nx, ny, nz = self.cfg.domain.nx, self.cfg.domain.ny, self.cfg.domain.nz
+        ts_ids = list(dict.fromkeys(ts_id for ts_id, time_out in self.time_shifts))
+        cat_ids = [c[0] for c in self.categories]
+        spec_ids = [s[0] for s in self.species]
+        totals = np.zeros((len(spec_ids), len(ts_ids), len(cat_ids), nz, ny, nx), dtype='f4')
+        self.area_cube_totals = totals
+
+        def accumulate(chunk):
+            i, j, k, spec, cat, ts, emiss = chunk_columns(chunk, 7)
+            spec_idx, spec_found = lookup_index(spec_ids, spec)
+            cat_idx, cat_found = lookup_index(cat_ids, cat)
+            ts_idx, ts_found = lookup_index(ts_ids, ts)
+            found = spec_found & cat_found & ts_found
+            if not found.all():
+                log.warning('Skipping', np.count_nonzero(~found), 'rows with unknown species, category or time shift')
+            # huge and missing emissions are treated as zero, as in the total file
+            emiss = np.where(emiss < 1e+36, emiss, 0)
+            idx = (spec_idx, ts_idx, cat_idx, k.astype('i8')-1, j.astype('i8')-1, i.astype('i8')-1)
+            np.add.at(totals, tuple(a[found] for a in idx), emiss[found])
+
+        return accumulate
+
+    def _distribute_area_cube(self):
+        """
+        Multiply the accumulated totals (see _area_cube_accumulator) by the time
+        factors and distribute the area_emiss_cube pack chunk by chunk.
+        """
+
+        ts_ids = list(dict.fromkeys(ts_id for ts_id, time_out in self.time_shifts))
+        cat_ids = [c[0] for c in self.categories]
+        totals = self.area_cube_totals
+        datestimes = self.rt_cfg['run']['datestimes']
+        factors = time_factor_tensor(datestimes, self.time_shifts, self.time_factors, ts_ids, cat_ids)
+        time_chunk = self.cfg.postproc.netcdfwriter.time_chunk
+        series = [disaggregate(totals[s], factors, time_chunk) for s in range(totals.shape[0])]
+        for start in range(0, len(datestimes), time_chunk):
+            log.debug('Distributing time disaggregated area emissions from time step', start)
+            for spec_idx, s in enumerate(series):
+                self.distribute('area_emiss_cube', spec_idx=spec_idx, start=start, data=next(s)[1])
+        del self.area_cube_totals
 
 
     @pack('area_emiss_by_species_category_and_level')
@@ -229,40 +430,24 @@ class EmissProvider(DataProvider):
         The emissions received are speciated but not time dissagreggated.
         """
 
+        if self._shared_scan('area_emiss_by_species_category_and_level'):
+            return
+
         self.get_species()  # Make sure we have the list of species ready first
         self.get_categories()  # Make sure we have the list of categories ready first
         self.get_time_shifts()  # Make sure we have the list of time shifts ready first
-        cur = self.db.cursor()
-
-        q = 'DECLARE c_area_emiss_by_species_category_and_level CURSOR FOR ' + \
-                    'SELECT g.i, g.j, coalesce(chl.vertical_level, -1) AS level, em.spec_id s, em.cat_id c, z.ts_id z, sum(em.emiss) e ' + \
+        q = 'SELECT g.i, g.j, coalesce(chl.vertical_level, -1) AS level, em.spec_id s, em.cat_id c, z.ts_id z, sum(em.emiss) e ' + \
                     'FROM "{case_schema}".ep_sg_emissions_spec em ' + \
                     'JOIN "{case_schema}".ep_sources_grid sg USING(sg_id) ' + \
                     'JOIN "{case_schema}".ep_grid_tz g USING(grid_id) ' + \
                     'JOIN "{case_schema}".ep_timezones z USING(tz_id) ' + \
                     'LEFT OUTER JOIN "{case_schema}".ep_transformation_chains_levels chl ON sg.transformation_chain=chl.chain_id ' + \
                     "WHERE sg.source_type IN ('A', 'L') " + \
-                    'GROUP BY g.i, g.j, level, em.spec_id, em.cat_id, z.ts_id ' + \
-                    'ORDER BY g.i, g.j, level, em.spec_id, em.cat_id, z.ts_id '
+                    'GROUP BY g.i, g.j, level, em.spec_id, em.cat_id, z.ts_id '
         q = q.format(case_schema=self.cfg.db_connection.case_schema)
         log.debug('get_area_emissions_by_species_category_and_level:', q)
-        cur.execute(q)
-        try:
-            cur2 = self.db.cursor('c_area_emiss_by_species_category_and_level')
-        except Exception as e:
-            log.debug('cur2 create:', e)
-        try:
-            cur2.itersize = int(self.cfg.db_connection.itersize)
-        except AttributeError:
-            pass
-
-        while True:
-            chunk = cur2.fetchmany(cur2.itersize)
-            if not chunk:
-                break
-            self.distribute('area_emiss_by_species_category_and_level', data=chunk)
-
-        cur.close()
+        self._fetch_chunks('c_area_emiss_by_species_category_and_level', q, self.area_emiss_fields,
+                           lambda chunk: self.distribute('area_emiss_by_species_category_and_level', data=chunk))
 
 
     @pack('point_vsrc_by_species_category_and_level')
@@ -274,14 +459,15 @@ class EmissProvider(DataProvider):
         The emissions received are speciated but not time dissagreggated.
         """
 
+        if self._shared_scan('point_vsrc_by_species_category_and_level'):
+            return
+
         self.get_species()  # Make sure we have the list of species ready first
         self.get_categories()  # Make sure we have the list of categories ready first
         self.get_time_shifts()  # Make sure we have the list of time shifts ready first
         self.get_emission_levels() # Make sure we have the list of emission levels ready first
 
-        cur = self.db.cursor()
-        q = 'DECLARE c_point_vsrc_by_species_category_and_level CURSOR FOR ' + \
-                    'SELECT g.i, g.j, chl.vertical_level AS level, em.spec_id s, em.cat_id c, z.ts_id z, ' + \
+        q = 'SELECT g.i, g.j, chl.vertical_level AS level, em.spec_id s, em.cat_id c, z.ts_id z, ' + \
                     'coalesce(ps.height, 0) as h, sum(em.emiss) e ' + \
                     'FROM "{case_schema}".ep_sg_emissions_spec em ' + \
                     'JOIN "{case_schema}".ep_sources_grid sg USING(sg_id) ' + \
@@ -291,27 +477,11 @@ class EmissProvider(DataProvider):
                     '  ON sg.transformation_chain=chl.chain_id ' + \
                     'LEFT OUTER JOIN "{source_schema}".ep_in_sources_point ps USING (source_id) ' + \
                     "WHERE sg.source_type = 'P' " + \
-                    'GROUP BY g.i, g.j, level, em.spec_id, em.cat_id, z.ts_id, h ' + \
-                    'ORDER BY g.i, g.j, level, em.spec_id, em.cat_id, z.ts_id, h '
+                    'GROUP BY g.i, g.j, level, em.spec_id, em.cat_id, z.ts_id, h '
         q = q.format(case_schema=self.cfg.db_connection.case_schema, source_schema=self.cfg.db_connection.source_schema)
         log.debug('get_point_vsrc_emissions_by_species_category_and_level:', q)
-        cur.execute(q)
-        try:
-            cur2 = self.db.cursor('c_point_vsrc_by_species_category_and_level')
-        except Exception as e:
-            log.debug('cur2 create:', e)
-        try:
-            cur2.itersize = int(self.cfg.db_connection.itersize)
-        except AttributeError:
-            pass
-
-        while True:
-            chunk = cur2.fetchmany(cur2.itersize)
-            if not chunk:
-                break
-            self.distribute('point_vsrc_by_species_category_and_level', data=chunk)
-
-        cur.close()
+        self._fetch_chunks('c_point_vsrc_by_species_category_and_level', q, self.point_vsrc_fields,
+                           lambda chunk: self.distribute('point_vsrc_by_species_category_and_level', data=chunk))
 
 
     @pack('point_emiss_by_species_and_category')
@@ -323,34 +493,29 @@ class EmissProvider(DataProvider):
         The emissions received are speciated but not time dissagreggated.
         """
 
+        if self._shared_scan('point_emiss_by_species_and_category'):
+            return
+
         self.get_point_species()  # Make sure we have the list of species ready first
         self.get_point_categories()  # Make sure we have the list of categories ready first
         self.get_time_shifts()  # Make sure we have the list of time shifts ready first
-        cur = self.db.cursor()
-
-        cur.execute('DECLARE c_point_emiss_by_species_and_category CURSOR FOR '
-                    'SELECT em.sg_id, em.spec_id s, em.cat_id c, z.ts_id z, sum(em.emiss) e '
-                    'FROM "{case_schema}".ep_sg_emissions_spec em '
-                    'JOIN "{case_schema}".ep_sources_grid sg USING(sg_id) '
-                    'JOIN "{case_schema}".ep_grid_tz g USING(grid_id) '
-                    'JOIN "{case_schema}".ep_timezones z USING(tz_id) '
-                    "WHERE sg.source_type IN ('P') "
-                    'GROUP BY em.sg_id, em.spec_id, em.cat_id, z.ts_id'.format(case_schema=self.cfg.db_connection.case_schema))
-
-        cur2 = self.db.cursor('c_point_emiss_by_species_and_category')
-        try:
-            cur2.itersize = int(self.cfg.db_connection.itersize)
-        except AttributeError:
-            pass
+        q = self._point_emissions_by_species_and_category_query()
 
-        while True:
-            chunk = cur2.fetchmany(cur2.itersize)
-            if not chunk:
-                break
+        self._fetch_chunks('c_point_emiss_by_species_and_category', q, self.point_emiss_fields,
+                           lambda chunk: self.distribute('point_emiss_by_species_and_category', data=chunk))
 
-            self.distribute('point_emiss_by_species_and_category', data=chunk)
+    def _point_emissions_by_species_and_category_query(self):
+        """
+        Query of the total point emissions grouped by source, species, category and time shift.
+        """
 
-        cur.close()
+        return 'SELECT em.sg_id, em.spec_id s, em.cat_id c, z.ts_id z, sum(em.emiss) e ' \
+               'FROM "{case_schema}".ep_sg_emissions_spec em ' \
+               'JOIN "{case_schema}".ep_sources_grid sg USING(sg_id) ' \
+               'JOIN "{case_schema}".ep_grid_tz g USING(grid_id) ' \
+               'JOIN "{case_schema}".ep_timezones z USING(tz_id) ' \
+               "WHERE sg.source_type IN ('P') " \
+               'GROUP BY em.sg_id, em.spec_id, em.cat_id, z.ts_id'.format(case_schema=self.cfg.db_connection.case_schema)
 
     @pack('point_emiss_by_species_and_category_ij')
     def get_point_emissions_by_species_and_category_ij(self):
@@ -364,48 +529,267 @@ class EmissProvider(DataProvider):
         self.get_point_species()  # Make sure we have the list of species ready first
         self.get_point_categories()  # Make sure we have the list of categories ready first
         self.get_time_shifts()  # Make sure we have the list of time shifts ready first
-        cur = self.db.cursor()
+        q = 'SELECT em.sg_id, em.spec_id s, em.cat_id c, z.ts_id z, sum(em.emiss) e ' \
+            'FROM "{case_schema}".ep_sg_emissions_spec em ' \
+            'JOIN "{case_schema}".ep_sources_grid sg USING(sg_id) ' \
+            'JOIN "{case_schema}".ep_grid_tz g USING(grid_id) ' \
+            'JOIN "{case_schema}".ep_timezones z USING(tz_id) ' \
+            "WHERE sg.source_type IN ('P') " \
+            'GROUP BY em.sg_id, em.spec_id, em.cat_id, z.ts_id'.format(case_schema=self.cfg.db_connection.case_schema)
+
+        self._fetch_chunks('c_point_emiss_by_species_and_category', q, self.point_emiss_fields,
+                           lambda chunk: self.distribute('point_emiss_by_species_and_category', data=chunk))
+
+    # columns of the shared scan query (see _shared_scan): tag of the branch,
+    # the union of the columns of the total packs (i holds sg_id for the point totals)
+    shared_scan_fields = [('pack', 'int4'), ('i', 'int8'), ('j', 'int4'), ('k', 'int4'), ('spec', 'int4'),
+                          ('cat', 'int8'), ('ts', 'int4'), ('height', 'float8'), ('emiss', 'float8')]
+
+    # branches of the shared scan query: tag, source types and the aggregation
+    # of the pre-joined emissions (relation base) into shared_scan_fields
+    shared_scan_branches = {
+        'area': (0, ('A', 'L'),
+                 'SELECT 0, i, j, k, spec, cat, ts, 0, sum(emiss) FROM base '
+                 "WHERE st IN ('A', 'L') "
+                 'GROUP BY i, j, k, spec, cat, ts'),
+        'area_level': (1, ('A', 'L'),
+                       'SELECT 1, b.i, b.j, coalesce(chl.vertical_level, -1) AS level, b.spec, b.cat, b.ts, 0, '
+                       'sum(b.emiss) FROM base b '
+                       'LEFT OUTER JOIN "{case_schema}".ep_transformation_chains_levels chl ON b.chain=chl.chain_id '
+                       "WHERE b.st IN ('A', 'L') "
+                       'GROUP BY b.i, b.j, level, b.spec, b.cat, b.ts'),
+        'point_vsrc': (2, ('P', ),
+                       'SELECT 2, b.i, b.j, chl.vertical_level AS level, b.spec, b.cat, b.ts, '
+                       'coalesce(ps.height, 0) AS h, sum(b.emiss) FROM base b '
+                       'JOIN "{case_schema}".ep_transformation_chains_levels chl ON b.chain=chl.chain_id '
+                       'LEFT OUTER JOIN "{source_schema}".ep_in_sources_point ps USING (source_id) '
+                       "WHERE b.st = 'P' "
+                       'GROUP BY b.i, b.j, level, b.spec, b.cat, b.ts, h'),
+        'point': (3, ('P', ),
+                  'SELECT 3, sg_id, 0, 0, spec, cat, ts, 0, sum(emiss) FROM base '
+                  "WHERE st = 'P' "
+                  'GROUP BY sg_id, spec, cat, ts'),
+    }
+
+    # total packs which can be delivered by the shared scan: branch, fields of the pack
+    # and the columns of shared_scan_fields they are taken from
+    shared_scan_packs = {
+        'area_emiss_by_species_and_category':
+            ('area', area_emiss_fields, ('i', 'j', 'k', 'spec', 'cat', 'ts', 'emiss')),
+        'area_emiss_cube':
+            ('area', area_emiss_fields, ('i', 'j', 'k', 'spec', 'cat', 'ts', 'emiss')),
+        'area_emiss_by_species_category_and_level':
+            ('area_level', area_emiss_fields, ('i', 'j', 'k', 'spec', 'cat', 'ts', 'emiss')),
+        'point_vsrc_by_species_category_and_level':
+            ('point_vsrc', point_vsrc_fields, ('i', 'j', 'k', 'spec', 'cat', 'ts', 'height', 'emiss')),
+        'point_emiss_by_species_and_category':
+            ('point', point_emiss_fields, ('i', 'spec', 'cat', 'ts', 'emiss')),
+    }
+
+    def _shared_scan_plan(self):
+        """
+        List of the total packs delivered by the shared scan (postproc.emissprovider.shared_scan)
+        in the order of the execution plan, empty if the shared scan is off or would serve
+        less than two packs.
+
+        The packs with registered receivers from shared_scan_packs are included, except
+        the packs required by other packs and the packs requiring another total pack,
+        because the rows of the packs come from the shared scan interleaved. The area totals
+        with the vertical distribution applied are always fetched by their own query.
+        """
 
-        cur.execute('DECLARE c_point_emiss_by_species_and_category CURSOR FOR '
-                    'SELECT em.sg_id, em.spec_id s, em.cat_id c, z.ts_id z, sum(em.emiss) e '
-                    'FROM "{case_schema}".ep_sg_emissions_spec em '
-                    'JOIN "{case_schema}".ep_sources_grid sg USING(sg_id) '
-                    'JOIN "{case_schema}".ep_grid_tz g USING(grid_id) '
-                    'JOIN "{case_schema}".ep_timezones z USING(tz_id) '
-                    "WHERE sg.source_type IN ('P') "
-                    'GROUP BY em.sg_id, em.spec_id, em.cat_id, z.ts_id'.format(case_schema=self.cfg.db_connection.case_schema))
+        with self.shared_scan_lock:
+            try:
+                return self.shared_scan_plan
+            except AttributeError:
+                pass
+
+            packs = []
+            if self.cfg.postproc.emissprovider.shared_scan:
+                excluded = set()
+                if self.cfg.postproc.time_disaggregation != 'cube':
+                    excluded.add('area_emiss_cube')
+                if self.cfg.run_params.vdistribution_params.apply_vdistribution and ep_rtcfg.get('vdist') == 1:
+                    excluded.update(('area_emiss_by_species_and_category', 'area_emiss_cube'))
+
+                plan = self.execution_plan(parallel=self.cfg.postproc.parallel_packs > 1)
+                order = [p for stage in plan for p in stage]
+                required = set(d for p in order for d in self.pack_dependencies(p))
+                packs = [p for p in order if p in self.shared_scan_packs and p not in excluded
+                         and p not in required
+                         and not set(self.shared_scan_packs).intersection(self.pack_dependencies(p))]
+                if len(packs) < 2:
+                    packs = []
+                log.debug('Packs of the shared scan:', packs)
+
+            self.shared_scan_plan = packs
+            return packs
+
+    def _shared_scan(self, pack):
+        """
+        Return True if the data of the total pack are delivered by the shared scan
+        (see _shared_scan_plan), False if the pack hook has to fetch them itself.
 
-        cur2 = self.db.cursor('c_point_emiss_by_species_and_category')
-        try:
-            cur2.itersize = int(self.cfg.db_connection.itersize)
-        except AttributeError:
-            pass
+        The shared scan runs in the hook of the last of its packs in the execution
+        plan, so that the packs required by the receivers of all of them have already
+        been distributed. The hooks of the other packs return without any data.
+        """
 
-        while True:
-            chunk = cur2.fetchmany(cur2.itersize)
-            if not chunk:
-                break
+        packs = self._shared_scan_plan()
+        if pack not in packs:
+            return False
 
-            self.distribute('point_emiss_by_species_and_category', data=chunk)
+        if pack == packs[-1]:
+            self._run_shared_scan(packs)
+        return True
 
-        cur.close()
+    def _shared_scan_query(self, packs):
+        """
+        Query computing the totals of all the given packs with a single scan
+        of the emissions: the join of ep_sg_emissions_spec, ep_sources_grid,
+        ep_grid_tz and ep_timezones is computed once as a common table expression
+        and aggregated by each branch of the UNION ALL. The result is not ordered.
+        """
 
+        branches = list(dict.fromkeys(self.shared_scan_packs[p][0] for p in packs))
+        source_types = sorted(set(t for b in branches for t in self.shared_scan_branches[b][1]))
+        q = 'WITH base AS (' \
+            'SELECT sg.source_type st, em.sg_id, sg.source_id, sg.transformation_chain chain, ' \
+            'g.i, g.j, sg.k, em.spec_id spec, em.cat_id cat, z.ts_id ts, em.emiss ' \
+            'FROM "{case_schema}".ep_sg_emissions_spec em ' \
+            'JOIN "{case_schema}".ep_sources_grid sg USING(sg_id) ' \
+            'JOIN "{case_schema}".ep_grid_tz g USING(grid_id) ' \
+            'JOIN "{case_schema}".ep_timezones z USING(tz_id) ' \
+            'WHERE sg.source_type IN ({source_types})) ' + \
+            ' UNION ALL '.join(self.shared_scan_branches[b][2] for b in branches)
+        return q.format(case_schema=self.cfg.db_connection.case_schema,
+                        source_schema=self.cfg.db_connection.source_schema,
+                        source_types=', '.join("'{}'".format(t) for t in source_types))
+
+    def _run_shared_scan(self, packs):
+        """
+        Run the shared scan query and route the rows of each chunk to the packs
+        by the tag of their branch, in the layout of the own query of the pack
+        (row tuples or NumPy structured arrays according to the transport).
+        """
 
+        self.get_species()
+        self.get_categories()
+        self.get_time_shifts()
+        if 'point_emiss_by_species_and_category' in packs:
+            self.get_point_species()
+            self.get_point_categories()
+        if 'point_vsrc_by_species_category_and_level' in packs:
+            self.get_emission_levels()
+        if 'area_emiss_cube' in packs:
+            self.get_time_factors()
+
+        names = [name for name, pg_type in self.shared_scan_fields]
+        routes = []
+        for p in packs:
+            branch, fields, columns = self.shared_scan_packs[p]
+            if p == 'area_emiss_cube':
+                consumer = self._area_cube_accumulator()
+            else:
+                consumer = lambda chunk, p=p: self.distribute(p, data=chunk)
+            routes.append((self.shared_scan_branches[branch][0], record_dtype(fields), columns,
+                           [names.index(c) for c in columns], consumer))
+
+        def route(chunk):
+            if isinstance(chunk, np.ndarray):
+                for tag, dtype, columns, positions, consumer in routes:
+                    rows = chunk[chunk['pack'] == tag]
+                    if len(rows):
+                        data = np.empty(len(rows), dtype=dtype)
+                        for name, c in zip(dtype.names, columns):
+                            data[name] = rows[c]
+                        consumer(data)
+            else:
+                for tag, dtype, columns, positions, consumer in routes:
+                    data = [tuple(row[c] for c in positions) for row in chunk if row[0] == tag]
+                    if data:
+                        consumer(data)
+
+        q = self._shared_scan_query(packs)
+        log.debug('Shared scan of the emission totals for', packs, ':', q)
+        self._fetch_chunks('c_shared_scan', q, self.shared_scan_fields, route)
+
+        if 'area_emiss_cube' in packs:
+            self._distribute_area_cube()
 
     @pack('area_emiss')
     def get_area_emission_time_series(self):
         """
         Fetch area emission data from the database and distribute to the receiver objects.
 
-        For all time steps (as set up in the run configuration) call the ep_emiss_time_series
-        function. A 4D matrix is received with dimensions [nx, ny, nz, nspec] where nspec is
-        the number of output species and nx, ny, nz are domain dimensions.
+        For all time steps (as set up in the run configuration) a 4D matrix is distributed
+        with dimensions [nx, ny, nz, nspec] where nspec is the number of output species
+        and nx, ny, nz are domain dimensions. The matrices are computed according to
+        postproc.emissprovider.time_series_mode:
+            sql  - call the ep_emiss_time_series database function for each time step
+            bulk - fetch the speciated totals and time factors once and compute
+                   the time steps with NumPy (see _area_emission_time_series_bulk)
 
         Uses the self.species list read by the get_species method.
         """
 
         self.get_species() # Make sure we have the list of species ready first
-        cur = self.db.cursor()
+        if self.cfg.postproc.emissprovider.time_series_mode == 'bulk':
+            self.get_time_shifts()
+            self.get_time_factors()
+            time_series = self._area_emission_time_series_bulk
+        else:
+            time_series = self._area_emission_time_series_sql
+
+        # combine area species with other model species
+        ep_species_names = [s[1] for s in self.ep_species]
+        timer = stage_timer('area_emiss')
+        for i, ep_emis in enumerate(self._time_series(time_series, timer)):
+            with timer.stage('combine'):
+                if len(ep_species_names) == 0:
+                    log.fmt_debug('WARNING: no emissions computed internally with FUME for timestep {}. It will continue anyway trying to collect emissions from external models.', i)
+                    emis, sp = combine_model_emis(ep_emis, ep_species_names ,i, noanthrop = True)
+                else:
+                    emis, sp = combine_model_emis(ep_emis, ep_species_names ,i )
+            with timer.stage('distribute'):
+                self.distribute('area_emiss', timestep=i, data=emis)
+        timer.print_split()
+
+    def _time_series(self, time_series, timer):
+        """
+        Generator of the time steps produced by the generator function time_series(db).
+
+        If postproc.emissprovider.prefetch is positive, the time steps are computed
+        in a background thread with a dedicated database connection, at most
+        prefetch time steps ahead of the consumer. Pending changes of the main
+        connection are committed first to make them visible to that connection.
+
+        The time spent computing the time steps is accounted to the stage 'fetch'
+        of timer, in the prefetch mode the time the consumer waits for them
+        to the stage 'wait'.
+        """
+
+        depth = self.cfg.postproc.emissprovider.prefetch
+        if depth == 0:
+            yield from timer.iterate(time_series(self.db), 'fetch')
+            return
+
+        log.debug('Prefetching', depth, 'time steps with a dedicated connection')
+        self.db.commit()
+        db = ep_newconnection()
+        try:
+            yield from timer.iterate(prefetch(timer.iterate(time_series(db), 'fetch'), depth), 'wait')
+            db.commit()
+        finally:
+            db.close()
+
+    def _area_emission_time_series_sql(self, db):
+        """
+        Generator of area emission matrices calling the ep_emiss_time_series
+        database function for each time step.
+        """
+
+        cur = db.cursor()
         for i in range(self.cfg.run_params.time_params.num_time_int):
             q = 'SELECT ep_emiss_time_series(%s,%s,%s,%s,%s,%s::text,%s)'
             log.debug('Fetching area emissions for timestep', i)
@@ -414,18 +798,230 @@ class EmissProvider(DataProvider):
                             self.cfg.db_connection.case_schema,
                             self.cfg.run_params.output_params.save_time_series_to_db))
 
-            ep_emis = np.array(cur.fetchone()[0])
-            # combine area species with other model species
-            ep_species_names = [s[1] for s in self.ep_species]
-            if len(ep_species_names) == 0:
-                log.fmt_debug('WARNING: no emissions computed internally with FUME for timestep {}. It will continue anyway trying to collect emissions from external models.', i)
-                emis, sp = combine_model_emis(ep_emis, ep_species_names ,i, noanthrop = True)
-            else:
-                emis, sp = combine_model_emis(ep_emis, ep_species_names ,i )
-            self.distribute('area_emiss', timestep=i, data=emis)
+            yield np.array(cur.fetchone()[0])
+
+        cur.close()
+
+    def _area_emission_time_series_bulk(self, db):
+        """
+        Generator of area emission matrices computed on the client side.
+
+        The speciated area emission totals grouped by (i, j, k, spec, cat, ts) are
+        fetched once, together with the time shifts and time factors. Every time
+        step is then obtained as a weighted bincount of the totals into the flattened
+        [nx, ny, nz, nspec] matrix, the weights being the time factors of the category
+        and time shift of each row. The result equals the one of ep_emiss_time_series.
+        Requires the time_shifts and time_factors packs to be read before.
+        """
+
+        nx, ny, nz = self.cfg.domain.nx, self.cfg.domain.ny, self.cfg.domain.nz
+        spec_ids = [int(s[0]) for s in self.ep_species]
+        nspec = len(spec_ids)
+
+        i, j, k, spec, cat, ts, emiss = self._fetch_area_emission_totals(db)
+
+        # the database function ignores species not in the output species list
+        spec_idx, found = lookup_index(spec_ids, spec)
+        i, j, k, spec_idx, cat, ts, emiss = (a[found] for a in (i, j, k, spec_idx, cat, ts, emiss))
+        flat_idx = np.ravel_multi_index((i-1, j-1, k-1, spec_idx), (nx, ny, nz, nspec))
+
+        cur = db.cursor()
+        for t, emis in enumerate(self._bulk_time_steps(flat_idx, cat, ts, emiss, (nx, ny, nz, nspec))):
+            log.debug('Computed area emissions for timestep', t)
+            if self.cfg.run_params.output_params.save_time_series_to_db:
+                cur.execute('INSERT INTO "{}".ep_out_emissions_array (time_out, emissions) VALUES (%s, %s)'
+                            .format(self.cfg.db_connection.case_schema),
+                            (self.rt_cfg['run']['datestimes'][t], emis.tolist()))
+            yield emis
 
         cur.close()
 
+    def _bulk_time_steps(self, flat_idx, cat, ts, emiss, shape):
+        """
+        Generator of the time steps of the emission matrices of the given shape
+        computed from the totals emiss of category cat and time shift ts, each
+        added to the position flat_idx of the flattened matrix weighted by the
+        time factor of its category and time shift.
+        Requires the time_shifts and time_factors packs to be read before.
+        """
+
+        cat_ids, cat_idx = np.unique(cat, return_inverse=True)
+        ts_ids, ts_idx = np.unique(ts, return_inverse=True)
+        factor_idx = ts_idx*len(cat_ids) + cat_idx
+        factors = time_factor_tensor(self.rt_cfg['run']['datestimes'], self.time_shifts,
+                                     self.time_factors, ts_ids, cat_ids)
+        factors = factors.reshape(factors.shape[0], -1)
+
+        size = int(np.prod(shape))
+        for t in range(self.cfg.run_params.time_params.num_time_int):
+            yield np.bincount(flat_idx, weights=emiss*factors[t, factor_idx], minlength=size).reshape(shape)
+
+    def _fetch_columns(self, cursor_name, query, fields, db):
+        """
+        Fetch the result of query with the columns given by fields (see
+        _fetch_chunks) as a tuple of NumPy arrays, one for each column.
+        """
+
+        chunks = []
+        self._fetch_chunks(cursor_name, query, fields, chunks.append, db=db)
+
+        if chunks and isinstance(chunks[0], np.ndarray):
+            # structured arrays of the binary COPY transport
+            rows = np.concatenate(chunks)
+            return tuple(rows[name] for name, pg_type in fields)
+
+        rows = np.array([row for chunk in chunks for row in chunk], dtype='f8').reshape((-1, len(fields)))
+        return tuple(rows[:, c].astype('i8') if pg_type.startswith('int') else rows[:, c]
+                     for c, (name, pg_type) in enumerate(fields))
+
+    def _fetch_area_emission_totals(self, db, condition=None):
+        """
+        Fetch speciated area emission totals grouped by grid cell, level, species,
+        category and time shift, optionally only of the grid cells matching the SQL
+        condition on the columns g.i, g.j. Returns a tuple of NumPy arrays
+        (i, j, k, spec, cat, ts, emiss).
+        """
+
+        q = 'SELECT g.i, g.j, sg.k, em.spec_id s, em.cat_id c, z.ts_id z, sum(em.emiss) e ' \
+            'FROM "{case_schema}".ep_sg_emissions_spec em ' \
+            'JOIN "{case_schema}".ep_sources_grid sg USING(sg_id) ' \
+            'JOIN "{case_schema}".ep_grid_tz g USING(grid_id) ' \
+            'JOIN "{case_schema}".ep_timezones z USING(tz_id) ' \
+            "WHERE sg.source_type IN ('A', 'L') {condition}" \
+            'GROUP BY g.i, g.j, sg.k, em.spec_id, em.cat_id, z.ts_id'.format(
+                case_schema=self.cfg.db_connection.case_schema,
+                condition='AND {} '.format(condition) if condition else '')
+
+        log.debug('Fetching area emission totals...', q)
+        return self._fetch_columns('c_area_emiss_totals', q, self.area_emiss_fields, db)
+
+    @pack('receptor_points')
+    def get_receptor_points(self):
+        """
+        Read the receptor points (e.g. monitoring stations) from the CSV file
+        postproc.extraction.points with the columns name, lon, lat (with a header
+        line) and distribute them as the list of (name, lon, lat, i, j) tuples,
+        i, j being the indices (starting from 1) of the grid cell containing
+        the point. Points outside the domain are left out.
+        """
+
+        try:
+            self.receptor_points
+        except AttributeError:
+            self.get_grid_geometry()
+            filename = self.cfg.postproc.extraction.points
+            if not filename:
+                log.error('Missing configuration parameter postproc.extraction.points!')
+                return
+
+            with open(filename, newline='') as f:
+                reader = csv.reader(f)
+                next(reader)
+                rows = [(r[0].strip(), float(r[1]), float(r[2])) for r in reader if r]
+
+            lon = np.array([r[1] for r in rows])
+            lat = np.array([r[2] for r in rows])
+            i, j = self.grid_geometry.cell_index(*self.grid_geometry.from_lonlat(lon, lat))
+            self.receptor_points = [(name, plon, plat, int(pi)+1, int(pj)+1)
+                                    for (name, plon, plat), pi, pj in zip(rows, i, j) if pi >= 0]
+            for name, plon, plat in [r for r, pi in zip(rows, i) if pi < 0]:
+                log.warning('Receptor point', name, 'at', plon, plat, 'is outside the domain')
+            log.debug('Receptor points:', self.receptor_points)
+            self.distribute('receptor_points', points=self.receptor_points)
+
+    @pack('area_emiss_window')
+    def get_area_emission_window(self):
+        """
+        For all time steps distribute the area emissions of the window of grid
+        cells postproc.extraction.window (i_min, i_max, j_min, j_max, starting
+        from 1, inclusive) as a 4D matrix [nx_window, ny_window, nz, nspec],
+        the species in the order of the species pack.
+
+        The condition of the window is a part of the database query, so only
+        the totals of the window are read. The time steps are always computed
+        on the client side (see _area_emission_subset_time_steps) and do not
+        contain the emissions of the external models.
+        """
+
+        window = self.cfg.postproc.extraction.window
+        if len(window) != 4:
+            log.error('Configuration parameter postproc.extraction.window must be i_min, i_max, j_min, j_max!')
+            return
+
+        self.get_species()
+        self.get_time_shifts()
+        self.get_time_factors()
+
+        i_min, i_max, j_min, j_max = [int(w) for w in window]
+        nxw, nyw = i_max-i_min+1, j_max-j_min+1
+        condition = 'g.i BETWEEN {} AND {} AND g.j BETWEEN {} AND {}'.format(i_min, i_max, j_min, j_max)
+
+        def cell_index(i, j):
+            inside = (i >= i_min) & (i <= i_max) & (j >= j_min) & (j <= j_max)
+            return np.where(inside, (i-i_min)*nyw + j-j_min, -1)
+
+        for t, emis in enumerate(self._area_emission_subset_time_steps(condition, cell_index, nxw*nyw)):
+            self.distribute('area_emiss_window', timestep=t,
+                            data=emis.reshape((nxw, nyw) + emis.shape[1:]))
+
+    @pack('area_emiss_points')
+    def get_area_emission_points(self):
+        """
+        For all time steps distribute the area emissions of the grid cells
+        of the receptor points (receptor_points pack) as a 3D matrix
+        [npoints, nz, nspec], the species in the order of the species pack.
+
+        Only the totals of these cells are read from the database, see
+        get_area_emission_window.
+        """
+
+        self.get_receptor_points()
+        self.get_species()
+        self.get_time_shifts()
+        self.get_time_factors()
+
+        try:
+            points = self.receptor_points
+        except AttributeError:
+            return
+        if not points:
+            log.warning('No receptor points in the domain')
+            return
+
+        ny = self.cfg.domain.ny
+        cells = sorted(set((i-1)*ny + j-1 for name, lon, lat, i, j in points))
+        condition = '(g.i, g.j) IN ({})'.format(', '.join('({}, {})'.format(c//ny+1, c%ny+1) for c in cells))
+
+        def cell_index(i, j):
+            idx, found = lookup_index(cells, (i-1)*ny + j-1)
+            return np.where(found, idx, -1)
+
+        point_cells = lookup_index(cells, [(i-1)*ny + j-1 for name, lon, lat, i, j in points])[0]
+        for t, emis in enumerate(self._area_emission_subset_time_steps(condition, cell_index, len(cells))):
+            self.distribute('area_emiss_points', timestep=t, data=emis[point_cells])
+
+    def _area_emission_subset_time_steps(self, condition, cell_index, ncells):
+        """
+        Generator of the time steps [ncells, nz, nspec] of the area emissions
+        of a subset of the grid cells, computed like _area_emission_time_series_bulk
+        from the totals of the cells matching the SQL condition on g.i, g.j.
+        cell_index(i, j) maps the cells to their positions in the subset (-1 to skip).
+        """
+
+        nz = self.cfg.domain.nz
+        # species only from the external models have no id
+        spec_ids = [-1 if s[0] is None else int(s[0]) for s in self.species]
+        nspec = len(spec_ids)
+
+        i, j, k, spec, cat, ts, emiss = self._fetch_area_emission_totals(self.db, condition)
+        spec_idx, found = lookup_index(spec_ids, spec)
+        cell = np.asarray(cell_index(i.astype('i8'), j.astype('i8')))
+        found &= (cell >= 0) & (cell < ncells)
+        cell, k, spec_idx, cat, ts, emiss = (a[found] for a in (cell, k, spec_idx, cat, ts, emiss))
+        flat_idx = np.ravel_multi_index((cell, k.astype('i8')-1, spec_idx), (ncells, nz, nspec))
+
+        yield from self._bulk_time_steps(flat_idx, cat, ts, emiss, (ncells, nz, nspec))
+
     @pack('species')
     def get_species(self):
         """
@@ -438,11 +1034,14 @@ class EmissProvider(DataProvider):
         try:
             self.species
         except AttributeError:  # Read the list from the database is it does not exist
-            q = 'SELECT * FROM "{}".get_species'.format(self.cfg.db_connection.case_schema)
-            log.debug('Getting list of species...', q)
-            with self.db.cursor() as cur:
-                cur.execute(q)
-                ep_species = cur.fetchall()
+            def fetch():
+                q = 'SELECT * FROM "{}".get_species'.format(self.cfg.db_connection.case_schema)
+                log.debug('Getting list of species...', q)
+                with self.db.cursor() as cur:
+                    cur.execute(q)
+                    return cur.fetchall()
+
+            ep_species = self._cached('species', fetch)
             self.species = combine_model_spec(ep_species)
             self.ep_species = ep_species
             log.fmt_debug('Species from FUME and other models: {}.', ','.join([s[1] for s in self.species]))
@@ -461,11 +1060,14 @@ class EmissProvider(DataProvider):
         try:
             self.categories
         except AttributeError:  # Read the list from the database is it does not exist
-            q = 'SELECT cat_id, name FROM "{}".get_categories ORDER BY cat_id'.format(self.cfg.db_connection.case_schema)
-            log.debug('Getting a list of categories...', q)
-            with self.db.cursor() as cur:
-                cur.execute(q)
-                self.categories = cur.fetchall()
+            def fetch():
+                q = 'SELECT cat_id, name FROM "{}".get_categories ORDER BY cat_id'.format(self.cfg.db_connection.case_schema)
+                log.debug('Getting a list of categories...', q)
+                with self.db.cursor() as cur:
+                    cur.execute(q)
+                    return cur.fetchall()
+
+            self.categories = self._cached('categories', fetch)
 
             log.fmt_debug('Categories from FUME: {}.', ','.join([c[1] for c in self.categories]))
 
@@ -480,13 +1082,17 @@ class EmissProvider(DataProvider):
         try:
             self.time_factors
         except AttributeError:
-            q = 'SELECT cat_id, time_loc, tv_factor FROM "{}".ep_time_factors ORDER BY time_loc, cat_id'.format(self.cfg.db_connection.case_schema)
-            log.debug('Getting a list of time disaggregation factors...', q)
-            with self.db.cursor() as cur:
-                cur.execute(q)
-                self.time_factors = defaultdict(dict)
-                for row in cur:
-                    self.time_factors[row[1]][row[0]] = row[2]
+            def fetch():
+                q = 'SELECT cat_id, time_loc, tv_factor FROM "{}".ep_time_factors ORDER BY time_loc, cat_id'.format(self.cfg.db_connection.case_schema)
+                log.debug('Getting a list of time disaggregation factors...', q)
+                time_factors = {}
+                with self.db.cursor() as cur:
+                    cur.execute(q)
+                    for row in cur:
+                        time_factors.setdefault(row[1], {})[row[0]] = row[2]
+                return time_factors
+
+            self.time_factors = defaultdict(dict, self._cached('time_factors', fetch))
 
             self.distribute('time_factors', factors=self.time_factors)
 
@@ -502,25 +1108,54 @@ class EmissProvider(DataProvider):
         try:
             self.molar_weight
         except AttributeError:  # Read the list from the database is it does not exist
-            self.molar_weight = {}
-            q = 'SELECT cat_id, spec_mod_id, avg(mol_weight) AS molar_weight' \
-                ' FROM "{}".ep_mod_spec_factors_all' \
-                ' GROUP BY cat_id, spec_mod_id' \
-                ' ORDER BY cat_id, spec_mod_id'.format(self.cfg.db_connection.case_schema)
-            log.debug('Getting a list of molar weights...', q)
-            cur = self.db.cursor()
-            cur.execute(q)
-            for m in cur.fetchall():
-                self.molar_weight[(m[0], m[1])] = m[2]
+            def fetch():
+                molar_weight = {}
+                q = 'SELECT cat_id, spec_mod_id, avg(mol_weight) AS molar_weight' \
+                    ' FROM "{}".ep_mod_spec_factors_all' \
+                    ' GROUP BY cat_id, spec_mod_id' \
+                    ' ORDER BY cat_id, spec_mod_id'.format(self.cfg.db_connection.case_schema)
+                log.debug('Getting a list of molar weights...', q)
+                cur = self.db.cursor()
+                cur.execute(q)
+                for m in cur.fetchall():
+                    molar_weight[(m[0], m[1])] = m[2]
+                cur.close()
+                return molar_weight
+
+            self.molar_weight = self._cached('molar_weight', fetch)
             #log.fmt_debug('Molar weights from FUME: {}.', ','.join([c[1] for c in self.get_molar_weight]))
             self.distribute('molar_weight', molar_weight=self.molar_weight)
-            cur.close()
 
     @pack('point_emiss')
     def get_point_emission_time_series(self):
+        """
+        Distribute the [numstk, nspec] matrices of point emissions for all time
+        steps, computed according to postproc.emissprovider.time_series_mode
+        (see get_area_emission_time_series).
+        """
+
         self.get_point_species()
         self.get_point_sources_params()
-        cur = self.db.cursor()
+        if self.cfg.postproc.emissprovider.time_series_mode == 'bulk':
+            self.get_time_shifts()
+            self.get_time_factors()
+            time_series = self._point_emission_time_series_bulk
+        else:
+            time_series = self._point_emission_time_series_sql
+
+        timer = stage_timer('point_emiss')
+        for i, emis in enumerate(self._time_series(time_series, timer)):
+            with timer.stage('distribute'):
+                self.distribute('point_emiss', timestep=i, data=emis)
+        timer.print_split()
+
+    def _point_emission_time_series_sql(self, db):
+        """
+        Generator of point emission matrices calling the ep_pemiss_time_series
+        database function for each time step.
+        """
+
+        cur = db.cursor()
         for i in range(self.cfg.run_params.time_params.num_time_int):
             q = 'SELECT ep_pemiss_time_series(%s,%s,%s::timestamp,%s::text)'
             log.debug('Fetching point emissions for timestep', i)
@@ -529,31 +1164,107 @@ class EmissProvider(DataProvider):
                             self.rt_cfg['run']['datestimes'][i],
                             self.cfg.db_connection.case_schema))
 
-            emis = np.array(cur.fetchone()[0])
-            self.distribute('point_emiss', timestep=i, data=emis)
+            yield np.array(cur.fetchone()[0])
         cur.close()
 
+    def _point_emission_time_series_bulk(self, db):
+        """
+        Generator of point emission matrices computed on the client side from the
+        speciated totals grouped by (sg_id, spec, cat, ts) fetched once, the same
+        way as in _area_emission_time_series_bulk. The result equals the one of
+        ep_pemiss_time_series.
+        """
+
+        stack_ids = [int(s[0]) for s in self.stacks]
+        spec_ids = [int(s[0]) for s in self.pspecies]
+
+        log.debug('Fetching point emission totals...')
+        sg, spec, cat, ts, emiss = self._fetch_columns('c_point_emiss_totals',
+                                                       self._point_emissions_by_species_and_category_query(),
+                                                       self.point_emiss_fields, db)
+        stk_idx, stk_found = lookup_index(stack_ids, sg)
+        spec_idx, spec_found = lookup_index(spec_ids, spec)
+        found = stk_found & spec_found
+        flat_idx = np.ravel_multi_index((stk_idx[found], spec_idx[found]), (len(stack_ids), len(spec_ids)))
+
+        yield from self._bulk_time_steps(flat_idx, cat[found], ts[found], emiss[found],
+                                         (len(stack_ids), len(spec_ids)))
+
     @pack('point_emiss_ij')
     def get_point_emission_time_series_ij(self):
         self.get_point_categories()
         self.get_point_species()
-        cur = self.db.cursor()
+        pcat = [int(i[0]) for i in self.pcategories]
+        pspec = [int(i[0]) for i in self.pspecies]
+        if len(pcat) > 0 and len(pspec) > 0 :
+            log.debug('pcat:', pcat)
+            log.debug('pspec:', pspec)
+            if self.cfg.postproc.emissprovider.time_series_mode == 'bulk':
+                self.get_time_shifts()
+                self.get_time_factors()
+                time_series = self._point_emission_time_series_ij_bulk
+            else:
+                time_series = self._point_emission_time_series_ij_sql
+
+            timer = stage_timer('point_emiss_ij')
+            for i, emis in enumerate(self._time_series(time_series, timer)):
+                log.debug('emis:', emis.shape)
+                with timer.stage('distribute'):
+                    self.distribute('point_emiss_ij', timestep=i, data=emis)
+            timer.print_split()
+        log.sql_debug(self.db)
+
+    def _point_emission_time_series_ij_sql(self, db):
+        """
+        Generator of gridded point emission matrices calling the ep_pemiss_time_series_ij
+        database function for each time step.
+        """
+
+        pcat = [int(i[0]) for i in self.pcategories]
+        pspec = [int(i[0]) for i in self.pspecies]
+        cur = db.cursor()
         for i in range(self.cfg.run_params.time_params.num_time_int):
             q = 'SELECT ep_pemiss_time_series_ij(%s::integer[], %s::integer[], %s::timestamp, %s::text)'
             log.debug('Fetching point emissions ij for timestep', i)
             log.debug(q)
-            pcat = [int(i[0]) for i in self.pcategories]
-            pspec = [int(i[0]) for i in self.pspecies]
-            if len(pcat) > 0 and len(pspec) > 0 :
-                log.debug('pcat:', pcat)
-                log.debug('pspec:', pspec)
-                cur.execute(q, (pcat, pspec, self.rt_cfg['run']['datestimes'][i], self.cfg.db_connection.case_schema))
-                emis = np.array(cur.fetchone()[0])
-                log.debug('emis:', emis.shape)
-                self.distribute('point_emiss_ij', timestep=i, data=emis)
-        log.sql_debug(self.db)
+            cur.execute(q, (pcat, pspec, self.rt_cfg['run']['datestimes'][i], self.cfg.db_connection.case_schema))
+            yield np.array(cur.fetchone()[0])
         cur.close()
 
+    def _point_emission_time_series_ij_bulk(self, db):
+        """
+        Generator of gridded point emission matrices [nx, ny, ncat, nspec] computed
+        on the client side from the speciated totals grouped by (i, j, spec, cat, ts)
+        fetched once. As in ep_pemiss_time_series_ij, the point sources with
+        a vertical level (volume sources) are not included.
+        """
+
+        nx, ny = self.cfg.domain.nx, self.cfg.domain.ny
+        cat_ids = [int(c[0]) for c in self.pcategories]
+        spec_ids = [int(s[0]) for s in self.pspecies]
+
+        q = 'SELECT g.i, g.j, em.spec_id s, em.cat_id c, z.ts_id z, sum(em.emiss) e ' \
+            'FROM "{case_schema}".ep_sg_emissions_spec em ' \
+            'JOIN "{case_schema}".ep_sources_grid sg USING(sg_id) ' \
+            'JOIN "{case_schema}".ep_grid_tz g USING(grid_id) ' \
+            'JOIN "{case_schema}".ep_timezones z USING(tz_id) ' \
+            'LEFT OUTER JOIN "{case_schema}".ep_transformation_chains_levels chl ' \
+            '  ON sg.transformation_chain=chl.chain_id ' \
+            "WHERE sg.source_type = 'P' AND chl.vertical_level IS NULL " \
+            'GROUP BY g.i, g.j, em.spec_id, em.cat_id, z.ts_id'.format(
+                case_schema=self.cfg.db_connection.case_schema)
+
+        log.debug('Fetching gridded point emission totals...')
+        i, j, spec, cat, ts, emiss = self._fetch_columns('c_point_emiss_ij_totals', q,
+                                                         self.point_emiss_ij_fields, db)
+        cat_idx, cat_found = lookup_index(cat_ids, cat)
+        spec_idx, spec_found = lookup_index(spec_ids, spec)
+        found = cat_found & spec_found
+        shape = (nx, ny, len(cat_ids), len(spec_ids))
+        flat_idx = np.ravel_multi_index((i[found]-1, j[found]-1, cat_idx[found], spec_idx[found]), shape)
+
+        yield from self._bulk_time_steps(flat_idx, cat[found], ts[found], emiss[found], shape)
+
     @pack('stack_params')
     def get_point_sources_params(self):
         """
@@ -586,11 +1297,14 @@ class EmissProvider(DataProvider):
         try:
             self.pspecies
         except AttributeError:  # Read the list from the database is it does not exist
-            q = 'SELECT * from "{}".get_species_point'.format(self.cfg.db_connection.case_schema)
-            log.debug('Getting list of point species...', q)
-            with self.db.cursor() as cur:
-                cur.execute(q)
-                self.pspecies = cur.fetchall()
+            def fetch():
+                q = 'SELECT * from "{}".get_species_point'.format(self.cfg.db_connection.case_schema)
+                log.debug('Getting list of point species...', q)
+                with self.db.cursor() as cur:
+                    cur.execute(q)
+                    return cur.fetchall()
+
+            self.pspecies = self._cached('point_species', fetch)
 
             self.distribute('point_species', pspecies=self.pspecies)
 
@@ -635,14 +1349,17 @@ class EmissProvider(DataProvider):
         try:
             self.pcategories
         except AttributeError:  # Read the list from the database is it does not exist
-            q = 'SELECT distinct c.cat_id, c.name FROM "{conf}".ep_emission_categories c '\
-                ' JOIN "{case}".ep_sg_emissions_spec sp USING(cat_id) '\
-                ' JOIN "{case}".ep_sources_grid sg USING(sg_id) WHERE sg.source_type = \'P\' ORDER BY c.cat_id'\
-                .format(conf=self.cfg.db_connection.conf_schema, case=self.cfg.db_connection.case_schema)
-            log.debug('Getting a list of point species categories...', q)
-            with self.db.cursor() as cur:
-                cur.execute(q)
-                self.pcategories = cur.fetchall()
+            def fetch():
+                q = 'SELECT distinct c.cat_id, c.name FROM "{conf}".ep_emission_categories c '\
+                    ' JOIN "{case}".ep_sg_emissions_spec sp USING(cat_id) '\
+                    ' JOIN "{case}".ep_sources_grid sg USING(sg_id) WHERE sg.source_type = \'P\' ORDER BY c.cat_id'\
+                    .format(conf=self.cfg.db_connection.conf_schema, case=self.cfg.db_connection.case_schema)
+                log.debug('Getting a list of point species categories...', q)
+                with self.db.cursor() as cur:
+                    cur.execute(q)
+                    return cur.fetchall()
+
+            self.pcategories = self._cached('point_categories', fetch)
 
             log.fmt_debug('Point species categories from FUME: {}.', ','.join([c[1] for c in self.pcategories]))
 
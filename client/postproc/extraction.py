@@ -0,0 +1,194 @@
+"""
+Description: output of the emissions of a part of the domain
+    - NetCDFWindowWriter: time series of the area emissions of a window of grid cells
+    - NetCDFPointsWriter: time series of the area emissions at receptor points
+    - CSVPointsWriter: the same as NetCDFPointsWriter in a CSV file
+"""
+
+"""
+This file is part of the FUME emission model.
+
+FUME is free software: you can redistribute it and/or modify it under the terms of the GNU General
+Public License as published by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+FUME is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+Information and source code can be obtained at www.fume-ep.org
+
+Copyright 2014-2023 Institute of Computer Science of the Czech Academy of Sciences, Prague, Czech Republic
+Copyright 2014-2023 Charles University, Faculty of Mathematics and Physics, Prague, Czech Republic
+Copyright 2014-2023 Czech Hydrometeorological Institute, Prague, Czech Republic
+Copyright 2014-2017 Czech Technical University in Prague, Czech Republic
+"""
+
+import csv
+import os
+import numpy as np
+from netCDF4 import date2num
+from postproc.receiver import DataReceiver, requires
+from postproc.netcdf import NetCDFWriter
+import lib.ep_logging
+log = lib.ep_logging.Logger(__name__)
+
+
+class NetCDFTimeSeriesWriter(NetCDFWriter):
+    """
+    Common part of the NetCDF writers of the extracted time series: species
+    variables with the given spatial dimensions and the time variable.
+    """
+
+    def create_species(self, species, dims):
+        self.species = species
+        self.outvars = []
+        dims = (self.names['t_dim'], ) + tuple(dims)
+        for specid, specname in self.species:
+            emisvar = self.outfile.createVariable(specname, 'f4', dims, fill_value=self.undef,
+                                                  **self.storage_options(dims))
+            emisvar.long_name = specname
+            emisvar.units = self.names['emission_units']
+            emisvar.var_desc = 'Model species ' + specname
+            emisvar.missing_value = self.undef
+            self.outvars.append(emisvar)
+
+    def finalize(self):
+        if self.actions['create_t_var']:
+            datestimes = self.rt_cfg['run']['datestimes']
+            self.timevar = self.outfile.createVariable(self.names['t_var'], 'f4', (self.names['t_dim'], ))
+            self.timevar.units = 'hours since ' + datestimes[0].strftime('%Y-%m-%d %H:%M')
+            self.timevar[:] = date2num([d.replace(tzinfo=None) for d in datestimes],
+                                       units=self.timevar.units, calendar='standard')
+
+        super().finalize()
+
+
+class NetCDFWindowWriter(NetCDFTimeSeriesWriter):
+    """
+    Postprocessor class writing the time series of the area emissions of the window
+    of grid cells postproc.extraction.window (area_emiss_window pack) into a generic
+    NetCDF file named postproc.extraction.windowfile. The indices of the window
+    cells in the domain are stored in the variables i and j.
+    """
+
+    def setup(self, *args, **kwargs):
+        if 'filename' not in kwargs:
+            if self.cfg.postproc.extraction.windowfile:
+                kwargs['filename'] = self.cfg.postproc.extraction.windowfile
+            else:
+                log.error('Missing configuration parameter postproc.extraction.windowfile!')
+
+        kwargs['no_create_x_dim'] = True
+        kwargs['no_create_y_dim'] = True
+        super().setup(*args, **kwargs)
+
+        i_min, i_max, j_min, j_max = [int(w) for w in self.cfg.postproc.extraction.window]
+        self.outfile.createDimension(self.names['x_dim'], i_max-i_min+1)
+        self.outfile.createDimension(self.names['y_dim'], j_max-j_min+1)
+        i_var = self.outfile.createVariable('i', 'i4', (self.names['x_dim'], ))
+        i_var.long_name = 'column of the grid cell in the domain (starting from 1)'
+        i_var[:] = np.arange(i_min, i_max+1)
+        j_var = self.outfile.createVariable('j', 'i4', (self.names['y_dim'], ))
+        j_var.long_name = 'row of the grid cell in the domain (starting from 1)'
+        j_var[:] = np.arange(j_min, j_max+1)
+
+    def receive_species(self, species):
+        self.create_species(species, (self.names['z_dim'], self.names['y_dim'], self.names['x_dim']))
+
+    @requires('species')
+    def receive_area_emiss_window(self, timestep, data):
+        # data [x, y, z, species]
+        for spec_idx, emisvar in enumerate(self.outvars):
+            emisvar[timestep] = data[:, :, :, spec_idx].transpose()
+
+    def finalize(self):
+        self.outfile.FILEDESC = 'Area emissions of a window of the domain created by FUME ' + \
+            self.cfg.run_params.output_params.output_description
+        super().finalize()
+
+
+class NetCDFPointsWriter(NetCDFTimeSeriesWriter):
+    """
+    Postprocessor class writing the time series of the area emissions of the grid
+    cells of the receptor points (area_emiss_points pack) into a generic NetCDF
+    file named postproc.extraction.pointsfile, with the dimension point and
+    the variables point_name, lon, lat, i and j describing the points.
+    """
+
+    def setup(self, *args, **kwargs):
+        if 'filename' not in kwargs:
+            if self.cfg.postproc.extraction.pointsfile:
+                kwargs['filename'] = self.cfg.postproc.extraction.pointsfile
+            else:
+                log.error('Missing configuration parameter postproc.extraction.pointsfile!')
+
+        kwargs['no_create_x_dim'] = True
+        kwargs['no_create_y_dim'] = True
+        super().setup(*args, **kwargs)
+
+    def receive_receptor_points(self, points):
+        self.outfile.createDimension('point', len(points))
+        name_var = self.outfile.createVariable('point_name', 'str', ('point', ))
+        name_var[:] = np.array([p[0] for p in points], dtype='object')
+        for c, (name, dtype, long_name) in enumerate((('lon', 'f8', 'longitude of the point'),
+                                                      ('lat', 'f8', 'latitude of the point'),
+                                                      ('i', 'i4', 'column of the grid cell (starting from 1)'),
+                                                      ('j', 'i4', 'row of the grid cell (starting from 1)'))):
+            var = self.outfile.createVariable(name, dtype, ('point', ))
+            var.long_name = long_name
+            var[:] = [p[c+1] for p in points]
+
+    @requires('receptor_points')
+    def receive_species(self, species):
+        self.create_species(species, ('point', self.names['z_dim']))
+
+    @requires('species')
+    def receive_area_emiss_points(self, timestep, data):
+        # data [point, z, species]
+        for spec_idx, emisvar in enumerate(self.outvars):
+            emisvar[timestep] = data[:, :, spec_idx]
+
+    def finalize(self):
+        self.outfile.FILEDESC = 'Area emissions at receptor points created by FUME ' + \
+            self.cfg.run_params.output_params.output_description
+        super().finalize()
+
+
+class CSVPointsWriter(DataReceiver):
+    """
+    Postprocessor class writing the time series of the area emissions of the grid
+    cells of the receptor points (area_emiss_points pack) into the CSV file
+    postproc.extraction.csvfile, one line per time step, point and level
+    with the emissions of all species.
+    """
+
+    def setup(self, *args, **kwargs):
+        filename = self.cfg.postproc.extraction.csvfile
+        if not filename:
+            log.error('Missing configuration parameter postproc.extraction.csvfile!')
+
+        filepath = os.path.dirname(os.path.abspath(filename))
+        if not os.path.exists(filepath):
+            os.makedirs(filepath)
+
+        self.outfile = open(filename, 'w', newline='')
+        self.writer = csv.writer(self.outfile)
+
+    def receive_receptor_points(self, points):
+        self.points = points
+
+    def receive_species(self, species):
+        self.species = species
+        self.writer.writerow(['time', 'point', 'level'] + [s[1] for s in species])
+
+    @requires('species', 'receptor_points')
+    def receive_area_emiss_points(self, timestep, data):
+        # data [point, z, species]
+        time = self.rt_cfg['run']['datestimes'][timestep].strftime('%Y-%m-%d %H:%M')
+        for p, point in enumerate(self.points):
+            for k in range(data.shape[1]):
+                self.writer.writerow([time, point[0], k+1] + ['{:g}'.format(e) for e in data[p, k]])
+
+    def finalize(self):
+        self.outfile.close()
@@ -27,7 +27,10 @@ Copyright 2014-2017 Czech Technical University in Prague, Czech Republic
 import numpy as np
 from netCDF4 import Dataset, date2num
 import os
+import time
 from postproc.receiver import DataReceiver, requires
+from postproc.timedisagg import lookup_index, chunk_columns, time_factor_tensor, period_factor_tensor, disaggregate
+from postproc.sharding import shard_filename, shard_datestimes
 import lib.ep_logging
 log = lib.ep_logging.Logger(__name__)
 
@@ -102,6 +105,90 @@ action_defaults = {
     'close_outfile': True,
 }
 
+"""
+Storage profiles compared by the benchmark mode of NetCDFWriter
+(postproc.netcdfwriter.benchmark), in addition to the configured profile.
+"""
+
+benchmark_profiles = [
+    ('contiguous', {'compression': 0, 'shuffle': False, 'chunking': 'auto', 'least_significant_digit': None}),
+    ('slice', {'compression': 0, 'shuffle': False, 'chunking': 'slice', 'least_significant_digit': None}),
+    ('zlib1', {'compression': 1, 'shuffle': True, 'chunking': 'slice', 'least_significant_digit': None}),
+    ('zlib4', {'compression': 4, 'shuffle': True, 'chunking': 'slice', 'least_significant_digit': None}),
+    ('zlib9', {'compression': 9, 'shuffle': True, 'chunking': 'slice', 'least_significant_digit': None}),
+]
+
+
+def storage_options(profile, dimensions, spatial_dims):
+    """
+    Keyword arguments of Dataset.createVariable for a variable with dimensions
+    (list of (name, size) pairs) by the storage profile (postproc.netcdfwriter
+    configuration section or a dict with the same keys).
+
+    With chunking 'slice', the chunks span the whole spatial dimensions
+    spatial_dims and have size 1 in the others (time, time shift, category),
+    i.e. one chunk is one time step of a species as written by the time writers.
+    """
+
+    options = {}
+    if profile['compression'] > 0:
+        options['zlib'] = True
+        options['complevel'] = profile['compression']
+        options['shuffle'] = profile['shuffle']
+    if profile['least_significant_digit'] is not None:
+        options['least_significant_digit'] = profile['least_significant_digit']
+    if profile['chunking'] == 'slice':
+        options['chunksizes'] = [max(size, 1) if name in spatial_dims else 1 for name, size in dimensions]
+
+    return options
+
+
+def benchmark_storage(filename, profiles, spatial_dims):
+    """
+    Copy the NetCDF file filename once for each of the storage profiles
+    (list of (name, profile) pairs, see storage_options) and report the write
+    throughput and the size of the file for each of them. The copies are removed.
+    """
+
+    infile = Dataset(filename)
+    outnames = ['{}.{}.benchmark'.format(filename, name) for name, profile in profiles]
+    outfiles = []
+    for outname in outnames:
+        outfile = Dataset(outname, 'w', format='NETCDF4')
+        for dimname, dim in infile.dimensions.items():
+            outfile.createDimension(dimname, None if dim.isunlimited() else len(dim))
+        outfiles.append(outfile)
+
+    nbytes = 0
+    elapsed = [0.0]*len(profiles)
+    for varname, var in infile.variables.items():
+        data = var[:]
+        if var.dtype != str:
+            nbytes += data.nbytes
+        fill_value = getattr(var, '_FillValue', None)
+        for i, (name, profile) in enumerate(profiles):
+            if var.dtype == str or not var.dimensions:
+                options = {}
+            else:
+                options = storage_options(profile, [(d, len(infile.dimensions[d])) for d in var.dimensions],
+                                          spatial_dims)
+            start = time.perf_counter()
+            outvar = outfiles[i].createVariable(varname, var.dtype, var.dimensions, fill_value=fill_value, **options)
+            outvar[:] = data
+            elapsed[i] += time.perf_counter() - start
+
+    infile.close()
+    log.info('Storage benchmark of', filename, '({:.1f} MB of data)'.format(nbytes/1e6))
+    for i, (name, profile) in enumerate(profiles):
+        start = time.perf_counter()
+        outfiles[i].close()
+        elapsed[i] += time.perf_counter() - start
+        size = os.path.getsize(outnames[i])
+        log.info('  {:12s} write {:8.1f} MB/s, file size {:10.1f} MB ({:5.1f} %)'.format(
+            name, nbytes/1e6/max(elapsed[i], 1e-9), size/1e6, 100.*size/max(nbytes, 1)))
+        os.remove(outnames[i])
+
+
 #undef = 0.
 
 class NetCDFWriter(DataReceiver):
@@ -135,6 +222,9 @@ class NetCDFWriter(DataReceiver):
         self.undef = kwargs['undef']
         if 'filename' not in kwargs and len(args) == 1:
             kwargs['filename'] = args[0]
+        if 'shard' in self.rt_cfg['run']:
+            kwargs['filename'] = shard_filename(kwargs['filename'], self.rt_cfg['run']['datestimes'][0],
+                                                self.rt_cfg['run']['shard'])
 
         filepath = os.path.dirname(os.path.abspath(kwargs['filename']))
         if not os.path.exists(filepath):
@@ -160,7 +250,83 @@ class NetCDFWriter(DataReceiver):
         if self.actions['create_t_dim']:
             self.outfile.createDimension(self.names['t_dim'], None)
 
+    def storage_options(self, dimensions):
+        """
+        Keyword arguments of createVariable for an emission variable with
+        the given dimension names by the storage profile configured
+        in postproc.netcdfwriter (chunking, compression, quantization).
+        """
+
+        return storage_options(self.cfg.postproc.netcdfwriter,
+                               [(d, len(self.outfile.dimensions[d])) for d in dimensions],
+                               (self.names['z_dim'], self.names['y_dim'], self.names['x_dim']))
+
+    def close_outfile(self):
+        """
+        Close the output file; in the benchmark mode compare the storage profiles on it.
+        """
+
+        filename = self.outfile.filepath()
+        self.outfile.close()
+        if self.cfg.postproc.netcdfwriter.benchmark:
+            benchmark_storage(filename,
+                              [('configured', self.cfg.postproc.netcdfwriter)] + benchmark_profiles,
+                              (self.names['z_dim'], self.names['y_dim'], self.names['x_dim']))
+
+    def buffer_values(self, spec_idx, idx, values):
+        """
+        Store values into the species output variables self.outvars[spec_idx]
+        at positions idx (tuple of index arrays, one for each dimension).
+
+        The values are kept in per-species in-memory arrays and written to the file
+        in one write per variable by flush_buffers (called in finalize). If the buffers
+        of all species would exceed postproc.netcdfwriter.buffer_limit (in MB, 0 means
+        no limit), the values are instead written to the file directly, one slab of
+        the first dimension of a variable at a time.
+        """
+
+        try:
+            self.buffers
+        except AttributeError:
+            self.buffers = {}
+            nbytes = sum(4*np.prod(v.shape) for v in self.outvars)
+            limit = self.cfg.postproc.netcdfwriter.buffer_limit
+            self.buffered = limit == 0 or nbytes <= limit*1024*1024
+            if not self.buffered:
+                log.debug('Output buffers would need', nbytes, 'bytes, writing by slabs')
+
+        if self.buffered:
+            for s in np.unique(spec_idx):
+                mask = spec_idx == s
+                if s not in self.buffers:
+                    self.buffers[s] = np.full(self.outvars[s].shape, self.undef, dtype='f4')
+                self.buffers[s][tuple(i[mask] for i in idx)] = values[mask]
+        else:
+            slabs = np.unique(np.stack((spec_idx, idx[0]), axis=1), axis=0)
+            for s, first in slabs:
+                mask = (spec_idx == s) & (idx[0] == first)
+                slab = self.outvars[s][first]
+                if np.ma.isMaskedArray(slab):
+                    slab = slab.filled(self.undef)
+                slab[tuple(i[mask] for i in idx[1:])] = values[mask]
+                self.outvars[s][first] = slab
+
+    def flush_buffers(self):
+        """
+        Write the species buffers filled by buffer_values to the output file.
+        """
+
+        try:
+            buffers = self.buffers
+        except AttributeError:
+            return
+
+        for s, buf in buffers.items():
+            self.outvars[s][:] = buf
+        self.buffers = {}
+
     def finalize(self):
+        self.flush_buffers()
         self.outfile.history = ''
 
         if self.actions['create_projection_attrs']:
@@ -177,7 +343,7 @@ class NetCDFWriter(DataReceiver):
 
         if self.actions['close_outfile']:
             log.debug('closing file: ', self.outfile.filepath())
-            self.outfile.close()
+            self.close_outfile()
 
 
 class NetCDFTotalWriter(NetCDFWriter):
@@ -209,13 +375,13 @@ class NetCDFTotalWriter(NetCDFWriter):
 
         for specid, specname in self.species:
             log.debug('receive_species:', self.names['ts_dim'], self.names['category_dim'], self.names['z_dim'], self.names['y_dim'],self.names['x_dim'])
-            emisvar = self.outfile.createVariable(
-                specname, 'f4', (self.names['ts_dim'],
-                                 self.names['category_dim'],
-                                 self.names['z_dim'],
-                                 self.names['y_dim'],
-                                 self.names['x_dim']),
-                fill_value=self.undef)
+            dims = (self.names['ts_dim'],
+                    self.names['category_dim'],
+                    self.names['z_dim'],
+                    self.names['y_dim'],
+                    self.names['x_dim'])
+            emisvar = self.outfile.createVariable(specname, 'f4', dims, fill_value=self.undef,
+                                                  **self.storage_options(dims))
             emisvar.long_name = specname
             emisvar.units = 'moles/s for gases and g/s for aerosols'
             emisvar.var_desc = 'Model species ' + specname
@@ -266,14 +432,22 @@ class NetCDFTotalAreaWriter(NetCDFTotalWriter):
     @requires('species')
     def receive_area_emiss_by_species_and_category(self, data):
         log.debug('area_emiss_by_species_and_category')
-        for row in data:
-            #log.debug('netcdf: receive_area_emiss_by_species_and_category: ', row)
-            spec_idx = self.species_lookup[row[3]]
-            cat_idx = self.categories_lookup[row[4]]
-            ts_idx = self.ts_lookup[row[5]]
-            self.z_var[row[2]-1] = row[2]
-            self.outvars[spec_idx][ts_idx, cat_idx, row[2]-1, row[1]-1, row[0]-1] =\
-                (row[6] < 1e+36 and row[6] or self.undef)
+        i, j, k, spec, cat, ts, emiss = chunk_columns(data, 7)
+        i, j, k = (c.astype('i8') for c in (i, j, k))
+        spec_idx, spec_found = lookup_index([s[0] for s in self.species], spec)
+        cat_idx, cat_found = lookup_index([c[0] for c in self.categories], cat)
+        ts_idx, ts_found = lookup_index(self.ts, ts)
+        found = spec_found & cat_found & ts_found
+        if not found.all():
+            log.warning('Skipping', np.count_nonzero(~found), 'rows with unknown species, category or time shift')
+
+        levels = np.unique(k[found])
+        self.z_var[levels-1] = levels
+        # huge, zero and missing emissions are stored as undef
+        values = np.where((emiss < 1e+36) & (emiss != 0), emiss, self.undef)[found]
+        self.buffer_values(spec_idx[found],
+                           (ts_idx[found], cat_idx[found], k[found]-1, j[found]-1, i[found]-1),
+                           values)
 
     def finalize(self):
         self.outfile.FILEDESC = 'Total area emissions created by FUME ' + self.cfg.run_params.output_params.output_description
@@ -288,9 +462,13 @@ class NetCDFAreaTimeDisaggregator(NetCDFWriter):
     NetCDF file.
 
     Assumes area totals were written previously by NetCDFTotalAreaWriter
-    in the file named self.cfg.postproc.netcdfareawriter.totalfile
+    in the file named self.cfg.postproc.netcdfareawriter.totalfile, or, with
+    postproc.time_disaggregation = cube, receives the time disaggregated
+    emissions computed once for all the writers by the area_emiss_cube pack.
     """
 
+    shardable = True
+
     def setup(self, *args, **kwargs):
         if 'filename' not in kwargs:
             if self.cfg.postproc.netcdfareawriter.timedfile:
@@ -309,12 +487,12 @@ class NetCDFAreaTimeDisaggregator(NetCDFWriter):
         if self.actions['create_spec_vars']:
             self.outvars = []
             for specid, specname in self.species:
-                emisvar = self.outfile.createVariable(
-                    specname, 'f4', (self.names['t_dim'],
-                                     self.names['z_dim'],
-                                     self.names['y_dim'],
-                                     self.names['x_dim']),
-                    fill_value=self.undef)
+                dims = (self.names['t_dim'],
+                        self.names['z_dim'],
+                        self.names['y_dim'],
+                        self.names['x_dim'])
+                emisvar = self.outfile.createVariable(specname, 'f4', dims, fill_value=self.undef,
+                                                      **self.storage_options(dims))
                 emisvar.long_name = specname
                 emisvar.units = self.names['emission_units']
                 emisvar.var_desc = 'Model species ' + specname
@@ -336,35 +514,58 @@ class NetCDFAreaTimeDisaggregator(NetCDFWriter):
                 self.ts.append(ts_id[0])
         self.ts_lookup = {member: idx for idx, member in enumerate(self.ts)}
 
-    @requires('time_shifts')
-    def finalize(self):
-        self.infile = Dataset(self.cfg.postproc.netcdfareawriter.totalfile)
+    def species_scale_factors(self):
+        """
+        Scale factors of the species by name: self.names['scale_factor'] is
+        either a single factor for all species or a dictionary of factors
+        of some of the species (the others are not scaled).
+        """
+
+        try:
+            return self.scale_factors
+        except AttributeError:
+            pass
 
         # intialize species specific scale factors
-        species_scale_factors = { s[1]:1.0 for s in self.species }
+        self.scale_factors = { s[1]:1.0 for s in self.species }
         # override by self.names['scale_factor']
         if type(self.names['scale_factor']) is not dict:
-            species_scale_factors = { s[1]: self.names['scale_factor'] for s in self.species }
+            self.scale_factors = { s[1]: self.names['scale_factor'] for s in self.species }
         else:
         # self.names['scale_factor'] is a dictionary, overwrite species_scale_factors content
             for s in self.names['scale_factor']:
-                species_scale_factors[s] = self.names['scale_factor'][s]
+                self.scale_factors[s] = self.names['scale_factor'][s]
 
-        for time_idx, stepdt in enumerate(self.rt_cfg['run']['datestimes']):
-            log.debug('Time step ', time_idx, stepdt, stepdt.replace(tzinfo=None))
-            for spec_idx, (specid, specname) in enumerate(self.species):
-                self.outvars[spec_idx][time_idx, :] = 0.
-                for ts_id in self.ts:
-                    ts_idx = self.ts_lookup[ts_id]
-                    for cat_idx, (catid, catname) in enumerate(self.categories):
-                        dtutc = self.time_shifts[(ts_id, stepdt)]
-                        tf = self.time_factors[dtutc]
-                        try:
-                            time_factor = float(tf[catid])
-                        except KeyError:
-                            continue
-                        self.outvars[spec_idx][time_idx, :, :, :] += \
-                            self.infile.variables[specname][ts_idx, cat_idx, :, :, :].filled(fill_value=0)*time_factor* species_scale_factors[specname] #self.names['scale_factor']
+        return self.scale_factors
+
+    @requires('species')
+    def receive_area_emiss_cube(self, spec_idx, start, data):
+        specname = self.species[spec_idx][1]
+        self.outvars[spec_idx][start:start+data.shape[0]] = data*self.species_scale_factors()[specname]
+
+    def disaggregate_total_file(self):
+        """
+        Compute the time series of all species from the total file.
+        """
+
+        self.infile = Dataset(self.cfg.postproc.netcdfareawriter.totalfile)
+        species_scale_factors = self.species_scale_factors()
+
+        # time disaggregation factors [time, ts, cat], the total file is indexed
+        # by the positions in self.ts and self.categories
+        factors = time_factor_tensor(self.rt_cfg['run']['datestimes'], self.time_shifts, self.time_factors,
+                                     self.ts, [c[0] for c in self.categories])
+        time_chunk = self.cfg.postproc.netcdfwriter.time_chunk
+        for spec_idx, (specid, specname) in enumerate(self.species):
+            log.debug('Time disaggregation of species', specname)
+            totals = np.ma.filled(self.infile.variables[specname][:], fill_value=0)
+            for start, values in disaggregate(totals, factors*species_scale_factors[specname], time_chunk):
+                self.outvars[spec_idx][start:start+values.shape[0]] = values
+
+    @requires('time_shifts')
+    def finalize(self):
+        if self.cfg.postproc.time_disaggregation != 'cube':
+            self.disaggregate_total_file()
 
         if self.actions['create_t_var']:
             self.timevar = self.outfile.createVariable(self.names['t_var'],
@@ -381,6 +582,121 @@ class NetCDFAreaTimeDisaggregator(NetCDFWriter):
         super().finalize()
 
 
+class NetCDFAreaPeriodWriter(NetCDFWriter):
+    """
+    Postprocessor class for writing area emissions aggregated by day, month
+    or year (postproc.netcdfareawriter.period) into a generic NetCDF file
+    named self.cfg.postproc.netcdfareawriter.periodfile.
+
+    The time factors are summed over each period and applied to the speciated
+    totals by category in a single pass, the hourly emissions are never
+    computed. The emissions of a period are the sum of the emissions of its
+    output time steps, i.e. the sum of the time steps written by
+    NetCDFAreaTimeDisaggregator for the same period.
+    """
+
+    def setup(self, *args, **kwargs):
+        if 'filename' not in kwargs:
+            if self.cfg.postproc.netcdfareawriter.periodfile:
+                kwargs['filename'] = self.cfg.postproc.netcdfareawriter.periodfile
+            else:
+                log.error('Missing configuration parameter postproc.netcdfareawriter.periodfile!')
+
+        super().setup(*args, **kwargs)
+        self.periods = shard_datestimes(self.rt_cfg['run']['datestimes'],
+                                        self.cfg.postproc.netcdfareawriter.period)
+        self.totals = []
+
+    @requires('categories')
+    def receive_species(self, species):
+        self.species = species
+        self.outvars = []
+        for specid, specname in self.species:
+            dims = (self.names['t_dim'],
+                    self.names['z_dim'],
+                    self.names['y_dim'],
+                    self.names['x_dim'])
+            emisvar = self.outfile.createVariable(specname, 'f4', dims, fill_value=self.undef,
+                                                  **self.storage_options(dims))
+            emisvar.long_name = specname
+            emisvar.units = self.names['emission_units']
+            emisvar.var_desc = 'Model species ' + specname
+            emisvar.cell_methods = self.names['t_var'] + ': sum'
+            emisvar.missing_value = self.undef
+            self.outvars.append(emisvar)
+
+    def receive_categories(self, categories):
+        self.categories = categories
+
+    def receive_time_factors(self, factors):
+        self.time_factors = factors
+
+    def receive_time_shifts(self, time_shifts):
+        self.time_shifts = time_shifts
+        self.ts = []
+        for ts_id in time_shifts:
+            if ts_id[0] not in self.ts:
+                self.ts.append(ts_id[0])
+
+    def receive_area_emiss_by_species_and_category(self, data):
+        if len(data):
+            self.totals.append(chunk_columns(data, 7))
+
+    def aggregate(self):
+        """
+        Compute and write the emissions of all species and periods.
+        """
+
+        nx, ny, nz = self.cfg.domain.nx, self.cfg.domain.ny, self.cfg.domain.nz
+        factors = period_factor_tensor(self.periods, self.time_shifts, self.time_factors,
+                                       self.ts, [c[0] for c in self.categories])
+        try:
+            i, j, k, spec, cat, ts, emiss = [np.concatenate(c) for c in zip(*self.totals)]
+        except ValueError:
+            i, j, k, spec, cat, ts, emiss = [np.zeros(0) for c in range(7)]
+        self.totals = []
+
+        spec_idx, spec_found = lookup_index([s[0] for s in self.species], spec)
+        cat_idx, cat_found = lookup_index([c[0] for c in self.categories], cat)
+        ts_idx, ts_found = lookup_index(self.ts, ts)
+        found = spec_found & cat_found & ts_found
+        if not found.all():
+            log.warning('Skipping', np.count_nonzero(~found), 'rows with unknown species, category or time shift')
+        # huge and missing emissions are treated as zero, as in the time series
+        emiss = np.where(emiss < 1e+36, emiss, 0)
+        cell = ((k.astype('i8')-1)*ny + j.astype('i8')-1)*nx + i.astype('i8')-1
+
+        time_chunk = self.cfg.postproc.netcdfwriter.time_chunk
+        for s, (specid, specname) in enumerate(self.species):
+            log.debug('Aggregation of species', specname, 'by', self.cfg.postproc.netcdfareawriter.period)
+            rows = found & (spec_idx == s)
+            s_cell, s_ts, s_cat, s_emiss = cell[rows], ts_idx[rows], cat_idx[rows], emiss[rows]
+            for start in range(0, len(self.periods), time_chunk):
+                values = np.stack([np.bincount(s_cell, weights=factors[p, s_ts, s_cat]*s_emiss,
+                                               minlength=nz*ny*nx)
+                                   for p in range(start, min(start+time_chunk, len(self.periods)))])
+                self.outvars[s][start:start+values.shape[0]] = values.reshape((-1, nz, ny, nx))
+
+    @requires('time_shifts', 'time_factors')
+    def finalize(self):
+        self.aggregate()
+
+        if self.actions['create_t_var']:
+            # time of the first output time step of each period
+            first = [p[0].replace(tzinfo=None) for p in self.periods]
+            self.timevar = self.outfile.createVariable(self.names['t_var'], 'f4', (self.names['t_dim'], ))
+            self.timevar.units = 'hours since ' + first[0].strftime('%Y-%m-%d %H:%M')
+            self.timevar[:] = date2num(first, units=self.timevar.units, calendar='standard')
+            stepsvar = self.outfile.createVariable('time_steps', 'i4', (self.names['t_dim'], ))
+            stepsvar.long_name = 'number of output time steps in the period'
+            stepsvar[:] = [len(p) for p in self.periods]
+
+        self.outfile.FILEDESC = 'Area emissions by ' + self.cfg.postproc.netcdfareawriter.period + \
+            ' created by FUME ' + self.cfg.run_params.output_params.output_description
+
+        super().finalize()
+
+
 class NetCDFTotalPointWriter(NetCDFWriter):
     """
     Postprocessor class for writing NetCDF point emission file.
@@ -465,13 +781,18 @@ class NetCDFTotalPointWriter(NetCDFWriter):
 
     @requires('stack_params','point_species','time_shifts')
     def receive_point_emiss_by_species_and_category(self, data):
-        for row in data:
-            spec_idx = self.pspecies_lookup[row[1]]
-            cat_idx = self.pcategories_lookup[row[2]]
-            ts_idx = self.ts_lookup[row[3]]
-            stk_idx = self.stacks_lookup[row[0]]
-            self.outvars[spec_idx][ts_idx, cat_idx, stk_idx] =\
-                (row[4] < 1e+36 and row[4] or self.undef)
+        sg_id, spec, cat, ts, emiss = chunk_columns(data, 5)
+        stk_idx, stk_found = lookup_index(self.stacks_id, sg_id.astype('i8'))
+        spec_idx, spec_found = lookup_index([s[0] for s in self.pspecies], spec)
+        cat_idx, cat_found = lookup_index([c[0] for c in self.pcategories], cat)
+        ts_idx, ts_found = lookup_index(self.ts, ts)
+        found = stk_found & spec_found & cat_found & ts_found
+        if not found.all():
+            log.warning('Skipping', np.count_nonzero(~found), 'rows with unknown stack, species, category or time shift')
+
+        # huge, zero and missing emissions are stored as undef
+        values = np.where((emiss < 1e+36) & (emiss != 0), emiss, self.undef)[found]
+        self.buffer_values(spec_idx[found], (ts_idx[found], cat_idx[found], stk_idx[found]), values)
 
     @requires('point_categories','time_shifts')
     def receive_point_species(self, pspecies):
@@ -481,11 +802,11 @@ class NetCDFTotalPointWriter(NetCDFWriter):
         self.outvars = []
 
         for specid, specname in self.pspecies:
-            emisvar = self.outfile.createVariable(
-                specname, 'f4', (self.names['ts_dim'],
-                                 self.names['category_dim'],
-                                 self.names['z_dim']),
-                fill_value=self.undef)
+            dims = (self.names['ts_dim'],
+                    self.names['category_dim'],
+                    self.names['z_dim'])
+            emisvar = self.outfile.createVariable(specname, 'f4', dims, fill_value=self.undef,
+                                                  **self.storage_options(dims))
             emisvar.long_name = specname
             emisvar.units = 'moles/s for gases and g/s for aerosols'
             emisvar.var_desc = 'Model species ' + specname
@@ -617,13 +938,13 @@ class NetCDFTotal3DWriter(NetCDFWriter):
         self.outvars = []
 
         for specid, specname in self.aspecies:
-            emisvar = self.outfile.createVariable(
-                specname, 'f4', (self.names['ts_dim'],
-                                 self.names['category_dim'],
-                                 self.names['z_dim'],
-                                 self.names['y_dim'],
-                                 self.names['x_dim']),
-                fill_value=self.undef)
+            dims = (self.names['ts_dim'],
+                    self.names['category_dim'],
+                    self.names['z_dim'],
+                    self.names['y_dim'],
+                    self.names['x_dim'])
+            emisvar = self.outfile.createVariable(specname, 'f4', dims, fill_value=self.undef,
+                                                  **self.storage_options(dims))
             emisvar.long_name = specname
             emisvar.units = 'moles/s for gases and g/s for aerosols'
             emisvar.var_desc = 'Model species ' + specname
@@ -682,10 +1003,10 @@ class NetCDFPointTimeDisaggregator(NetCDFWriter):
         if self.actions['create_spec_vars']:
             self.outvars = []
             for specid, specname in self.pspecies:
-                emisvar = self.outfile.createVariable(
-                    specname, 'f4', (self.names['t_dim'],
-                                     self.names['z_dim']),
-                    fill_value=self.undef)
+                dims = (self.names['t_dim'],
+                        self.names['z_dim'])
+                emisvar = self.outfile.createVariable(specname, 'f4', dims, fill_value=self.undef,
+                                                      **self.storage_options(dims))
                 emisvar.long_name = specname
                 emisvar.units = self.names['emission_units']
                 emisvar.var_desc = 'Model species ' + specname
@@ -787,12 +1108,12 @@ class NetCDF3DTimeDisaggregator(NetCDFWriter):
         if self.actions['create_spec_vars']:
             self.outvars = []
             for specname in species:
-                emisvar = self.outfile.createVariable(
-                    specname, 'f4', (self.names['t_dim'],
-                                     self.names['z_dim'],
-                                     self.names['y_dim'],
-                                     self.names['x_dim']),
-                    fill_value=float(undef))
+                dims = (self.names['t_dim'],
+                        self.names['z_dim'],
+                        self.names['y_dim'],
+                        self.names['x_dim'])
+                emisvar = self.outfile.createVariable(specname, 'f4', dims, fill_value=float(undef),
+                                                      **self.storage_options(dims))
                 emisvar.long_name = specname
                 emisvar.units = self.names['emission_units']
                 emisvar.var_desc = 'Model species ' + specname
@@ -0,0 +1,90 @@
+"""
+Description: persistent on-disk cache of the small metadata packs of a data provider
+(species, categories, time shifts, ...), invalidated by a fingerprint of the case data
+"""
+
+"""
+This file is part of the FUME emission model.
+
+FUME is free software: you can redistribute it and/or modify it under the terms of the GNU General
+Public License as published by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+FUME is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+Information and source code can be obtained at www.fume-ep.org
+
+Copyright 2014-2023 Institute of Computer Science of the Czech Academy of Sciences, Prague, Czech Republic
+Copyright 2014-2023 Charles University, Faculty of Mathematics and Physics, Prague, Czech Republic
+Copyright 2014-2023 Czech Hydrometeorological Institute, Prague, Czech Republic
+Copyright 2014-2017 Czech Technical University in Prague, Czech Republic
+"""
+
+import os
+import pickle
+import threading
+import lib.ep_logging
+log = lib.ep_logging.Logger(__name__)
+
+
+class PackCache():
+    """
+    Cache of pack data stored in a single pickle file.
+
+    The file holds the fingerprint of the data it was created from (any picklable
+    value, typically row counts and maximum ids of the database tables the packs
+    are read from). If the fingerprint of the current data differs, the cached
+    packs are discarded and fetched again.
+    """
+
+    def __init__(self, filename, fingerprint):
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self.lock = threading.Lock()
+        self.packs = {}
+
+        try:
+            with open(filename, 'rb') as f:
+                content = pickle.load(f)
+        except FileNotFoundError:
+            log.debug('Pack cache', filename, 'does not exist yet')
+            return
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            log.warning('Ignoring unreadable pack cache', filename, ':', e)
+            return
+
+        if content.get('fingerprint') == fingerprint:
+            self.packs = content['packs']
+            log.debug('Pack cache', filename, 'loaded with packs', list(self.packs))
+        else:
+            log.info('Case data changed, pack cache', filename, 'invalidated')
+
+    def get(self, name, fetch):
+        """
+        Return the cached data of pack name. If not cached, call the function
+        fetch to get them and save them in the cache.
+        """
+
+        with self.lock:
+            if name in self.packs:
+                log.debug('Pack', name, 'read from cache')
+                return self.packs[name]
+
+        value = fetch()
+        with self.lock:
+            self.packs[name] = value
+            self.save()
+        return value
+
+    def save(self):
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'wb') as f:
+            pickle.dump({'fingerprint': self.fingerprint, 'packs': self.packs}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, self.filename)
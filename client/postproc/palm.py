@@ -29,9 +29,63 @@ import numpy as np
 from netCDF4 import Dataset, date2num
 from postproc.receiver import DataReceiver, requires
 from postproc.netcdf import NetCDFAreaTimeDisaggregator, NetCDFTotalWriter
+from postproc.timedisagg import time_factor_tensor, disaggregate, lookup_index, chunk_columns
 import lib.ep_logging
 log = lib.ep_logging.Logger(__name__)
 
+
+def buildings_3d_from_2d(b2d, delz):
+    """
+    3D building mask [k, y, x] from the building heights buildings_2d: the
+    grid boxes from the ground up to the building height (rounded to delz)
+    are buildings, heights below delz/2 are not considered buildings.
+    """
+
+    maxk = math.floor(b2d.max() / delz) + 1
+    top = np.floor(b2d / delz + 0.5) + 1
+    mask = (np.arange(maxk)[:, np.newaxis, np.newaxis] < top) & (b2d >= delz*0.5)
+    return mask.astype(np.int8)
+
+
+def locate_levels_k(b3d, level, y, x):
+    """
+    k index of the volume sources on the given levels in the columns (y, x)
+    of the building mask b3d (1 building, 0 air, other values are ignored).
+
+    Level 0 is the top of the highest building of the column (or the ground
+    if there is none), the levels above 0 are the ground below the building
+    tops, which is found only if the column has no more than level separate
+    buildings and does not end with a building at the bottom (the ground
+    of courtyards under overhanging buildings etc.). The k index of the
+    ground is 0, k -1 means that the level was not found in the column.
+    """
+
+    building = b3d == 1
+    valid = building | (b3d == 0)
+    nk = b3d.shape[0]
+    kidx = np.arange(nk)[:, np.newaxis, np.newaxis]
+
+    # column properties: the highest building box, the number of separate
+    # buildings and whether the lowest box is air
+    has_building = building.any(axis=0)
+    top = nk - 1 - np.argmax(building[::-1], axis=0)
+    # the nearest valid box below each box (-1 for none)
+    below = np.maximum.accumulate(np.where(valid, kidx, -1), axis=0)
+    below = np.concatenate((np.full((1,)+below.shape[1:], -1), below[:-1]))
+    below_building = np.take_along_axis(building, np.maximum(below, 0), axis=0) & (below >= 0)
+    nbuildings = np.count_nonzero(building & ~below_building, axis=0)
+    lowest = np.argmax(valid, axis=0)
+    ground_air = np.take_along_axis(b3d, lowest[np.newaxis], axis=0)[0] == 0
+
+    level = np.asarray(level)
+    k = np.where(level == 0, np.where(has_building[y, x], top[y, x], 0),
+                 np.where(has_building[y, x] & ground_air[y, x] & (nbuildings[y, x] <= level), 0, -1))
+
+    missing = np.count_nonzero(k < 0)
+    if missing:
+        log.error(missing, 'volume source levels were not found in the buildings of their columns. Skipping.')
+    return k
+
 class PalmTotalAreaWriter(NetCDFTotalWriter):
     """
     Postprocessor class for writing NetCDF area emission file.
@@ -87,6 +141,9 @@ class PALMAreaTimeWriter(NetCDFAreaTimeDisaggregator):
     files. Requires a prior run of NetCDFTotalAreaWriter!*
     """
 
+    # PALM needs the whole simulation time in one file
+    shardable = False
+
     def setup(self, *args, **kwargs):
         """
         Run NetCDF setup with PALM-specific overrides:
@@ -131,6 +188,23 @@ class PALMAreaTimeWriter(NetCDFAreaTimeDisaggregator):
         self.species_lookup = {member[0]: idx for idx, member in enumerate(self.species)}
         self.create_2d_emiss_file_struct()
 
+    def receive_grid_geometry(self, geometry):
+        """
+        Save the geographic coordinates of the grid cell centres (variables lon, lat)
+        """
+
+        self.lon = self.outfile.createVariable('lon', 'f4', ('y', 'x'))
+        self.lon.long_name = 'longitude'
+        self.lon.standard_name = 'longitude'
+        self.lon.units = 'degrees_east'
+        self.lon[:] = geometry.lon
+
+        self.lat = self.outfile.createVariable('lat', 'f4', ('y', 'x'))
+        self.lat.long_name = 'latitude'
+        self.lat.standard_name = 'latitude'
+        self.lat.units = 'degrees_north'
+        self.lat[:] = geometry.lat
+
     def receive_point_species(self, pspecies):
         self.pspecies = pspecies
 
@@ -179,27 +253,21 @@ class PALMAreaTimeWriter(NetCDFAreaTimeDisaggregator):
         # calculate and fill out temporarily disaggregated emission
         self.infile = Dataset(self.cfg.postproc.palmwriter.totalfile, "r")
 
-        for time_idx, stepdt in enumerate(self.rt_cfg['run']['datestimes']):
-            log.debug('Time step area sources', time_idx, stepdt.replace(tzinfo=None))
-            for spec_idx, (specid, specname) in enumerate(self.species):
-                for ts_id in self.ts:
-                    ts_idx = self.ts_lookup[ts_id]
-                    for cat_idx, (catid, catname) in enumerate(self.categories):
-                        dtutc = self.time_shifts[(ts_id, stepdt)]
-                        tf = self.time_factors[dtutc]
-                        try:
-                            time_factor = float(tf[catid])
-                        except KeyError:
-                            continue
-
-                        # write emisssion flux for base surface emissions (level = 0 -> z = 0)
-                        # gas phase species needs to convert to weight units from molar for PALM!
-                        # palm needs flux per m2 - normalize by 1/grid_area
-                        # remark: self.infile.variables[specname] is indexed from 0 despite of dimension values!!
-                        #         level index 0 thus means level value -1 (2d emission)
-                        self.emisvar[time_idx, 0, :, :, spec_idx] += \
-                            self.infile.variables[specname][ts_idx, cat_idx, 0, :, :].filled(fill_value=float(0.0)) * \
-                            time_factor * self.molar_weight[(catid,specid)] * self.norm_coef
+        cat_ids = [c[0] for c in self.categories]
+        factors = time_factor_tensor(self.rt_cfg['run']['datestimes'], self.time_shifts, self.time_factors,
+                                     self.ts, cat_ids)
+        time_chunk = self.cfg.postproc.netcdfwriter.time_chunk
+        for spec_idx, (specid, specname) in enumerate(self.species):
+            log.debug('Time disaggregation of area sources of species', specname)
+            # write emisssion flux for base surface emissions (level = 0 -> z = 0)
+            # gas phase species needs to convert to weight units from molar for PALM!
+            # palm needs flux per m2 - normalize by 1/grid_area
+            # remark: self.infile.variables[specname] is indexed from 0 despite of dimension values!!
+            #         level index 0 thus means level value -1 (2d emission)
+            weights = np.array([self.molar_weight.get((catid, specid), 0) for catid in cat_ids]) * self.norm_coef
+            totals = self.infile.variables[specname][:, :, 0, :, :].filled(fill_value=float(0.0))
+            for start, values in disaggregate(totals, factors*weights, time_chunk):
+                self.emisvar[start:start+values.shape[0], 0, :, :, spec_idx] += values
 
         # close files
         self.infile.close()
@@ -286,6 +354,9 @@ class PALMVsrcTimeWriter(NetCDFAreaTimeDisaggregator):
     files. Requires a prior run of PalmTotalAreaWriter!*
     """
 
+    # PALM needs the whole simulation time in one file
+    shardable = False
+
     def setup(self, *args, **kwargs):
         """
         Run NetCDF setup with PALM-specific overrides:
@@ -373,14 +444,13 @@ class PALMVsrcTimeWriter(NetCDFAreaTimeDisaggregator):
     def receive_point_vsrc_by_species_category_and_level(self, data):
         try:
             self.point_vsrc_emiss
-        except:
+        except AttributeError:
             log.debug('Create list point_vsrc_emiss')
             self.point_vsrc_emiss = []
-        # receive point_vsrc_emiss
+        # receive point_vsrc_emiss columns i, j, level, spec_id, cat_id, ts_id, height, emiss
         log.debug('Receive point_vsrc_emiss rows')
-        for row in data:
-            # i, j, level, spec_id, cat_id, ts_id, height, emiss
-            self.point_vsrc_emiss.append([row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7]])
+        if len(data):
+            self.point_vsrc_emiss.append(chunk_columns(data, 8))
 
 
     def finalize(self):
@@ -428,18 +498,7 @@ class PALMVsrcTimeWriter(NetCDFAreaTimeDisaggregator):
                 self.b3d = self.static_driver.variables['buildings_3d'][:].data
             except:
                 # build b3d from b2d
-                b2d = self.static_driver.variables['buildings_2d'][:].data
-                maxh = b2d.max()
-                maxk = math.floor(maxh / self.delz) + 1
-                self.b3d = np.zeros((maxk, np.shape(b2d)[0], np.shape(b2d)[1]), np.int8)
-                for i in range(np.shape(b2d)[1]):
-                    for j in range(np.shape(b2d)[0]):
-                        if b2d[j, i] >= self.delz*0.5:
-                            self.b3d[0:math.floor(b2d[j, i] / self.delz + 0.5)+1, j, i] = 1
-
-            # init ivsrc counter nad vsrc mapper
-            ivsrc = 0
-            vsrc_map_ijk = {}
+                self.b3d = buildings_3d_from_2d(self.static_driver.variables['buildings_2d'][:].data, self.delz)
 
             # process area vsrc from total emiss file
             # get list of non-zero value locations
@@ -451,98 +510,96 @@ class PALMVsrcTimeWriter(NetCDFAreaTimeDisaggregator):
             has_data = np.ones(dshape, dtype=bool)
             for specid, specname in self.species:
                 v = self.infile.variables[specname][:, :, startlevel:, :, :]
-                vmask = v.mask.min(axis=(0,1))
+                vmask = np.ma.getmaskarray(v).min(axis=(0,1))
                 has_data &= vmask
-            # invert values and transpose coordinates to x, y, level
-            has_data = ~has_data
-            # list coordinates of all filled values
-            for level, y, x in zip(*has_data.nonzero()):
-                self.vsrc_i[ivsrc] = x
-                self.vsrc_j[ivsrc] = y
-                # locate k index for given level
-                k = self.locate_level_k( self.b3d[:, y, x], level, y, x) + 1   # this will place volume source at the first grid above the ground in level
-                if k <= 0:
-                    continue
-                # locate terrain top heigh and k dimension
-                # !!! check with PALM procedure of terrain gridding !!!
-                self.vsrc_k[ivsrc] = k
-                # add key to mapping
-                vsrc_map_ijk[(x,y,k)] = ivsrc
-                level_idx = level + startlevel
-                log.fmt_debug('Found vsrc_k = {vsrc_k} for x,y,level,ivsrc = {x}, {y}, {level}, {ivsrc}.', \
-                              vsrc_k=self.vsrc_k[ivsrc], x=x, y=y, level=level, ivsrc=ivsrc)
-                for spec_idx, (specid, specname) in enumerate(self.species):
-                    invar = self.infile.variables[specname][:, :, level_idx, y, x]
-                    for cat_idx, (catid, catname) in enumerate(self.categories):
-                        # !!!HACK!!! PALM vsrc needs units in mol/m3/s for gases and kg/m3/s for PM
-                        # transform PM from g to kg, species in mol units leave unchanged
-                        # distinguish between gasses and PM by (molar weight == 1)
-                        # In future, the model-mechanism units needs to be added
-                        # into the mechanism configuration for every specie
-                        # !!!HACK!!!
-                        unit_fact = 1e-3 if (self.molar_weight[(catid,specid)]==1) else 1
-                        for ts_id in self.ts:
-                            ts_idx = self.ts_lookup[ts_id]
-                            v = invar[ts_idx, cat_idx]
-                            if np.ma.is_masked(v):
-                                continue
-                            for time_idx, stepdt in enumerate(self.rt_cfg['run']['datestimes']):
-                                dtutc = self.time_shifts[(ts_id, stepdt)]
-                                tf = self.time_factors[dtutc]
-                                try:
-                                    time_factor = float(tf[catid])
-                                except KeyError:
-                                    continue
-
-                                self.vsrc_value[spec_idx][time_idx, ivsrc] += v * time_factor * self.norm_coef * unit_fact
-                # increase vsrc counter
-                ivsrc += 1
-            # close infile
-            self.infile.close()
+            # invert values and list coordinates of all filled values
+            level, y, x = (~has_data).nonzero()
+            # locate k index for given level, this will place volume source at the first grid above the ground in level
+            k = locate_levels_k(self.b3d, level, y, x) + 1
+            found = k > 0
+            level, y, x, k = level[found], y[found], x[found], k[found]
+            nvsrc_area = len(k)
+            log.debug('Found', nvsrc_area, 'area volume sources')
 
             # process point sources
-            process_ps = True
+            # i,j start from 1 in database and from 0 in netcdf
             try:
-                self.point_vsrc_emiss
-            except:
-                process_ps = False
-                pass
-            if process_ps:
-                for row in self.point_vsrc_emiss:
-                    # row = [i, j, level, spec_id, cat_id, ts_id, height, emiss]
-                    # i,j start from 1 in database and from 0 in netcdf
-                    i = row[0]-1
-                    j = row[1]-1
-                    # locate k index for given level
-                    k = self.locate_level_k(self.b3d[:, j, i], row[2], j, i)
-                    # calculate k according height of point source
-                    # ensure it is higher then building
-                    k = max(math.floor(row[6]/self.cfg.domain.delz), k) + 1
-                    # check if i,j,k already exists in vsrc file
-                    try:
-                        jvsrc = vsrc_map_ijk[(i,j,k)]
-                    except:
-                        jvsrc = ivsrc
-                        vsrc_map_ijk[(i, j, k)] = ivsrc
-                        ivsrc += 1
-                        self.vsrc_i[jvsrc] = i
-                        self.vsrc_j[jvsrc] = j
-                        self.vsrc_k[jvsrc] = k
-                    # for ispec in range(len(self.species_lookup)):
-                    cat_id = row[4]
-                    spec_id = row[3]
-                    unit_fact = 1e-3 if (self.molar_weight[(cat_id, spec_id)] == 1) else 1
-                    for ts_id in self.ts:
-                        # ts_idx = self.ts_lookup[ts_id]
-                        for time_idx, stepdt in enumerate(self.rt_cfg['run']['datestimes']):
-                            dtutc = self.time_shifts[(ts_id, stepdt)]
-                            tf = self.time_factors[dtutc]
-                            try:
-                                time_factor = float(tf[row[4]])
-                            except KeyError:
-                                continue
-                            spec_idx = self.species_lookup[row[3]]
-                            self.vsrc_value[spec_idx][time_idx, jvsrc] += row[7] * time_factor * self.norm_coef * unit_fact
+                i, j, plevel, pspec, pcat, pts, height, pemiss = \
+                    [np.concatenate(c) for c in zip(*self.point_vsrc_emiss)]
+            except (AttributeError, ValueError):
+                i, j, plevel, pspec, pcat, pts, height, pemiss = [np.zeros(0) for c in range(8)]
+            # the rows come unordered from the database, sort them by i, j, level, species,
+            # category, time shift and height to number the new volume sources deterministically
+            order = np.lexsort((height, pts, pcat, pspec, plevel, j, i))
+            i, j, plevel, pspec, pcat, pts, height, pemiss = \
+                [c[order] for c in (i, j, plevel, pspec, pcat, pts, height, pemiss)]
+            i = i.astype(int) - 1
+            j = j.astype(int) - 1
+            # locate k index for given level
+            pk = locate_levels_k(self.b3d, plevel.astype(int), j, i) if len(i) else np.zeros(0, dtype=int)
+            # calculate k according height of point source
+            # ensure it is higher then building
+            pk = np.maximum(np.floor(height/self.cfg.domain.delz).astype(int), pk) + 1
+
+            # point sources share the volume source with the same i,j,k
+            # (the last one of the area volume sources), the others are added
+            # after the area volume sources in the order of appearance
+            vsrc_map_ijk = dict(zip(zip(x.tolist(), y.tolist(), k.tolist()), range(nvsrc_area)))
+            pvsrc = np.empty(len(pk), dtype=int)
+            new_i, new_j, new_k = [], [], []
+            for row, key in enumerate(zip(i.tolist(), j.tolist(), pk.tolist())):
+                try:
+                    pvsrc[row] = vsrc_map_ijk[key]
+                except KeyError:
+                    pvsrc[row] = vsrc_map_ijk[key] = nvsrc_area + len(new_i)
+                    new_i.append(key[0])
+                    new_j.append(key[1])
+                    new_k.append(key[2])
+            nvsrc = nvsrc_area + len(new_i)
+
+            # write all volume sources at once
+            self.vsrc_i[:nvsrc] = np.concatenate((x, new_i)).astype('i4')
+            self.vsrc_j[:nvsrc] = np.concatenate((y, new_j)).astype('i4')
+            self.vsrc_k[:nvsrc] = np.concatenate((k, new_k)).astype('i4')
+
+            # time disaggregation factors [time, ts, cat]
+            datestimes = self.rt_cfg['run']['datestimes']
+            cat_ids = [c[0] for c in self.categories]
+            factors = time_factor_tensor(datestimes, self.time_shifts, self.time_factors, self.ts, cat_ids)
+            # point sources: the factors of all time shifts are applied
+            pcat_ids = list(dict.fromkeys(pcat.astype(int).tolist()))
+            pcat_idx = lookup_index(pcat_ids, pcat.astype(int))[0]
+            pfactors = time_factor_tensor(datestimes, self.time_shifts, self.time_factors,
+                                          self.ts, pcat_ids).sum(axis=1)
+            pspec_idx = np.array([self.species_lookup[s] for s in pspec.astype(int).tolist()], dtype=int)
+            time_chunk = self.cfg.postproc.netcdfwriter.time_chunk
+
+            for spec_idx, (specid, specname) in enumerate(self.species):
+                log.debug('Time disaggregation of volume sources of species', specname)
+                # !!!HACK!!! PALM vsrc needs units in mol/m3/s for gases and kg/m3/s for PM
+                # transform PM from g to kg, species in mol units leave unchanged
+                # distinguish between gasses and PM by (molar weight == 1)
+                # In future, the model-mechanism units needs to be added
+                # into the mechanism configuration for every specie
+                # !!!HACK!!!
+                unit_fact = np.array([1e-3 if self.molar_weight.get((catid, specid)) == 1 else 1
+                                      for catid in cat_ids])
+                totals = self.infile.variables[specname][:, :, startlevel:, :, :][:, :, level, y, x]
+                totals = np.ma.filled(totals, fill_value=0)
+
+                rows = pspec_idx == spec_idx
+                pweights = pemiss[rows] * self.norm_coef * \
+                    np.array([1e-3 if self.molar_weight.get((catid, specid)) == 1 else 1
+                              for catid in pcat[rows].astype(int).tolist()])
+
+                for start, values in disaggregate(totals, factors*unit_fact*self.norm_coef, time_chunk):
+                    chunk = np.zeros((values.shape[0], nvsrc))
+                    chunk[:, :nvsrc_area] = values
+                    np.add.at(chunk, (slice(None), pvsrc[rows]),
+                              pfactors[start:start+values.shape[0]][:, pcat_idx[rows]] * pweights)
+                    self.vsrc_value[spec_idx][start:start+values.shape[0], :nvsrc] = chunk
+            # close infile
+            self.infile.close()
 
         # close out file
         self.outfile.close()
@@ -602,48 +659,3 @@ class PALMVsrcTimeWriter(NetCDFAreaTimeDisaggregator):
         except Exception as ex:
             log.debug('Check configuration parameters casename and grid_name.')
             log.debug(ex)
-
-    def locate_level_k(self, b, level, y, x):
-        # locate k index for level = 0
-        ka = np.where(b == 1)[0]
-        if ka.size == 0:
-            if level == 0:
-                k = 0
-            else:
-                log.fmt_error('No building found in x,y,level = {x}, {y}, {level}. Skipping.', x=x, y=y, level=level)
-                return -1
-        else:
-            k = ka.max()
-        if level > 0:
-            # locate k for level>0
-            b = b[:k + 1]
-            found = False
-            for l in range(1, level + 1):  # levels from 1 to level
-                # next top of air
-                ka = np.where(b == 0)[0]
-                if ka.size == 0:
-                    log.fmt_error('Only level {l} (building) found in x,y,level = {x}, {y}, {level}. Skipping.', l=l,
-                                  x=x, y=y, level=level)
-                    return -1
-
-                k = ka.max()
-                b = b[:k + 1]
-                # next top of building
-                ka = np.where(b == 1)[0]
-                if ka.size == 0:
-                    if l < level:
-                        log.fmt_error('Only level {l} (ground) found in x,y,level = {x}, {y}, {level}. Skipping.', l=l,
-                                      x=x, y=y, level=level)
-                    else:
-                        # reached ground
-                        k = 0
-                        found = True
-                else:
-                    # shrink to next top of the building
-                    k = ka.max()
-                    b = b[:k + 1]
-            if not found:
-                # k for level not found, do not process point
-                return -1
-        # return value k
-        return k
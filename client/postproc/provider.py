@@ -26,44 +26,137 @@ Copyright 2014-2017 Czech Technical University in Prague, Czech Republic
 
 from abc import ABCMeta
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+from lib.ep_libutil import ep_newconnection
 import lib.ep_logging
 log = lib.ep_logging.Logger(__name__)
 
 def pack(name):
     """
     Decorator for the DataProvider classes registers given method as a pack
-    hook.
+    hook. Calls of the hook are serialized by a per-instance lock of the pack,
+    so that the hook (typically caching its result) runs only once even if
+    called from several packs running in parallel.
     """
     def f_wrap(f):
-        def f_wrapped(*args, **kwargs):
-            return f(*args, **kwargs)
+        def f_wrapped(self, *args, **kwargs):
+            with self.pack_locks[name]:
+                return f(self, *args, **kwargs)
 
         f_wrapped._pack = name
         return f_wrapped
     return f_wrap
 
-pack_hooks = {}
+
+def prefetch(iterable, depth):
+    """
+    Generator of the items of iterable computed in a background thread.
+    At most depth items are kept ready in a bounded queue, so the producer
+    (e.g. fetching time steps from the database) runs ahead of the consumer
+    (distributing them to the receivers) by at most depth items. Exceptions
+    of the producer are re-raised in the consumer.
+    """
+
+    items = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        it = iter(iterable)
+        try:
+            for item in it:
+                if not put(('item', item)):
+                    break
+            else:
+                put(('end', None))
+        except Exception as e:
+            put(('error', e))
+        finally:
+            if hasattr(it, 'close'):
+                it.close()
+
+    producer = threading.Thread(target=produce, name='prefetch', daemon=True)
+    producer.start()
+    try:
+        while True:
+            kind, item = items.get()
+            if kind == 'end':
+                break
+            if kind == 'error':
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
 
 class DataProviderMeta(ABCMeta):
     """
-    Upon class instantiation, go through the methods and find out which ones have
-    a _pack attribute and save that function as a pack hook in the 'pack_hooks' database.
-    Each pack can have one hook.
+    Upon class creation, go through the methods and find out which ones have
+    a _pack attribute and save their names as pack hooks in the pack_hooks
+    class attribute (pack name -> method name), together with the hooks
+    inherited from the base classes. Each pack can have one hook per class.
     """
     def __new__(cls, name, bases, dct):
         inst = super().__new__(cls, name, bases, dct)
-        rank = 0
+        hooks = {}
+        for base in reversed(inst.__mro__[1:]):
+            hooks.update(getattr(base, 'pack_hooks', {}))
+
+        own_hooks = {}
         for n, o in dct.items():
             if callable(o) and hasattr(o, '_pack'):
-                if o._pack in pack_hooks:
+                if o._pack in own_hooks:
                     raise ValueError('Hook already defined for pack {}'.format(o._pack))
 
-                pack_hooks[o._pack] = {'name': n, 'ran': False}
-                rank += 1
+                own_hooks[o._pack] = n
 
+        hooks.update(own_hooks)
+        inst.pack_hooks = hooks
         return inst
 
 
+class ReceiverWorker(threading.Thread):
+    """
+    Worker thread delivering the packs to one receiver in concurrent mode.
+    The packs are queued in a bounded FIFO queue, so the receiver gets them
+    in the order they were distributed and a slow receiver blocks
+    the provider once its queue is full. After an exception in the receiver,
+    the rest of the queue is discarded and the exception is kept in self.error.
+    """
+
+    def __init__(self, receiver, queue_size):
+        super().__init__(name='receiver-{}'.format(type(receiver).__name__), daemon=True)
+        self.receiver = receiver
+        self.queue = queue.Queue(queue_size)
+        self.error = None
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+
+            fun, args, kwargs = item
+            try:
+                fun(*args, **kwargs)
+            except Exception as e:
+                log.error('Receiver', type(self.receiver).__name__, 'failed:', e)
+                self.error = e
+
+
 class DataProvider(metaclass=DataProviderMeta):
     """
     Base class for data providers
@@ -71,6 +164,11 @@ class DataProvider(metaclass=DataProviderMeta):
 
     def __init__(self, *args, **kwargs):
         self.receivers = defaultdict(list)
+        self.receiver_locks = {}
+        self.workers = {}
+        self.pack_locks = {p: threading.RLock() for p in self.pack_hooks}
+        self.local = threading.local()
+        self.db = None
 
         if 'cfg' in kwargs:
             self.cfg = kwargs['cfg']
@@ -81,6 +179,19 @@ class DataProvider(metaclass=DataProviderMeta):
         if 'db' in kwargs:
             self.db = kwargs['db']
 
+    @property
+    def db(self):
+        """
+        Database connection of the current thread: the pooled connection
+        of a pack running in parallel (see run_parallel), the main connection
+        otherwise.
+        """
+        return getattr(self.local, 'db', None) or self.main_db
+
+    @db.setter
+    def db(self, value):
+        self.main_db = value
+
     def register_receiver(self, receiver):
         """
         Register a receiver object, typically through the dispatch.run function
@@ -88,56 +199,206 @@ class DataProvider(metaclass=DataProviderMeta):
         If a receive_<pack_name> method exists in the object, the object is
         registered as a receiver.
         """
-        log.debug('*** Pack hooks', pack_hooks)
-        for pack in pack_hooks:
+        log.debug('*** Pack hooks', self.pack_hooks)
+        for pack in self.pack_hooks:
             rcv_fun = 'receive_{pack}'.format(pack=pack)
             if hasattr(receiver, rcv_fun):
                 rcv_fun_obj = getattr(receiver, rcv_fun)
                 if callable(rcv_fun_obj):
                     self.receivers[pack].append(receiver)
+                    self.receiver_locks[receiver] = threading.Lock()
 
     def distribute(self, pack, *args, **kwargs):
         """
         Send the data for a given pack to all registered receivers.
         Must be called explicitely by a pack hook method in a data provider
         class.
+
+        In concurrent mode the data are queued for the worker threads
+        of the receivers instead. Packs running in parallel never call
+        the same receiver at the same time.
         """
         for r in self.receivers[pack]:
-            getattr(r, 'receive_{pack}'.format(pack=pack))(*args, **kwargs)
+            rcv_fun_obj = getattr(r, 'receive_{pack}'.format(pack=pack))
+            if r in self.workers:
+                worker = self.workers[r]
+                if worker.error is not None:
+                    raise worker.error
+                worker.queue.put((rcv_fun_obj, args, kwargs))
+            else:
+                with self.receiver_locks[r]:
+                    rcv_fun_obj(*args, **kwargs)
+
+    def start_workers(self, receivers, queue_size):
+        """
+        Start a worker thread for each receiver (concurrent mode).
+        """
+        for r in receivers:
+            self.workers[r] = ReceiverWorker(r, queue_size)
+            self.workers[r].start()
+
+    def stop_workers(self):
+        """
+        Wait until the workers have processed all queued packs and stop them.
+        Re-raise the first exception of a receiver if any.
+        """
+        for worker in self.workers.values():
+            worker.queue.put(None)
+        for worker in self.workers.values():
+            worker.join()
+
+        errors = [w.error for w in self.workers.values() if w.error is not None]
+        self.workers = {}
+        if errors:
+            raise errors[0]
+
+    def pack_dependencies(self, pack):
+        """
+        Return the list of packs required (see receiver.requires) by the receivers
+        of a given pack. Required packs without any receivers are left out,
+        as they are never run.
+        """
+        deps = []
+        for r in self.receivers[pack]:
+            rcv_fun_obj = getattr(r, 'receive_{pack}'.format(pack=pack))
+            for p in getattr(rcv_fun_obj, '_requires', ()):
+                if p not in self.pack_hooks:
+                    raise ValueError('Unknown pack {} required by {}.receive_{}'
+                                     .format(p, type(r).__name__, pack))
+                if len(self.receivers[p]) > 0 and p not in deps:
+                    deps.append(p)
+        return deps
+
+    def execution_plan(self, parallel=False):
+        """
+        Resolve the dependency graph of the packs with registered receivers
+        and return the execution plan as a list of stages, each stage being
+        a list of packs.
+
+        The sequential plan has one pack per stage, in the order of the pack
+        hooks declaration with the required packs run first. In the parallel
+        plan each stage contains the packs whose required packs all belong
+        to the previous stages, the packs of one stage can run concurrently.
+        """
+        order = []
+        visiting = []
+
+        def visit(pack):
+            if pack in order:
+                return
+            if pack in visiting:
+                raise ValueError('Cyclic dependency between packs: {}'
+                                 .format(' -> '.join(visiting[visiting.index(pack):] + [pack])))
+            visiting.append(pack)
+            for p in self.pack_dependencies(pack):
+                visit(p)
+            visiting.pop()
+            order.append(pack)
+
+        for pack in self.pack_hooks:
+            if len(self.receivers[pack]) > 0:
+                visit(pack)
+
+        if not parallel:
+            return [[pack] for pack in order]
+
+        level = {}
+        for pack in order:
+            level[pack] = 1 + max((level[p] for p in self.pack_dependencies(pack)), default=-1)
+
+        stages = [[] for l in range(max(level.values(), default=-1)+1)]
+        for pack in order:
+            stages[level[pack]].append(pack)
+        return stages
 
     def _run_hook(self, pack):
         """
-        Run a pack hook method for an invoked pack if any receivers are registered
-        for a given pack, potentially resolving dependencies between packs if
-        defined by a receiver method.
-        """
-        log.debug('*** Running pack hook', pack)
-        met = pack_hooks[pack]
-        met_obj = getattr(self, met['name'])
-        if met['ran']:
-            log.debug('*** Pack', pack,'already ran, skipping...')
-            return
-
-        if len(self.receivers[pack]) > 0:
-            log.debug('*** Running pack hook', pack, len(self.receivers[pack]))
-            for r in self.receivers[pack]:
-                rcv_fun_obj = getattr(r, 'receive_{pack}'.format(pack=pack))
-                if hasattr(rcv_fun_obj, '_requires'):
-                    for p in rcv_fun_obj._requires:
-                        log.debug('*** Resolving dependency ', p)
-                        self._run_hook(p)
-
-            met_obj()
-            met['ran'] = True
+        Run the pack hook method of a given pack.
+        """
+        log.debug('*** Running pack hook', pack, len(self.receivers[pack]))
+        getattr(self, self.pack_hooks[pack])()
+
+    def _run_hook_pooled(self, pack, connections):
+        """
+        Run the pack hook method of a given pack in a worker thread
+        with a connection from the pool of connections.
+        """
+        try:
+            db = connections.get_nowait()
+        except queue.Empty:
+            db = ep_newconnection()
+
+        self.local.db = db
+        try:
+            self._run_hook(pack)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            self.local.db = None
+            connections.put(db)
+
+    def run_parallel(self, plan, num_workers):
+        """
+        Run the stages of the execution plan one after another, the packs
+        of one stage concurrently in at most num_workers threads, each pack
+        with its own database connection. Pending changes of the main
+        connection are committed first to make them visible to the pooled
+        connections.
+        """
+        self.db.commit()
+        connections = queue.Queue()
+        try:
+            with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='pack') as executor:
+                for stage in plan:
+                    if len(stage) == 1:
+                        self._run_hook(stage[0])
+                        continue
+
+                    log.debug('*** Running packs in parallel:', stage)
+                    futures = [executor.submit(self._run_hook_pooled, pack, connections)
+                               for pack in stage]
+                    for f in futures:
+                        f.result()
+        finally:
+            while not connections.empty():
+                connections.get().close()
 
     def run(self):
+        """
+        Set up the receivers, run all pack hooks and finalize the receivers.
+
+        The packs are run according to the execution plan. If postproc.parallel_packs
+        is greater than one, independent packs run concurrently (see run_parallel).
+        If postproc.concurrent is set, the receivers get the packs in their
+        own threads (see ReceiverWorker), with at most postproc.queue_size
+        packs waiting for each receiver. The setup and finalize methods are
+        always called from the main thread, finalize only after all receivers
+        have processed all their packs.
+        """
+        num_workers = self.cfg.postproc.parallel_packs
+        plan = self.execution_plan(parallel=num_workers > 1)
+        log.debug('*** Execution plan:', plan)
+
         receivers = set([r for p in self.receivers.values() for r in p])
         for r in receivers:
             if hasattr(r, 'setup') and callable(r.setup):
                 r.setup()
 
-        for pack in pack_hooks:
-            self._run_hook(pack)
+        if self.cfg.postproc.concurrent:
+            log.debug('*** Distributing packs concurrently to', len(receivers), 'receivers')
+            self.start_workers(receivers, self.cfg.postproc.queue_size)
+
+        try:
+            if num_workers > 1:
+                self.run_parallel(plan, num_workers)
+            else:
+                for stage in plan:
+                    for pack in stage:
+                        self._run_hook(pack)
+        finally:
+            self.stop_workers()
 
         for r in receivers:
             if hasattr(r, 'finalize') and callable(r.finalize):
@@ -47,8 +47,15 @@ def requires(*names):
 class DataReceiver():
     """
     Base class for data receivers
+
+    Receivers writing all their output in finalize from the received packs
+    (time writers based on the total files) can set the class attribute
+    shardable to allow splitting their output into files by day or month
+    (see postproc.sharding).
     """
 
+    shardable = False
+
     def __init__(self, *args, **kwargs):
         if 'cfg' in kwargs:
             self.cfg = kwargs['cfg']
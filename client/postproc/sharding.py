@@ -0,0 +1,142 @@
+"""
+Description: splitting the output of the time writers into files by day or month
+    - ShardedReceiver: stand-in for a shardable receiver, writes the shards in worker processes
+    - shard_datestimes, shard_filename: helper functions
+"""
+
+"""
+This file is part of the FUME emission model.
+
+FUME is free software: you can redistribute it and/or modify it under the terms of the GNU General
+Public License as published by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+FUME is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+Information and source code can be obtained at www.fume-ep.org
+
+Copyright 2014-2023 Institute of Computer Science of the Czech Academy of Sciences, Prague, Czech Republic
+Copyright 2014-2023 Charles University, Faculty of Mathematics and Physics, Prague, Czech Republic
+Copyright 2014-2023 Czech Hydrometeorological Institute, Prague, Czech Republic
+Copyright 2014-2017 Czech Technical University in Prague, Czech Republic
+"""
+
+import os
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from postproc.receiver import DataReceiver
+import lib.ep_logging
+log = lib.ep_logging.Logger(__name__)
+
+shard_formats = {
+    'day': '%Y%m%d',
+    'month': '%Y%m',
+    'year': '%Y',
+}
+
+
+def shard_datestimes(datestimes, mode):
+    """
+    Split the list of output times into lists of consecutive times of the same
+    day, month or year (mode 'day', 'month' or 'year') in the output time zone.
+    """
+
+    if mode == 'day':
+        key = lambda dt: dt.date()
+    elif mode == 'year':
+        key = lambda dt: dt.year
+    else:
+        key = lambda dt: (dt.year, dt.month)
+
+    return [list(g) for k, g in itertools.groupby(datestimes, key=key)]
+
+
+def shard_filename(filename, first, mode):
+    """
+    Output file name of the shard beginning with the time first. If filename
+    contains strftime directives (e.g. emis_%Y%m%d.nc), they are replaced,
+    otherwise the date of the shard is appended to the file name (emis_20190101.nc).
+    """
+
+    if '%' in filename:
+        return first.strftime(filename)
+
+    root, ext = os.path.splitext(filename)
+    return '{}_{}{}'.format(root, first.strftime(shard_formats[mode]), ext)
+
+
+# receiver class, configuration and received packs of the writer process,
+# set by the pool initializer
+_shard_state = None
+
+
+def _init_shard_worker(receiver_class, cfg, rt_cfg, calls):
+    global _shard_state
+    _shard_state = (receiver_class, cfg, rt_cfg, calls)
+
+
+def _write_shard(datestimes):
+    """
+    Write one shard in a worker process: create a new receiver for the
+    shard's output times, replay the received packs and finalize it.
+    """
+
+    receiver_class, cfg, rt_cfg, calls = _shard_state
+    shard_rt_cfg = dict(rt_cfg)
+    shard_rt_cfg['run'] = dict(rt_cfg['run'], datestimes=datestimes, shard=cfg.postproc.sharding)
+    receiver = receiver_class(cfg=cfg, rt_cfg=shard_rt_cfg)
+    receiver.setup()
+    for name, args, kwargs in calls:
+        getattr(receiver, name)(*args, **kwargs)
+    receiver.finalize()
+    return datestimes[0], len(datestimes)
+
+
+class ShardedReceiver(DataReceiver):
+    """
+    Stand-in for a receiver class writing its output in finalize only
+    (class attribute shardable = True), registered by the dispatcher instead
+    of the receiver when postproc.sharding is 'day' or 'month'.
+
+    The received packs are only stored. In finalize, the output times are
+    split into days or months and for each of them a new receiver object is
+    created in a worker process (postproc.shard_workers processes), gets
+    the stored packs and writes its own file with the time metadata of the
+    shard (see shard_filename).
+    """
+
+    def __init__(self, receiver_class, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.receiver_class = receiver_class
+        self.calls = []
+
+    def __getattr__(self, name):
+        if not name.startswith('receive_'):
+            raise AttributeError(name)
+        rcv_fun_obj = getattr(self.receiver_class, name)
+
+        def store(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+
+        store._requires = getattr(rcv_fun_obj, '_requires', ())
+        return store
+
+    def setup(self):
+        pass
+
+    def finalize(self):
+        # only the output times and the projection are used by the time writers,
+        # the rest of the run time configuration (database connection etc.) stays here
+        rt_cfg = {'run': {'datestimes': self.rt_cfg['run']['datestimes']},
+                  'projection_params': self.rt_cfg['projection_params']}
+        shards = shard_datestimes(rt_cfg['run']['datestimes'], self.cfg.postproc.sharding)
+        log.info('Writing', self.receiver_class.__name__, 'output in', len(shards), 'shards by',
+                 self.cfg.postproc.sharding)
+
+        with ProcessPoolExecutor(max_workers=self.cfg.postproc.shard_workers,
+                                 initializer=_init_shard_worker,
+                                 initargs=(self.receiver_class, self.cfg, rt_cfg, self.calls)) as executor:
+            for first, count in executor.map(_write_shard, shards):
+                log.debug('Shard', first, 'with', count, 'time steps written')
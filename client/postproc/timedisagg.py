@@ -0,0 +1,147 @@
+"""
+Description: helper functions for vectorized time disaggregation of emissions
+    - time_factor_tensor: dense [time, ts, cat] array of time disaggregation factors
+    - period_factor_tensor: time disaggregation factors summed over output periods
+    - lookup_index: vectorized mapping of database ids to array positions
+    - chunk_columns: column arrays of a chunk of rows distributed by a data provider
+"""
+
+"""
+This file is part of the FUME emission model.
+
+FUME is free software: you can redistribute it and/or modify it under the terms of the GNU General
+Public License as published by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+FUME is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+Information and source code can be obtained at www.fume-ep.org
+
+Copyright 2014-2023 Institute of Computer Science of the Czech Academy of Sciences, Prague, Czech Republic
+Copyright 2014-2023 Charles University, Faculty of Mathematics and Physics, Prague, Czech Republic
+Copyright 2014-2023 Czech Hydrometeorological Institute, Prague, Czech Republic
+Copyright 2014-2017 Czech Technical University in Prague, Czech Republic
+"""
+
+import numpy as np
+
+
+def time_factor_tensor(datestimes, time_shifts, time_factors, ts_ids, cat_ids):
+    """
+    Build a dense array of time disaggregation factors with dimensions
+    [time, ts, cat] for the output times datestimes, time shift ids ts_ids
+    and category ids cat_ids.
+
+    time_shifts is the (ts_id, time_out)->time_loc dictionary of the
+    time_shifts pack, time_factors the time_loc->{cat_id: factor} dictionary
+    of the time_factors pack. Missing combinations get the factor zero, the
+    same result as the inner joins in the database time series functions.
+    """
+
+    factors = np.zeros((len(datestimes), len(ts_ids), len(cat_ids)), dtype='f8')
+    for time_idx, stepdt in enumerate(datestimes):
+        for ts_idx, ts_id in enumerate(ts_ids):
+            try:
+                tf = time_factors[time_shifts[(ts_id, stepdt)]]
+            except KeyError:
+                continue
+            for cat_idx, cat_id in enumerate(cat_ids):
+                try:
+                    factors[time_idx, ts_idx, cat_idx] = float(tf[cat_id])
+                except KeyError:
+                    continue
+
+    return factors
+
+
+def period_factor_tensor(periods, time_shifts, time_factors, ts_ids, cat_ids):
+    """
+    Sums of the time disaggregation factors over output periods with dimensions
+    [period, ts, cat]. periods is a list of lists of output times (e.g. days or
+    months, see postproc.sharding.shard_datestimes), the other arguments are
+    the same as for time_factor_tensor.
+
+    The result equals time_factor_tensor summed over the times of each period,
+    but the factors of each local time are looked up only once and the factors
+    of the individual output times are never built for the whole run.
+    """
+
+    cat_pos = {cat_id: idx for idx, cat_id in enumerate(cat_ids)}
+    # dense factors of the local times used, row 0 for the missing ones
+    rows = [np.zeros(len(cat_ids), dtype='f8')]
+    loc_rows = {}
+    idx = []
+    for times in periods:
+        period_idx = np.zeros((len(times), len(ts_ids)), dtype=int)
+        for time_idx, stepdt in enumerate(times):
+            for ts_idx, ts_id in enumerate(ts_ids):
+                try:
+                    time_loc = time_shifts[(ts_id, stepdt)]
+                except KeyError:
+                    continue
+                if time_loc not in loc_rows:
+                    row = np.zeros(len(cat_ids), dtype='f8')
+                    for cat_id, factor in time_factors.get(time_loc, {}).items():
+                        if cat_id in cat_pos:
+                            row[cat_pos[cat_id]] = float(factor)
+                    loc_rows[time_loc] = len(rows)
+                    rows.append(row)
+                period_idx[time_idx, ts_idx] = loc_rows[time_loc]
+        idx.append(period_idx)
+
+    table = np.array(rows)
+    factors = np.zeros((len(periods), len(ts_ids), len(cat_ids)), dtype='f8')
+    for p, period_idx in enumerate(idx):
+        factors[p] = table[period_idx].sum(axis=0)
+
+    return factors
+
+
+def disaggregate(totals, factors, chunk_size):
+    """
+    Time disaggregation of the totals of one species with dimensions
+    [ts, cat, ...] by the factor array [time, ts, cat] (see time_factor_tensor).
+    Yields (start, values) pairs, values being the time series of the
+    emissions [time, ...] for at most chunk_size output times beginning with
+    the time index start.
+    """
+
+    for start in range(0, factors.shape[0], chunk_size):
+        yield start, np.tensordot(factors[start:start+chunk_size], totals, axes=([1, 2], [0, 1]))
+
+
+def lookup_index(keys, values):
+    """
+    Vectorized equivalent of [keys.index(v) for v in values].
+    Returns the array of positions of values in keys and a boolean mask
+    of the values found in keys (positions of values not found are 0).
+    """
+
+    keys = np.asarray(keys)
+    values = np.asarray(values)
+    if keys.size == 0:
+        return np.zeros(values.shape, dtype=int), np.zeros(values.shape, dtype=bool)
+
+    order = np.argsort(keys, kind='stable')
+    pos = np.searchsorted(keys, values, sorter=order)
+    idx = order[np.minimum(pos, keys.size-1)]
+    found = keys[idx] == values
+    idx[~found] = 0
+    return idx, found
+
+
+def chunk_columns(data, ncols):
+    """
+    Return the list of ncols column arrays of a chunk of rows as distributed
+    by the EmissProvider packs, either a list of row tuples (cursor transport)
+    or a NumPy structured array (binary COPY transport). Columns of row tuples
+    are converted to float64, the caller casts the id columns as needed.
+    """
+
+    if isinstance(data, np.ndarray) and data.dtype.names:
+        return [data[name] for name in data.dtype.names[:ncols]]
+
+    rows = np.array(data, dtype='f8').reshape((-1, ncols))
+    return [rows[:, c] for c in range(ncols)]
@@ -215,4 +215,4 @@ class WRFCHEM3DTimeWriter(NetCDF3DTimeDisaggregator):
         self.outfile.ISICE = np.int32(24)
         self.outfile.ISURBAN = np.int32(1)
         self.outfile.ISOILWATER = np.int32(14)
-        self.outfile.close()
+        self.close_outfile()
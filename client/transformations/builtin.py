@@ -22,8 +22,11 @@ Copyright 2014-2023 Czech Hydrometeorological Institute, Prague, Czech Republic
 Copyright 2014-2017 Czech Technical University in Prague, Czech Republic
 """
 
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from lib.db import Relation
 from lib.ep_config import ep_cfg
+from lib.ep_libutil import ep_newconnection
 from transformations.base import Transformation, OneToOneTransformation,\
                                  TwoToOneTransformation, \
                                  virtual
@@ -245,24 +248,55 @@ class IntersectTransformation(TwoToOneTransformation):
     Intersects input shapes with the assigned geometry sets and calculates
     the intersect coefficients.
     """
-    parameters = ['inrelation', 'inrelation2', 'outrelation', 'outsrid', 'normalize']
+    parameters = ['inrelation', 'inrelation2', 'outrelation', 'outsrid', 'normalize', 'executor']
 
-    def __init__(self, inrel1=None, inrel2=None, outrel=None, outsrid=None, normalize=True):
+    def __init__(self, inrel1=None, inrel2=None, outrel=None, outsrid=None, normalize=True, executor='sql'):
         super().__init__(inrel1=inrel1, inrel2=inrel2, outrel=outrel, outsrid=outsrid)
         self.has_coef = True
         self.normalize = normalize
+        # 'sql' - SQL function ep_intersection, 'tiled' - ep_intersection on tiles in parallel
+        # (see apply_tiled), 'client' - transformations.gridding.ClientIntersection
+        self.executor = executor
+        # parameters of the regular grid in inrelation2 (see ep_intersection), None for general geometries
+        self.grid = None
 
     def __str__(self):
         return 'Intersect: ' + str(self.inrelation) + ' # ' + str(self.inrelation2) + ' -> ' + str(self.outrelation)
 
     def apply(self):
-        cur = self.db_connection.cursor()
         self.outrelation.srid = self.outsrid
         self.outrelation.fields = list(set(self.inrelation.fields) | set(self.inrelation2.fields))
-        q = cur.mogrify(
+        if self.executor == 'client':
+            from transformations.gridding import ClientIntersection
+            log.debug('Intersect with client executor:', self)
+            ClientIntersection(self.db_connection, self.inrelation, self.inrelation2, self.outrelation,
+                               self.outsrid, self.normalize,
+                               workers=self.cfg.transformations.client_workers,
+                               chunksize=self.cfg.transformations.client_chunk).run()
+            return
+
+        if self.executor == 'tiled':
+            if not self.outrelation.temp:
+                return self.apply_tiled()
+            log.warning('Temporary table', self.outrelation.name, 'cannot be filled by tiles, intersecting at once')
+
+        cur = self.db_connection.cursor()
+        q = self.intersection_query(cur)
+        log.debug(q)
+        res = cur.execute(q)
+        log.sql_debug(self.db_connection)
+        return res
+
+    def intersection_query(self, cur, createtable=True, tile=None):
+        """
+        Call of the SQL function ep_intersection creating the output table
+        (createtable) and filling it with the intersections of the given tile
+        (see ep_intersection).
+        """
+        return cur.mogrify(
             'SELECT * FROM ep_intersection('
-            '%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s'
-            ')', [self.inrelation.schema,
+            '%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s::double precision[], '
+            '%s::double precision[])', [self.inrelation.schema,
                   self.inrelation.name,
                   '{'+','.join([i for i in self.inrelation.fields])+'}',
                   self.inrelation.coef,
@@ -274,12 +308,84 @@ class IntersectTransformation(TwoToOneTransformation):
                   self.outrelation.geom_field,
                   self.outrelation.coef,
                   self.normalize,
-                  True,  # FIXME
-                  self.outrelation.temp])
-        log.debug(q)
-        res = cur.execute(q)
+                  createtable,
+                  self.outrelation.temp,
+                  self.grid,
+                  tile])
+
+    def tiles(self, cur, n):
+        """
+        Split the geometries of inrelation2 into n x n tiles of equal size over
+        their extent by the centre of their bounding box, the same way as
+        ep_intersection does. Returns the tile arrays of ep_intersection
+        of the non-empty tiles.
+        """
+        cur.execute('SELECT srid FROM public.geometry_columns WHERE f_table_schema = %s AND f_table_name = %s',
+                    (self.inrelation2.schema, self.inrelation2.name))
+        geom = '"{}"'.format(self.inrelation2.geom_field)
+        if cur.fetchone()[0] != self.outsrid:
+            geom = 'ST_Transform({}, {})'.format(geom, self.outsrid)
+        table = '"{}"."{}"'.format(self.inrelation2.schema, self.inrelation2.name)
+
+        cur.execute('SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) '
+                    'FROM (SELECT ST_Extent({}) AS e FROM {}) AS t'.format(geom, table))
+        x0, y0, x1, y1 = cur.fetchone()
+        params = {'n': float(n), 'x0': x0, 'y0': y0, 'wx': (x1 - x0)/n, 'wy': (y1 - y0)/n}
+        cur.execute('SELECT tx, ty, ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) FROM ('
+                    'SELECT least(%(n)s - 1, greatest(0, floor(((ST_XMin(g) + ST_XMax(g)) / 2 - %(x0)s) / %(wx)s))) AS tx, '
+                    '       least(%(n)s - 1, greatest(0, floor(((ST_YMin(g) + ST_YMax(g)) / 2 - %(y0)s) / %(wy)s))) AS ty, '
+                    '       ST_Extent(g) AS e '
+                    'FROM (SELECT {} AS g FROM {}) AS t GROUP BY 1, 2) AS e ORDER BY 1, 2'.format(geom, table),
+                    params)
+        return [[params['n'], x0, y0, params['wx'], params['wy']] + list(row) for row in cur.fetchall()]
+
+    def intersect_tile(self, tile, connections):
+        """
+        Intersect one tile on a connection from the pool of connections.
+        """
+        try:
+            db = connections.get_nowait()
+        except queue.Empty:
+            db = ep_newconnection()
+
+        try:
+            with db.cursor() as cur:
+                cur.execute(self.intersection_query(cur, createtable=False, tile=tile))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            connections.put(db)
+
+    def apply_tiled(self):
+        """
+        Intersect the tiles of inrelation2 (transformations.tiles x transformations.tiles,
+        see tiles) in parallel in transformations.tile_workers threads, each with its own
+        database connection, into the same output table. Every pair of geometries is
+        intersected in exactly one tile with the whole geometries, so the result is
+        the same as the one of a single ep_intersection call.
+        """
+        cur = self.db_connection.cursor()
+        cur.execute(self.intersection_query(cur, tile=[]))
+        tiles = self.tiles(cur, self.cfg.transformations.tiles)
+        # the output table has to be visible to the connections of the tiles
+        self.db_connection.commit()
+        log.debug('Intersect', self, 'in', len(tiles), 'tiles')
+
+        connections = queue.Queue()
+        try:
+            with ThreadPoolExecutor(max_workers=self.cfg.transformations.tile_workers,
+                                    thread_name_prefix='tile') as executor:
+                futures = [executor.submit(self.intersect_tile, tile, connections) for tile in tiles]
+                for f in futures:
+                    f.result()
+        finally:
+            while not connections.empty():
+                connections.get().close()
+
+        cur.execute('ANALYZE "{}"."{}"'.format(self.outrelation.schema, self.outrelation.name))
         log.sql_debug(self.db_connection)
-        return res
 
     def cleanup(self):
         with self.db_connection.cursor() as cur:
@@ -292,19 +398,33 @@ class ToGridTransformation(IntersectTransformation):
     Usually run as the penultimate step in the transformation chain before
     SourcesToGridTransformation.
     """
-    def __init__(self, inrel=None, outrel=None, normalize=True, method='Area', mandatory=True):
+    def __init__(self, inrel=None, outrel=None, normalize=True, method='Area', mandatory=True, executor='sql'):
         self.method = method
         self.mandatory = mandatory
         self.case_schema = ep_cfg.db_connection.case_schema
         inrel2 = Relation(schema=self.case_schema, name='ep_grid_tz', fields=['grid_id'])
-        super().__init__(inrel1=inrel, inrel2=inrel2, outrel=outrel, normalize=normalize)
+        super().__init__(inrel1=inrel, inrel2=inrel2, outrel=outrel, normalize=normalize, executor=executor)
 
     def __str__(self):
         return 'ToGrid: ' + str(self.inrelation) + ' -> ' + str(self.outrelation) + ' -> ' + str(self.method)
 
+    def regular_grid(self):
+        """
+        Parameters of the case grid [nx, ny, xmin, ymin, dx, dy] if it is the regular
+        grid created by FUME from the domain configuration, None otherwise.
+        """
+        domain = self.cfg.domain
+        if not domain.create_grid or not self.cfg.transformations.regular_grid:
+            return None
+
+        return [domain.nx, domain.ny,
+                domain.xorg - domain.delx*domain.nx/2.0, domain.yorg - domain.dely*domain.ny/2.0,
+                domain.delx, domain.dely]
+
     def apply(self):
         log.debug("ToGridTransformation apply:", self.method)
         if self.method == 'Area':
+            self.grid = self.regular_grid()
             super().apply()
         elif self.method == 'Centre':
             self.to_center()
@@ -68,6 +68,14 @@ builtin_transformations_conf = {
 }
 
 
+def get_executor(trans):
+    """
+    Executor of the intersection of the transformation trans: its own executor
+    parameter or transformations.executor of the main configuration.
+    """
+    return getattr(trans, 'executor', None) or ep_cfg.transformations.executor
+
+
 def get_builtin_transformation(name):
     class TransformationConfig():
         pass
@@ -209,7 +217,8 @@ def create_transformation(trans):
             method = trans.method
         else:
             method = 'Area'
-        transformation = ToGridTransformation(normalize=normalize, method=method)
+        transformation = ToGridTransformation(normalize=normalize, method=method,
+                                              executor=get_executor(trans))
 
     elif trans.type == 'intersect' and hasattr(trans, 'intersect') and trans.intersect is not None:
         # TODO this is wrong, it remainded from time of call to_grid as intersect, needs to be generalized here!!!
@@ -220,7 +229,7 @@ def create_transformation(trans):
             outrel.coef = outrel.fields[0]  # FIXME
         except AttributeError:
             outrel = None
-        transformation = IntersectTransformation(inrel2=inrel2, outrel=outrel)
+        transformation = IntersectTransformation(inrel2=inrel2, outrel=outrel, executor=get_executor(trans))
 
     elif trans.type == 'surrogate' and hasattr(trans, 'surrogate_set') and trans.surrogate_set is not None:
         if hasattr(trans, 'surrogate_type'):
@@ -237,6 +246,12 @@ def create_transformation(trans):
 
 
 def run():
+    if ep_cfg.transformations.benchmark_sources > 0:
+        from transformations.gridding import benchmark_executors
+        benchmark_executors(ep_connection, ep_cfg,
+                            Relation(schema=ep_cfg.db_connection.case_schema, name='ep_grid_tz', fields=['grid_id']),
+                            ep_cfg.transformations.benchmark_sources)
+
     cur = ep_connection.cursor()
     log.debug('*** Initialize transformation queue...')
     cur.execute('SELECT ep_init_transformation_queue(%s)', [ep_cfg.db_connection.case_schema])
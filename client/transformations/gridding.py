@@ -0,0 +1,305 @@
+"""
+Description: client side executor of the intersection transformations
+    - ClientIntersection: intersection of a relation with the grid (or another relation)
+      computed with Shapely in a process pool, same output table as ep_intersection
+    - intersect_geometries: vectorized intersection of an array of geometries with the grid
+    - benchmark_executors: comparison of the SQL and client executors on synthetic sources
+"""
+
+"""
+This file is part of the FUME emission model.
+
+FUME is free software: you can redistribute it and/or modify it under the terms of the GNU General
+Public License as published by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+FUME is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+Information and source code can be obtained at www.fume-ep.org
+
+Copyright 2014-2023 Institute of Computer Science of the Czech Academy of Sciences, Prague, Czech Republic
+Copyright 2014-2023 Charles University, Faculty of Mathematics and Physics, Prague, Czech Republic
+Copyright 2014-2023 Czech Hydrometeorological Institute, Prague, Czech Republic
+Copyright 2014-2017 Czech Technical University in Prague, Czech Republic
+"""
+
+import io
+import csv
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import shapely
+import lib.ep_logging
+log = lib.ep_logging.Logger(__name__)
+
+
+def intersect_geometries(geoms, coefs, grid, grid_coefs, tree, normalize, srid):
+    """
+    Intersect the array of geometries geoms with the geometries grid indexed by
+    the STRtree tree, the same way as ep_intersection does: invalid geometries
+    are skipped, only the intersections of the same dimension as the geometry
+    are kept and the coefficient is the area (length) of the intersection divided
+    by the area (length) of the geometry (normalize) or 1.0 for points, multiplied
+    by the coefficients coefs and grid_coefs (None if not used).
+
+    Returns the indices of the geometries and of the grid geometries, the coefficients
+    and the intersections as multi geometries in the hex EWKB format.
+    """
+
+    valid = shapely.is_valid(geoms)
+    src, cell = tree.query(geoms, predicate='intersects')
+    keep = valid[src]
+    src, cell = src[keep], cell[keep]
+
+    dims = shapely.get_dimensions(geoms)[src]
+    inter = shapely.intersection(geoms[src], grid[cell])
+    keep = (shapely.get_dimensions(inter) == dims) & ~shapely.is_empty(inter)
+    src, cell, dims, inter = src[keep], cell[keep], dims[keep], inter[keep]
+
+    # ST_Multi(ST_CollectionExtract(intersection, dimension+1))
+    parts, index = shapely.get_parts(inter, return_index=True)
+    part_keep = shapely.get_dimensions(parts) == dims[index]
+    parts, index = parts[part_keep], index[part_keep]
+    multi = np.empty(len(inter), dtype=object)
+    for dim, make_multi in ((0, shapely.multipoints), (1, shapely.multilinestrings), (2, shapely.multipolygons)):
+        sel = dims[index] == dim
+        if sel.any():
+            make_multi(parts[sel], indices=index[sel], out=multi)
+    multi = shapely.set_srid(multi, srid)
+
+    coef = np.ones(len(inter))
+    for dim, measure in ((2, shapely.area), (1, shapely.length)):
+        sel = dims == dim
+        if sel.any():
+            total = measure(geoms[src[sel]])
+            part = measure(inter[sel])
+            if normalize:
+                part = np.divide(part, total, out=np.zeros_like(part), where=total > 0)
+            coef[sel] = np.where(total > 0, part, 0.0)
+    if coefs is not None:
+        coef *= coefs[src]
+    if grid_coefs is not None:
+        coef *= grid_coefs[cell]
+
+    return src, cell, coef, shapely.to_wkb(multi, hex=True, include_srid=True)
+
+
+# grid geometries, their coefficients, their STRtree, normalize flag and srid
+# of the worker process, set by the pool initializer
+_grid_state = None
+
+
+def _init_gridding_worker(grid_wkb, grid_coefs, normalize, srid):
+    global _grid_state
+    grid = shapely.from_wkb(grid_wkb)
+    _grid_state = (grid, grid_coefs, shapely.STRtree(grid), normalize, srid)
+
+
+def _intersect_chunk(geoms_wkb, coefs):
+    grid, grid_coefs, tree, normalize, srid = _grid_state
+    return intersect_geometries(shapely.from_wkb(geoms_wkb), coefs, grid, grid_coefs, tree, normalize, srid)
+
+
+def _table_name(schema, name):
+    if schema:
+        return '"{}"."{}"'.format(schema, name)
+    return '"{}"'.format(name)
+
+
+class ClientIntersection():
+    """
+    Client side replacement of the SQL function ep_intersection, creating
+    the same output table outrel from the relations inrel1 and inrel2.
+
+    The geometries of inrel2 (typically the grid) are read once and indexed
+    by an STRtree in every worker process. The geometries of inrel1 are streamed
+    as WKB in chunks of chunksize rows, intersected in a pool of workers processes
+    with the Shapely vectorized operations and the results are written into
+    the output table by COPY. Only the computation runs in the workers,
+    the database connection db is used by the main process only.
+    """
+
+    def __init__(self, db, inrel1, inrel2, outrel, outsrid, normalize, workers=0, chunksize=10000):
+        self.db = db
+        self.inrel1 = inrel1
+        self.inrel2 = inrel2
+        self.outrel = outrel
+        self.outsrid = outsrid
+        self.normalize = normalize
+        self.workers = workers or os.cpu_count()
+        self.chunksize = chunksize
+
+    def geometry_column(self, cur, rel):
+        cur.execute('SELECT f_geometry_column, coord_dimension, srid, type FROM public.geometry_columns '
+                    'WHERE f_table_schema = %s AND f_table_name = %s', (rel.schema, rel.name))
+        return cur.fetchone()
+
+    def geometry_query(self, rel, geomcol, srid, fields):
+        geom = '"{}"'.format(geomcol)
+        if srid != self.outsrid:
+            geom = 'ST_Transform({}, {})'.format(geom, self.outsrid)
+        columns = ['ST_AsBinary({})'.format(geom)] + ['"{}"'.format(f) for f in fields]
+        return 'SELECT {} FROM {}'.format(', '.join(columns), _table_name(rel.schema, rel.name))
+
+    def create_table(self, cur, geomtype, geomdim):
+        outname = _table_name(self.outrel.schema, self.outrel.name)
+        cur.execute('DROP TABLE IF EXISTS {}'.format(outname))
+        columns = ['"{}" serial'.format(self.outrel.pk)]
+        for rel in (self.inrel1, self.inrel2):
+            for field in rel.fields:
+                cur.execute('SELECT data_type FROM information_schema.columns '
+                            'WHERE table_schema = %s AND table_name = %s AND column_name = %s',
+                            (rel.schema, rel.name, field))
+                columns.append('"{}" {}'.format(field, cur.fetchone()[0]))
+        if self.outrel.coef:
+            columns.append('"{}" double precision'.format(self.outrel.coef))
+        columns.append('PRIMARY KEY ("{}")'.format(self.outrel.pk))
+        cur.execute('CREATE {}TABLE {} ({}){}'.format('TEMP ' if self.outrel.temp else '', outname,
+                                                      ', '.join(columns),
+                                                      ' ON COMMIT DROP' if self.outrel.temp else ''))
+
+        if geomtype.startswith('MULTI') or geomtype.startswith('GEOMETRY'):
+            outtype = geomtype
+        else:
+            outtype = 'MULTI' + geomtype
+        cur.execute('SELECT AddGeometryColumn(%s, %s, %s, %s, %s, %s)',
+                    (self.outrel.schema, self.outrel.name, self.outrel.geom_field,
+                     self.outsrid, outtype, geomdim))
+
+    def write(self, cur, rows, result):
+        src, cell, coef, wkb = result
+        if len(src) == 0:
+            return
+
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        nfields1 = len(self.inrel1.fields)
+        for s, c, k, g in zip(src, cell, coef, wkb):
+            line = list(rows[s][1:nfields1+1]) + list(self.grid_values[c])
+            if self.outrel.coef:
+                line.append(repr(float(k)))
+            line.append(g)
+            writer.writerow(line)
+        buf.seek(0)
+
+        columns = self.inrel1.fields + self.inrel2.fields + ([self.outrel.coef] if self.outrel.coef else []) + \
+            [self.outrel.geom_field]
+        cur.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                            _table_name(self.outrel.schema, self.outrel.name),
+                            ', '.join('"{}"'.format(c) for c in columns)), buf)
+
+    def run(self):
+        cur = self.db.cursor()
+        geomcol1, geomdim1, srid1, geomtype1 = self.geometry_column(cur, self.inrel1)
+        geomcol2, geomdim2, srid2, geomtype2 = self.geometry_column(cur, self.inrel2)
+        if not self.outsrid:
+            self.outsrid = srid1
+
+        self.create_table(cur, geomtype1, geomdim1)
+
+        # grid geometries with their values and coefficients
+        fields2 = self.inrel2.fields + ([self.inrel2.coef] if self.inrel2.coef else [])
+        cur.execute(self.geometry_query(self.inrel2, geomcol2, srid2, fields2))
+        grid = cur.fetchall()
+        grid_wkb = [bytes(r[0]) for r in grid]
+        self.grid_values = [r[1:len(self.inrel2.fields)+1] for r in grid]
+        grid_coefs = np.array([r[-1] for r in grid], dtype=float) if self.inrel2.coef else None
+        log.debug('ClientIntersection:', len(grid), 'geometries of', self.inrel2.name, 'read')
+
+        fields1 = self.inrel1.fields + ([self.inrel1.coef] if self.inrel1.coef else [])
+        query = self.geometry_query(self.inrel1, geomcol1, srid1, fields1)
+        log.debug('ClientIntersection:', query)
+        cur.execute('DECLARE ep_client_intersection CURSOR FOR {}'.format(query))
+        cur2 = self.db.cursor('ep_client_intersection')
+
+        # at most two chunks per worker are waiting, so that the sources are streamed
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_gridding_worker,
+                                 initargs=(grid_wkb, grid_coefs, self.normalize, self.outsrid)) as executor:
+            while True:
+                rows = cur2.fetchmany(self.chunksize)
+                if not rows:
+                    break
+                coefs = np.array([r[-1] for r in rows], dtype=float) if self.inrel1.coef else None
+                pending.append((rows, executor.submit(_intersect_chunk, [bytes(r[0]) for r in rows], coefs)))
+                while len(pending) > 2*self.workers:
+                    rows, future = pending.popleft()
+                    self.write(cur, rows, future.result())
+            while pending:
+                rows, future = pending.popleft()
+                self.write(cur, rows, future.result())
+        cur2.close()
+
+        outname = _table_name(self.outrel.schema, self.outrel.name)
+        cur.execute('CREATE INDEX IF NOT EXISTS "{}_{}" ON {} USING gist ("{}")'.format(
+                    self.outrel.name, self.outrel.geom_field, outname, self.outrel.geom_field))
+        cur.execute('ANALYZE {}'.format(outname))
+        cur.close()
+
+
+def benchmark_executors(db, cfg, grid, nsources):
+    """
+    Compare the SQL (ep_intersection) and the client executor on nsources
+    synthetic sources (polygons, lines and points in equal numbers spread
+    randomly over the grid envelope) intersected with the relation grid.
+    The wall times, the numbers of the output rows and the sums of the
+    coefficients of both executors are reported, all tables are dropped.
+    """
+
+    from lib.db import Relation
+    schema = cfg.db_connection.case_schema
+    srid = cfg.projection_params.projection_srid
+    srcrel = Relation(schema=schema, name='ep_gridding_benchmark_src', fields=['src_id'])
+    outrels = {executor: Relation(schema=schema, name='ep_gridding_benchmark_' + executor,
+                                  fields=['src_id'] + grid.fields, pk='id', coef='coef')
+               for executor in ('sql', 'client')}
+
+    cur = db.cursor()
+    cur.execute('SELECT ST_XMin(geom), ST_YMin(geom), ST_XMax(geom), ST_YMax(geom) FROM "{}".ep_grid_env'.format(schema))
+    xmin, ymin, xmax, ymax = cur.fetchone()
+    size = min(xmax - xmin, ymax - ymin) / 50.0
+    cur.execute('DROP TABLE IF EXISTS "{}"."{}"'.format(schema, srcrel.name))
+    cur.execute('CREATE TABLE "{schema}"."{table}" (src_id integer, geom geometry(Geometry, {srid}))'.format(
+                schema=schema, table=srcrel.name, srid=srid))
+    cur.execute('SELECT setseed(0.5)')
+    cur.execute('INSERT INTO "{schema}"."{table}" '
+                'SELECT n, CASE mod(n, 3) '
+                '  WHEN 0 THEN ST_Buffer(ST_MakePoint(x, y), %(size)s * random(), 4) '
+                '  WHEN 1 THEN ST_MakeLine(ST_MakePoint(x, y), ST_MakePoint(x + %(size)s * (random() - 0.5) * 4, '
+                '                                                          y + %(size)s * (random() - 0.5) * 4)) '
+                '  ELSE ST_MakePoint(x, y) END '
+                'FROM (SELECT n, %(xmin)s + random() * %(width)s AS x, %(ymin)s + random() * %(height)s AS y '
+                '      FROM generate_series(1, %(n)s) AS n) AS p'.format(schema=schema, table=srcrel.name),
+                {'size': size, 'xmin': xmin, 'ymin': ymin, 'width': xmax - xmin, 'height': ymax - ymin,
+                 'n': nsources})
+    cur.execute('UPDATE "{}"."{}" SET geom = ST_SetSRID(geom, {})'.format(schema, srcrel.name, srid))
+    cur.execute('CREATE INDEX ON "{}"."{}" USING gist (geom)'.format(schema, srcrel.name))
+    cur.execute('ANALYZE "{}"."{}"'.format(schema, srcrel.name))
+    db.commit()
+
+    for executor, outrel in outrels.items():
+        start = time.perf_counter()
+        if executor == 'sql':
+            cur.execute('SELECT ep_intersection(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)',
+                        [schema, srcrel.name, '{src_id}', '', grid.schema, grid.name,
+                         '{' + ','.join(grid.fields) + '}', grid.coef, schema, outrel.name,
+                         srid, outrel.pk, outrel.geom_field, outrel.coef, True, True, False])
+        else:
+            ClientIntersection(db, srcrel, grid, outrel, srid, True,
+                               workers=cfg.transformations.client_workers,
+                               chunksize=cfg.transformations.client_chunk).run()
+        db.commit()
+        elapsed = time.perf_counter() - start
+        cur.execute('SELECT count(*), sum(coef) FROM "{}"."{}"'.format(schema, outrel.name))
+        nrows, coefsum = cur.fetchone()
+        log.info('Gridding benchmark, executor {}: {} sources, {} intersections, sum of coefficients {:.6f}, '
+                 '{:.2f} s'.format(executor, nsources, nrows, coefsum or 0.0, elapsed))
+
+    for rel in [srcrel] + list(outrels.values()):
+        cur.execute('DROP TABLE IF EXISTS "{}"."{}"'.format(rel.schema, rel.name))
+    db.commit()
+    cur.close()
@@ -1,4 +1,4 @@
-/*
+﻿/*
 Description: It creates grid table for in FUME model.
 */
 
@@ -56,15 +56,6 @@ declare
     ret boolean;
     res text;
     sqltext text;
-    sqlinsert text;
-    i integer;
-    j integer;
-    xmin double precision;
-    xmax double precision;
-    ymin double precision;
-    ymax double precision;
-    geomtext text;
-    geomgrid geometry;
 begin
     ret = false;
     -- tn = quote_ident(gridschema) || '.' || quote_ident(gridtable);
@@ -84,32 +75,25 @@ begin
         'yma double precision  ' ||
         ' )', gridschema, gridtable);
     execute sqltext;
-    sqltext = format('alter table %I.%I add primary key (grid_id)', gridschema, gridtable);
-    execute sqltext;
     -- create geometry column
     perform AddGeometryColumn(gridschema, gridtable, 'geom', srid, 'POLYGON', 2);
 
-    -- create particular gridboxes and intersect them with timezones
-    sqlinsert = format('insert into %I.%I (' ||
-              'i, j, xmi, xma, ymi, yma, geom) values (' ||
-              '$1, $2, $3, $4, $5, $6, $7 )', gridschema, gridtable);
-    raise notice 'sqlinsert = %', sqlinsert;
-    for i in 1 .. nx loop
-        for j in 1 .. ny loop
-            --raise notice 'Add gridbox i,j = %,%', i, j;
-            xmin = xo+dx*(i-1-nx/2.0);
-            xmax = xo+dx*(i-nx/2.0);
-            ymin = yo+dy*(j-1-ny/2.0);
-            ymax = yo+dy*(j-ny/2.0);
-            geomtext = format('POLYGON((%s %s, %s %s, %s %s, %s %s, %s %s))',
-                       xmin, ymin, xmax, ymin, xmax, ymax, xmin, ymax, xmin, ymin);
-            --raise notice 'geomtext=%', geomtext;
-            geomgrid = ST_GeometryFromText(geomtext,srid);
-            execute sqlinsert using i, j, xmin, xmax, ymin, ymax, geomgrid;
-        end loop;
-    end loop;
-
-    -- create geometry index
+    -- create all gridboxes in one statement, grid_id numbered by i and then j
+    sqltext = format('insert into %I.%I (grid_id, i, j, xmi, xma, ymi, yma, geom) ' ||
+              'select (i-1)*$2+j, i, j, xmi, xma, ymi, yma, ST_MakeEnvelope(xmi, ymi, xma, yma, $7) ' ||
+              'from (select i, j, ' ||
+              '             $5+$3*(i-1-$1/2.0) as xmi, $5+$3*(i-$1/2.0) as xma, ' ||
+              '             $6+$4*(j-1-$2/2.0) as ymi, $6+$4*(j-$2/2.0) as yma ' ||
+              '      from generate_series(1, $1) as i cross join generate_series(1, $2) as j) as b',
+              gridschema, gridtable);
+    raise notice 'sqltext = %', sqltext;
+    execute sqltext using nx, ny, dx, dy, xo, yo, srid;
+    execute format('select setval(pg_get_serial_sequence(%L, %L), %s)',
+                   format('%I.%I', gridschema, gridtable), 'grid_id', nx*ny);
+
+    -- create primary key and indexes after the load
+    sqltext = format('alter table %I.%I add primary key (grid_id)', gridschema, gridtable);
+    execute sqltext;
     execute format('create index if not exists %I on %I.%I using gist(geom)',  gridtable||'_geom', gridschema, gridtable);
     execute format('create index if not exists %I on %I.%I (i,j)',  gridtable||'_i_j', gridschema, gridtable);
 
@@ -32,7 +32,26 @@ Copyright 2014-2017 Czech Technical University in Prague, Czech Republic
 * coef1 and coef2. The intersect geometry is stored in field
 * of name geomcoli. The value createtable denotes if a new table
 * tablei shall be created and tempi if this table is created as temporary.
+* If table2 is the regular case grid with columns i, j (ep_grid_tz),
+* its parameters can be passed in the array grid = {nx, ny, xmin, ymin, dx, dy}
+* (xmin, ymin is the lower left corner of the grid). The candidate
+* grid cells of every table1 geometry are then computed arithmetically
+* row by row instead of the spatial join with table2.
+* The intersection can be limited to one tile of table2 by the array
+* tile = {n, x0, y0, wx, wy, tx, ty, xmin, ymin, xmax, ymax}: the table2
+* geometries are split into n x n tiles of size wx, wy starting at x0, y0
+* by the centre of their bounding box (the outer tiles extend to infinity),
+* only the geometries of the tile tx, ty (counted from 0) are intersected
+* with the table1 geometries overlapping the box xmin, ymin, xmax, ymax
+* (extent of the tile). Every pair of geometries belongs to exactly one
+* tile, so the tiles can be intersected in parallel into the same table.
+* If tile is an empty array, only the table tablei is created.
 *********************************************************************/
+drop function if exists ep_intersection(text, text, text[], text, text, text, text[], text, text, text, integer,
+                                        text, text, text, boolean, boolean, boolean);
+drop function if exists ep_intersection(text, text, text[], text, text, text, text[], text, text, text, integer,
+                                        text, text, text, boolean, boolean, boolean, double precision[]);
+
 create or replace function ep_intersection (
     schema1 text,
     table1 text,
@@ -50,7 +69,9 @@ create or replace function ep_intersection (
     coefi text,
     normaliz boolean,
     createtable boolean,
-    tempi boolean)
+    tempi boolean,
+    grid double precision[] default null,
+    tile double precision[] default null)
     returns boolean as
 $$
 declare
@@ -84,14 +105,22 @@ declare
     i integer;
     j integer;
     sqltext text;
-    sqltrans1 text;
-    sqltrans2 text;
+    sqltext2 text;
+    sqlgeom1 text;
+    sqlgeom2 text;
+    sqlfrom1 text;
+    sqlfrom2 text;
     sqlcoef text;
     sqldim text;
     sqlfields1 text;
     sqlcond1 text;
     sqlnorma text;
     sqlnorml text;
+    sqlrowmin text;
+    sqlrowmax text;
+    sqltile text;
+    cols text[];
+    eps double precision = 1e-6;
 
     rec1 text[];
     rec2 text[];
@@ -102,7 +131,7 @@ declare
     ci double precision;
 
 begin
-    raise notice 'ep_intersection: %, %, %, %, %, %, %, %, %, %, %, %, %, %, %, %, %', schema1,table1,fields1,coef1,schema2,table2,fields2,coef2,schemai,tablei,sridi,idi,geomcoli,coefi,normaliz,createtable,tempi;
+    raise notice 'ep_intersection: %, %, %, %, %, %, %, %, %, %, %, %, %, %, %, %, %, %, %', schema1,table1,fields1,coef1,schema2,table2,fields2,coef2,schemai,tablei,sridi,idi,geomcoli,coefi,normaliz,createtable,tempi,grid,tile;
     -- construct table full names
     if schema1 = '' then
         tablename1 = format('%I',table1);
@@ -234,21 +263,52 @@ begin
 
     -- select part
     sqltext = sqltext || ') select ';
-    -- prepare transformation strings
+
+    -- The inputs are transformed to sridi only once: table1 in a subquery
+    -- (OFFSET 0 keeps the planner from repeating ST_Transform for every pair),
+    -- table2 (usually the grid) into a temporary table with its own spatial index,
+    -- so that the join can still use an index.
     if srid1 = sridi then
-        sqltrans1 = format('t1.%I', geomcol1);
+        sqlgeom1 = format('t1.%I', geomcol1);
+        sqlfrom1 = format('%s AS t1', tablename1);
     else
-        sqltrans1 = format('ST_Transform(t1.%I,%s)', geomcol1, sridi);
+        sqlgeom1 = 't1.ep_geom';
+        sqlfrom1 = format('(SELECT ST_Transform(t.%I,%s) AS ep_geom', geomcol1, sridi);
+        cols = fields1;
+        if coef1 <> '' and not coef1 = any(cols) then
+            cols = cols || coef1;
+        end if;
+        foreach field in array cols
+        loop
+            sqlfrom1 = sqlfrom1||format(', t.%I', field);
+        end loop;
+        sqlfrom1 = sqlfrom1||format(' FROM %s AS t OFFSET 0) AS t1', tablename1);
     end if;
     if sridi = srid2 then
-        sqltrans2 = format('t2.%I',geomcol2);
+        sqlgeom2 = format('t2.%I', geomcol2);
+        sqlfrom2 = format('%s AS t2', tablename2);
     else
-        sqltrans2 = format('ST_Transform(t2.%I,%s)',geomcol2,sridi);
+        sqlgeom2 = 't2.ep_geom';
+        sqltext2 = format('SELECT ST_Transform(t.%I,%s) AS ep_geom', geomcol2, sridi);
+        cols = fields2;
+        if coef2 <> '' and not coef2 = any(cols) then
+            cols = cols || coef2;
+        end if;
+        foreach field in array cols
+        loop
+            sqltext2 = sqltext2||format(', t.%I', field);
+        end loop;
+        execute 'drop table if exists ep_intersection_t2';
+        execute format('create temp table ep_intersection_t2 on commit drop as %s FROM %s AS t', sqltext2, tablename2);
+        execute 'create index on ep_intersection_t2 using gist (ep_geom)';
+        execute 'analyze ep_intersection_t2';
+        sqlfrom2 = 'ep_intersection_t2 AS t2';
     end if;
+    sqldim = format('ST_Dimension(%s)', sqlgeom1);
 
-    -- intersect geometry
-    sqltext = sqltext ||' ST_Multi(ST_CollectionExtract(ST_Intersection('||sqltrans1||','||sqltrans2||'), 
-    least(ST_Dimension('||sqltrans1||')+1, ST_Dimension('||sqltrans2||')+1))) ';
+    -- intersect geometry (table2 geometries are polygons, i.e. the dimension
+    -- of the intersection is the dimension of the table1 geometry)
+    sqltext = sqltext ||' ST_Multi(ST_CollectionExtract(x.ep_geom, '||sqldim||'+1)) ';
 
     -- field values
     foreach field in array fields1
@@ -271,31 +331,29 @@ begin
         if coef2 <> '' then
             sqlcoef = sqlcoef||format(' * t2.%I',coef2);
         end if;
-        -- dimmension of geometry
-        sqldim = format('ST_Dimension(t1.%I)', geomcol1);
         -- normalization formulas
         if normaliz then
-          sqlnorma = '/ST_Area('||sqltrans1||')';
-          sqlnorml = '/ST_Length('||sqltrans1||')';
+          sqlnorma = '/ST_Area('||sqlgeom1||')';
+          sqlnorml = '/ST_Length('||sqlgeom1||')';
         else
           sqlnorma = '';
           sqlnorml = '';
         end if;
 
-        -- coefi calculation
+        -- coefi calculation from the measure of the intersection
             sqltext = sqltext ||
                 ', CASE
                      WHEN '||sqldim||' = 2 THEN
                        CASE
-                         WHEN ST_Area('||sqltrans1||') > 0 THEN
-                       ST_Area(ST_Intersection('||sqltrans1||','||sqltrans2||'))'||sqlnorma||sqlcoef||'
+                         WHEN ST_Area('||sqlgeom1||') > 0 THEN
+                       ST_Area(x.ep_geom)'||sqlnorma||sqlcoef||'
                          ELSE
                            0.0
                          END
                      WHEN '||sqldim||' = 1 THEN
                        CASE
-                         WHEN ST_Length('||sqltrans1||') > 0 THEN
-                       ST_Length(ST_Intersection('||sqltrans1||','||sqltrans2||'))'||sqlnorml||sqlcoef||'
+                         WHEN ST_Length('||sqlgeom1||') > 0 THEN
+                       ST_Length(x.ep_geom)'||sqlnorml||sqlcoef||'
                          ELSE
                            0.0
                        END
@@ -303,14 +361,63 @@ begin
                    END ';
     end if;
 
-    sqltext = sqltext || ' FROM ' || tablename1 || ' AS t1 ';
-    sqltext = sqltext || ' JOIN ' || tablename2 || ' AS t2 ';
-    sqltext = sqltext || ' ON ST_IsValid('||sqltrans1||') and ST_Intersects('||sqltrans1||','||sqltrans2||')';
-    sqltext = sqltext || ' where ST_Dimension(ST_Multi(ST_Intersection('||sqltrans1||','||sqltrans2||'))) = ';
-    sqltext = sqltext || ' least(ST_Dimension('||sqltrans1||'), ST_Dimension('||sqltrans2||'))';
+    -- The pairs are found by the spatial index (&&), the intersection of each pair
+    -- is computed once in the LATERAL subquery (OFFSET 0 keeps it from being inlined
+    -- into every expression using it). Geometries covering each other need no
+    -- intersection, ST_Intersects is evaluated only for the other pairs.
+    sqltext = sqltext || ' FROM ' || sqlfrom1;
+    -- table2 geometries of the tile, by the centre of their bounding box
+    -- (the tile is passed as parameter $1 to keep the exact values of its bounds)
+    sqltile = '';
+    if cardinality(tile) > 0 then
+        sqltile = format(' AND least($1[1] - 1, greatest(0, floor(((ST_XMin(%1$s) + ST_XMax(%1$s)) / 2 - $1[2]) / $1[4]))) = $1[6]'
+                         ' AND least($1[1] - 1, greatest(0, floor(((ST_YMin(%1$s) + ST_YMax(%1$s)) / 2 - $1[3]) / $1[5]))) = $1[7]',
+                         sqlgeom2);
+    end if;
+    if grid is not null and sridi = srid2 then
+        -- Regular grid {nx, ny, xmin, ymin, dx, dy}: the rows touched by the bounding box
+        -- of the geometry are computed arithmetically, the geometry is clipped by each
+        -- row strip and the columns are taken from the bounding box of the clipped part.
+        -- The cells are read from table2 by their (i, j) index, the intersections
+        -- are then the same as those of the spatial join.
+        sqltext = sqltext || format(' CROSS JOIN LATERAL (SELECT generate_series('
+                                    'greatest(1, ceil((ST_YMin(%1$s) - %2$s) / %3$s - %4$s)::integer), '
+                                    'least(%5$s, floor((ST_YMax(%1$s) - %2$s) / %3$s + %4$s)::integer + 1)) AS j '
+                                    'WHERE ST_IsValid(%1$s)) AS ep_row',
+                                    sqlgeom1, grid[4], grid[6], eps, grid[2]::integer);
+        sqlrowmin = format('%s + (ep_row.j - 1) * %s', grid[4], grid[6]);
+        sqlrowmax = format('%s + ep_row.j * %s', grid[4], grid[6]);
+        sqltext = sqltext || ' CROSS JOIN LATERAL (SELECT CASE'
+                          || ' WHEN '||sqldim||' = 0 THEN '||sqlgeom1
+                          || format(' WHEN ST_YMin(%1$s) >= %2$s AND ST_YMax(%1$s) <= %3$s THEN %1$s',
+                                    sqlgeom1, sqlrowmin, sqlrowmax)
+                          || format(' ELSE ST_Intersection(%1$s, ST_MakeEnvelope(ST_XMin(%1$s), %2$s - %5$s, ST_XMax(%1$s), %3$s + %5$s, %4$s))',
+                                    sqlgeom1, sqlrowmin, sqlrowmax, sridi, eps * grid[6])
+                          || ' END AS ep_geom OFFSET 0) AS ep_strip';
+        sqltext = sqltext || format(' CROSS JOIN LATERAL generate_series('
+                                    'greatest(1, ceil((ST_XMin(ep_strip.ep_geom) - %1$s) / %2$s - %3$s)::integer), '
+                                    'least(%4$s, floor((ST_XMax(ep_strip.ep_geom) - %1$s) / %2$s + %3$s)::integer + 1)) AS ep_col(i)',
+                                    grid[3], grid[5], eps, grid[1]::integer);
+        sqltext = sqltext || ' JOIN ' || sqlfrom2 || ' ON t2.i = ep_col.i AND t2.j = ep_row.j' || sqltile;
+    else
+        sqltext = sqltext || ' JOIN ' || sqlfrom2 || ' ON ' || sqlgeom1 || ' && ' || sqlgeom2 || sqltile;
+    end if;
+    sqltext = sqltext || ' CROSS JOIN LATERAL (SELECT CASE'
+                      || ' WHEN '||sqldim||' = 2 AND ST_CoveredBy('||sqlgeom2||','||sqlgeom1||') THEN '||sqlgeom2
+                      || ' WHEN ST_CoveredBy('||sqlgeom1||','||sqlgeom2||') THEN '||sqlgeom1
+                      || ' WHEN ST_Intersects('||sqlgeom1||','||sqlgeom2||') THEN ST_Intersection('||sqlgeom1||','||sqlgeom2||')'
+                      || ' END AS ep_geom OFFSET 0) AS x';
+    sqltext = sqltext || ' where ST_IsValid('||sqlgeom1||') and x.ep_geom is not null';
+    sqltext = sqltext || ' and ST_Dimension(x.ep_geom) = ' || sqldim;
+    if cardinality(tile) > 0 then
+        sqltext = sqltext || format(' and %s && ST_MakeEnvelope($1[8], $1[9], $1[10], $1[11], %s)',
+                                    sqlgeom1, sridi);
+    end if;
 
-    raise notice 'Intersect: %', sqltext;
-    execute sqltext;
+    if tile is null or cardinality(tile) > 0 then
+        raise notice 'Intersect: %, %', sqltext, tile;
+        execute sqltext using tile;
+    end if;
 
     -- normalize points on border of more table2 geometries -
     -- devide coefficient by number of intersecting geometries
@@ -363,9 +470,11 @@ begin
         */
     end if;
 
-    -- recompile statistics
-    sqltext = format('analyze %s', tablenamei);
-    execute sqltext;
+    -- recompile statistics (the tiles are analyzed by the caller when all are finished)
+    if tile is null or cardinality(tile) = 0 then
+        sqltext = format('analyze %s', tablenamei);
+        execute sqltext;
+    end if;
 
     return true;
 